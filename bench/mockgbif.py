@@ -0,0 +1,400 @@
+#-*- coding: utf-8 -*-
+
+'''
+Local stand-in for the GBIF api, replaying the records of fixtures/.
+
+   python bench/mockgbif.py --port 8700 --latency 20 --error_rate 0.01 --records 30000 --polls 3
+   python easy_gbif.py --gbif_url http://127.0.0.1:8700/v1/ -s --sCountry PT --all
+
+Answers occurrence search (pages of the fixture records, renumbered up to
+--records, with their own year, month and coordinates to filter on, the
+facets of those and of country, taxonKey, basisOfRecord and datasetKey, and
+a 400 answer past --max_offset), get, verbatim, fragment, count, the count_*
+lists and the count schema (fixtures/count_schema.json), species match (the
+names of the fixture records), species/{key} (the usages of fixtures/species.json:
+the species of the fixture records and some of their higher taxa), and the
+download cycle: a POSTed request gets a key, download_meta reports it
+PREPARING for --polls calls then SUCCEEDED, and the zip (made of the
+fixture export rows, --rows rows) is served with Range support.
+Every answer waits --latency ms, and a share --error_rate of them are 503s.
+GET /_stats gives the count and handling times of the requests.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+KEY_BASE = 3000000000
+
+## search fields of the occurrence numbers, and of the fixture records
+PLACE = ['year', 'month', 'decimalLatitude', 'decimalLongitude']
+FIELDS = {'country': 'countryCode', 'taxonKey': 'taxonKey', 'basisOfRecord': 'basisOfRecord', 'datasetKey': 'datasetKey'}
+
+
+def load_records():
+    with open(os.path.join(FIXTURES, 'occurrences.json')) as f:
+        return json.load(f)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+
+def record(records, n):
+    """ the fixture record of occurrence number n, with its own key """
+    item = dict(records[n % len(records)])
+    item['key'] = KEY_BASE + n
+    item['gbifID'] = str(KEY_BASE + n)
+    return item
+
+
+def export(rows, seed=0):
+    """ a download zip of rows rows, the fixture export rows renumbered and with jittered coordinates """
+    state = random.Random(seed)
+    with open(os.path.join(FIXTURES, 'occurrence.tsv')) as f:
+        header = f.readline()
+        fixture = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+    names = header.rstrip('\n').split('\t')
+    gbifid, lat, lon = names.index('gbifid'), names.index('decimallatitude'), names.index('decimallongitude')
+    lines = [header]
+    for n in range(rows):
+        fields = list(fixture[n % len(fixture)])
+        fields[gbifid] = str(KEY_BASE + n)
+        fields[lat] = '%.6f' % (float(fields[lat]) + state.uniform(-0.5, 0.5))
+        fields[lon] = '%.6f' % (float(fields[lon]) + state.uniform(-0.5, 0.5))
+        lines.append('\t'.join(fields) + '\n')
+    buf = StringIO()
+    archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    archive.writestr('occurrence.csv', ''.join(lines))
+    archive.close()
+    return buf.getvalue()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    ## one write per answer: headers and body in separate segments meet the delayed ack of keep-alive clients
+    wbufsize = -1
+
+    def _answer(self, code, body, content_type='application/json', headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def _json(self, data, code=200):
+        self._answer(code, json.dumps(data))
+
+    def _handle(self, method):
+        start = time.time()
+        mock = self.server.mock
+        url = urlparse.urlparse(self.path)
+        path = re.sub(r'^/v1/', '', url.path).strip('/')
+        params = dict((name, values if name == 'facet' else values[-1]) for name, values in urlparse.parse_qs(url.query).items())
+        if path == '_stats':
+            self._json(mock.stats())
+            return
+        if mock.latency:
+            time.sleep(mock.latency / 1000.0)
+        if mock.fail():
+            self._json({'error': 'mock failure'}, 503)
+        else:
+            getattr(self, '_' + method)(path, params)
+        mock.record(path, time.time() - start)
+
+    def do_GET(self):
+        self._handle('get')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._handle('post')
+
+    def _get(self, path, params):
+        mock = self.server.mock
+        if path == 'occurrence/search':
+            limit = min(int(params.get('limit', 20)), 300)
+            offset = int(params.get('offset', 0))
+            if offset + limit > mock.max_offset:
+                self._json({'error': 'offset + limit over %d' % mock.max_offset}, 400)
+                return
+            numbers = mock.select(params)
+            results = [mock.occurrence(n) for n in numbers[offset:offset + limit]]
+            self._json({'offset': offset, 'limit': limit, 'endOfRecords': offset + limit >= len(numbers),
+                        'count': len(numbers), 'results': results, 'facets': mock.facets(numbers, params)})
+        elif path == 'occurrence/count':
+            self._json(mock.count)
+        elif path == 'occurrence/count/schema':
+            self._json(mock.schema)
+        elif path.startswith('occurrence/counts/'):
+            field = {'basisOfRecord': 'basisOfRecord', 'year': 'year', 'datasets': 'datasetKey',
+                     'countries': 'countryCode', 'publishingCountries': 'countryCode'}.get(path.split('/')[-1])
+            counts = {}
+            for item in mock.records:
+                value = str(item.get(field))
+                counts[value] = counts.get(value, 0) + mock.count // len(mock.records)
+            self._json(counts)
+        elif path == 'species/match':
+            self._json(mock.match(params.get('name', '')))
+        elif re.match(r'^species/\d+$', path):
+            usage = mock.usages.get(int(path.split('/')[1]))
+            if usage is not None:
+                self._json(usage)
+            else:
+                self._json({'error': 'not found'}, 404)
+        elif re.match(r'^occurrence/\d+(/verbatim|/fragment)?$', path):
+            n = int(path.split('/')[1]) - KEY_BASE
+            if 0 <= n < mock.count:
+                self._json(mock.occurrence(n))
+            else:
+                self._json({'error': 'not found'}, 404)
+        elif re.match(r'^occurrence/download/request/[\w-]+(\.zip)?$', path):
+            self._zip(path.split('/')[-1].replace('.zip', ''))
+        elif path.startswith('occurrence/download/user/'):
+            self._json({'offset': 0, 'limit': 20, 'endOfRecords': True, 'count': len(mock.downloads),
+                        'results': [mock.meta(key, poll=False) for key in sorted(mock.downloads)]})
+        elif path.startswith('occurrence/download/'):
+            key = path.split('/')[-1]
+            if key in mock.downloads:
+                self._json(mock.meta(key))
+            else:
+                self._json({'error': 'not found'}, 404)
+        else:
+            self._json({'error': 'unknown endpoint %s' % path}, 404)
+
+    def _post(self, path, params):
+        if path == 'occurrence/download/request':
+            self._answer(201, self.server.mock.submit(), 'text/plain')
+        else:
+            self._json({'error': 'unknown endpoint %s' % path}, 404)
+
+    def _zip(self, key):
+        body = self.server.mock.zip()
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match and int(match.group(1)) < len(body):
+            start = int(match.group(1))
+            self._answer(206, body[start:], 'application/zip',
+                         {'Content-Range': 'bytes %d-%d/%d' % (start, len(body) - 1, len(body))})
+        else:
+            self._answer(200, body, 'application/zip')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Mock(object):
+    """ state of the mock api: fixture records, downloads and request statistics """
+
+    def __init__(self, records=30000, rows=10000, polls=2, latency=0, error_rate=0, seed=0, base_url=None,
+                 max_offset=100000):
+        self.records = load_records()
+        self.schema = load_fixture('count_schema.json')
+        self.usages = dict((usage['key'], usage) for usage in load_fixture('species.json'))
+        self.count = records
+        self.max_offset = max_offset
+        self.rows = rows
+        self.polls = polls
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.base_url = base_url
+        self.downloads = {}
+        self.times = {}
+        self.lock = threading.Lock()
+        self._zip = None
+        self._places = None
+        self._years = {}
+        self._selected = {}
+
+    def place(self, n):
+        """ (year, month, latitude, longitude) of occurrence number n: every 211th has no year, every 97th no coordinates """
+        state = random.Random(self.seed * 1000003 + n)
+        year = None if n % 211 == 0 else state.randint(1900, 2024)
+        month = state.randint(1, 12)
+        if n % 97 == 0:
+            return year, month, None, None
+        return year, month, round(state.uniform(-60, 75), 5), round(state.uniform(-180, 180), 5)
+
+    def occurrence(self, n):
+        """ the fixture record of occurrence number n, with its own key, date and coordinates """
+        item = record(self.records, n)
+        item['year'], item['month'], item['decimalLatitude'], item['decimalLongitude'] = self.place(n)
+        return item
+
+    def value(self, n, name):
+        """ search field name of occurrence number n """
+        if name in PLACE:
+            if self._places is None:
+                self.select({})
+            return self._places[n][PLACE.index(name)]
+        return self.records[n % len(self.records)].get(FIELDS[name])
+
+    def facets(self, numbers, params):
+        """ facets answer of the facet params, counted over the occurrence numbers """
+        answer = []
+        limit = int(params.get('facetLimit', 10))
+        mincount = int(params.get('facetMincount', 1))
+        for name in params.get('facet', []):
+            if name not in PLACE and name not in FIELDS:
+                continue
+            counts = {}
+            for n in numbers:
+                value = self.value(n, name)
+                if value is not None:
+                    counts[value] = counts.get(value, 0) + 1
+            ranked = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))
+            answer.append({'field': re.sub(r'([A-Z])', r'_\1', name).upper(),
+                           'counts': [{'name': str(value), 'count': count} for value, count in ranked[:limit] if count >= mincount]})
+        return answer
+
+    def select(self, params):
+        """ numbers of the occurrences matching the year, month, coordinates and fixture field params """
+        filters = dict((name, params[name]) for name in PLACE + ['hasCoordinate'] + sorted(FIELDS) if name in params)
+        key = json.dumps(filters, sort_keys=True)
+        with self.lock:
+            if self._places is None:
+                self._places = [self.place(n) for n in range(self.count)]
+                for n, place in enumerate(self._places):
+                    self._years.setdefault(place[0], []).append(n)
+            if key in self._selected:
+                return self._selected[key]
+
+        def inside(value, bounds):
+            if value is None:
+                return False
+            low, high = (bounds.split(',') + [bounds])[:2]
+            return (low == '*' or value >= float(low)) and (high == '*' or value <= float(high))
+
+        candidates = xrange(self.count)
+        if 'year' in filters:
+            candidates = sorted(n for year in self._years if inside(year, filters['year']) for n in self._years[year])
+        numbers = []
+        for n in candidates:
+            year, month, latitude, longitude = self._places[n]
+            if 'year' in filters and not inside(year, filters['year']):
+                continue
+            if 'month' in filters and not inside(month, filters['month']):
+                continue
+            if 'decimalLatitude' in filters and not inside(latitude, filters['decimalLatitude']):
+                continue
+            if 'decimalLongitude' in filters and not inside(longitude, filters['decimalLongitude']):
+                continue
+            if 'hasCoordinate' in filters and (latitude is not None) != (filters['hasCoordinate'].lower() == 'true'):
+                continue
+            item = self.records[n % len(self.records)]
+            if any(str(item.get(FIELDS[name])) != filters[name] for name in FIELDS if name in filters):
+                continue
+            numbers.append(n)
+        with self.lock:
+            self._selected[key] = numbers
+        return numbers
+
+    def fail(self):
+        with self.lock:
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def record(self, path, seconds):
+        endpoint = re.sub(r'\d+', 'N', path)
+        with self.lock:
+            self.times.setdefault(endpoint, []).append(seconds)
+
+    def stats(self):
+        with self.lock:
+            return dict((endpoint, {'requests': len(times), 'seconds': sum(times)}) for endpoint, times in self.times.items())
+
+    def match(self, name):
+        """ species/match answer: the taxon of a fixture record of that name, or no match """
+        for item in self.records:
+            if name in (item.get('species'), item.get('scientificName')):
+                return {'usageKey': item['taxonKey'], 'scientificName': item.get('scientificName'),
+                        'canonicalName': item.get('species'), 'rank': item.get('taxonRank'), 'status': 'ACCEPTED',
+                        'kingdom': item.get('kingdom'), 'family': item.get('family'), 'matchType': 'EXACT', 'confidence': 98}
+        return {'matchType': 'NONE', 'confidence': 100, 'synonym': False}
+
+    def zip(self):
+        with self.lock:
+            if self._zip is None:
+                self._zip = export(self.rows, self.seed)
+            return self._zip
+
+    def submit(self):
+        with self.lock:
+            key = '%07d-%s' % (len(self.downloads) + 1, time.strftime('%Y%m%d%H%M%S'))
+            self.downloads[key] = 0
+        return key
+
+    def meta(self, key, poll=True):
+        with self.lock:
+            if poll:
+                self.downloads[key] += 1
+            polls = self.downloads[key]
+        status = 'SUCCEEDED' if polls > self.polls else 'PREPARING'
+        meta = {'key': key, 'status': status, 'totalRecords': self.rows,
+                'downloadLink': '%soccurrence/download/request/%s.zip' % (self.base_url, key)}
+        if status == 'SUCCEEDED':
+            meta['size'] = len(self.zip())
+        return meta
+
+
+class _ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start(port=0, **options):
+    """ serve the mock api from a background thread, returning (server, base url) """
+    server = _ThreadingServer(('127.0.0.1', port), _Handler)
+    base_url = 'http://127.0.0.1:%d/v1/' % server.server_address[1]
+    server.mock = Mock(base_url=base_url, **options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, base_url
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Local stand-in for the GBIF api')
+    parser.add_argument('--port', dest='port', help='port  – [int] port to listen on', type=int, default=8700, action='store')
+    parser.add_argument('--records', dest='records', help='records  – [int] number of occurrences of the search and count answers', type=int, default=30000, action='store')
+    parser.add_argument('--rows', dest='rows', help='rows  – [int] number of rows of the download zips', type=int, default=10000, action='store')
+    parser.add_argument('--polls', dest='polls', help='polls  – [int] number of download_meta calls answering PREPARING', type=int, default=2, action='store')
+    parser.add_argument('--latency', dest='latency', help='latency  – [float] ms added to every answer', type=float, default=0, action='store')
+    parser.add_argument('--error_rate', dest='error_rate', help='error_rate  – [float] share of answers that are 503 errors', type=float, default=0, action='store')
+    parser.add_argument('--max_offset', dest='max_offset', help='max_offset  – [int] deepest offset + limit of the search', type=int, default=100000, action='store')
+    parser.add_argument('--seed', dest='seed', help='seed  – [int] random seed of the errors and of the zip coordinates', type=int, default=0, action='store')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    server, base_url = start(args.port, records=args.records, rows=args.rows, polls=args.polls,
+                             latency=args.latency, error_rate=args.error_rate, seed=args.seed,
+                             max_offset=args.max_offset)
+    sys.stdout.write("mock GBIF api at %s\n" % base_url)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#-*- coding: utf-8 -*-
+
+'''
+Benchmarks of easy_gbif.py and of the gridding stages, against the mock api.
+
+   python bench/run.py
+   python bench/run.py --only search,partition,get --latency 20 --error_rate 0.01 --repeat 5
+   python bench/run.py --save baseline.json
+   python bench/run.py --compare baseline.json --tolerance 0.2
+
+Every benchmark is a command run --repeat times in a subprocess, with the
+mock api (bench/mockgbif.py) serving from a thread of this process. For
+each one it reports the throughput (items per second of the median run),
+the p50 and p99 of the run times, the peak RSS of the subprocess and the
+number of api requests with their mean handling time on the server.
+With --compare, a benchmark whose throughput fell, or whose p50 or peak
+RSS rose, by more than --tolerance against a saved run is a regression,
+and the exit status is 1.
+
+The startup benchmarks time a subcommand that only parses its arguments
+(get --help), and the same with the legacy flags (-g --help), which build
+the whole parser. Each fails, with exit status 1, when it takes more than
+--startup_budget ms over a bare interpreter: scripts calling easy_gbif.py
+thousands of times pay that cost on every call.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+import mockgbif
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = ['startup', 'startup_legacy', 'search', 'partition', 'get', 'download', 'grid', 'rarefy', 'diversity']
+
+## startup benchmarks, held to the budget
+STARTUP = ['startup', 'startup_legacy']
+## ms the start of a command may add to the start of a bare interpreter
+STARTUP_BUDGET = 100
+## runs of a startup benchmark, at least
+STARTUP_RUNS = 20
+
+
+def percentile(values, q):
+    """ q-th percentile of values, linearly interpolated """
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def execute(command, cwd):
+    """ (seconds, peak rss in KB, stdout) of a command run to completion """
+    out = tempfile.TemporaryFile()
+    start = time.time()
+    process = subprocess.Popen(command, cwd=cwd, stdout=out, stderr=subprocess.PIPE, env=_environ())
+    err = process.stderr.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    out.seek(0)
+    output = out.read()
+    if process.returncode != 0:
+        raise RuntimeError("%s failed (%d): %s" % (' '.join(command), process.returncode, err[-2000:]))
+    return seconds, usage.ru_maxrss, output
+
+
+def _environ():
+    environ = dict(os.environ)
+    environ.update(GBIF_USER='bench', GBIF_PWD='bench', GBIF_EMAIL='bench@example.org')
+    environ['PYTHONPATH'] = os.pathsep.join([ROOT] + [p for p in [environ.get('PYTHONPATH')] if p])
+    return environ
+
+
+class Suite(object):
+    """ the benchmark commands, their inputs and their item counts """
+
+    def __init__(self, base_url, workdir, records, rows):
+        self.base_url = base_url
+        self.workdir = workdir
+        self.records = records
+        self.rows = rows
+        self.python = sys.executable
+        self.easy_gbif = [self.python, os.path.join(ROOT, 'easy_gbif.py'), '--gbif_url', base_url,
+                          '--no_cache', '--rate', '1000']
+
+    def prepare(self, name):
+        """ (setup, command, items) of a benchmark: setup() runs before every repetition """
+        workdir = self.workdir
+        if name == 'startup':
+            return None, [self.python, os.path.join(ROOT, 'easy_gbif.py'), 'get', '--help'], 1
+        if name == 'startup_legacy':
+            return None, [self.python, os.path.join(ROOT, 'easy_gbif.py'), '-g', '--help'], 1
+        if name == 'search':
+            return None, self.easy_gbif + ['--workers', '4', '-s', '--sCountry', 'PT', '--all'], self.records
+        if name == 'partition':
+            ## a ceiling under the record count, as a large query has past the 100000 of the api
+            return None, self.easy_gbif + ['--workers', '8', '-s', '--sCountry', 'PT', '--partition',
+                                           '--partition_ceiling', str(max(self.records // 6, 300))], self.records
+        if name == 'get':
+            keys = os.path.join(workdir, 'keys.txt')
+            count = min(self.records, 2000)
+            with open(keys, 'w') as f:
+                for n in range(count):
+                    f.write('%d\n' % (mockgbif.KEY_BASE + n))
+            return None, self.easy_gbif + ['--workers', '8', '-g', '--gKeys', keys], count
+        if name == 'download':
+            path = os.path.join(workdir, 'download')
+
+            def setup():
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                os.makedirs(path)
+            return setup, self.easy_gbif + ['-d', '--wait', '-q', 'country = PT', '--path', path,
+                                            '--poll', '0.2', '--max_poll', '0.5',
+                                            '--jobs_file', os.path.join(path, 'jobs.json')], self.rows
+        export = os.path.join(workdir, 'export.zip')
+        if not os.path.exists(export):
+            with open(export, 'wb') as f:
+                f.write(mockgbif.export(self.rows))
+        if name == 'grid':
+            return None, [self.python, os.path.join(ROOT, 'grid.py'), '-i', export,
+                          '-o', os.path.join(workdir, 'cells.npz')], self.rows
+        cells = os.path.join(workdir, 'cells.npz')
+        if not os.path.exists(cells):
+            execute([self.python, os.path.join(ROOT, 'grid.py'), '-i', export, '-o', cells], workdir)
+        if name == 'rarefy':
+            return None, [self.python, os.path.join(ROOT, 'rarefy.py'), '-i', cells,
+                          '-o', os.path.join(workdir, 'rarefied.tsv'), '--depth', 'min', '--replicates', '20'], self.rows
+        if name == 'diversity':
+            return None, [self.python, os.path.join(ROOT, 'diversity.py'), '-i', cells,
+                          '-o', os.path.join(workdir, 'diversity.tsv'), '--depths', '1,5,10,20,50,100,min'], self.rows
+        raise ValueError("unknown benchmark %s" % name)
+
+
+def run(name, suite, server, repeat):
+    """ measures of repeat runs of a benchmark """
+    setup, command, items = suite.prepare(name)
+    if name in STARTUP:
+        repeat = max(repeat, STARTUP_RUNS)
+    seconds, rss = [], []
+    before = server.mock.stats()
+    for n in range(repeat):
+        if setup is not None:
+            setup()
+        wall, peak, output = execute(command, suite.workdir)
+        seconds.append(wall)
+        rss.append(peak)
+    after = server.mock.stats()
+    requests = sum(entry['requests'] for entry in after.values()) - sum(entry['requests'] for entry in before.values())
+    handling = sum(entry['seconds'] for entry in after.values()) - sum(entry['seconds'] for entry in before.values())
+    p50 = percentile(seconds, 50)
+    return {'items': items, 'runs': repeat, 'throughput': items / p50 if p50 else None,
+            'p50': p50, 'p99': percentile(seconds, 99), 'peak_rss_kb': max(rss),
+            'requests': requests // repeat, 'server_ms': 1000.0 * handling / requests if requests else None}
+
+
+def compare(results, baseline, tolerance):
+    """ list of the regressions of results against baseline """
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if old.get('throughput') and result['throughput'] < old['throughput'] * (1 - tolerance):
+            regressions.append('%s throughput %.1f -> %.1f items/s' % (name, old['throughput'], result['throughput']))
+        if result['p50'] > old['p50'] * (1 + tolerance):
+            regressions.append('%s p50 %.3f -> %.3f s' % (name, old['p50'], result['p50']))
+        if result['peak_rss_kb'] > old['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('%s peak RSS %d -> %d KB' % (name, old['peak_rss_kb'], result['peak_rss_kb']))
+    return regressions
+
+
+def report(results):
+    sys.stdout.write('%-14s %10s %14s %9s %9s %12s %9s %10s\n'
+                     % ('benchmark', 'items', 'items/s', 'p50 s', 'p99 s', 'peak RSS MB', 'requests', 'server ms'))
+    for name in BENCHMARKS:
+        if name not in results:
+            continue
+        result = results[name]
+        sys.stdout.write('%-14s %10d %14.1f %9.3f %9.3f %12.1f %9d %10s\n'
+                         % (name, result['items'], result['throughput'], result['p50'], result['p99'],
+                            result['peak_rss_kb'] / 1024.0, result['requests'],
+                            '-' if result['server_ms'] is None else '%.2f' % result['server_ms']))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks of easy_gbif.py against a local mock of the GBIF api')
+    parser.add_argument('--only', dest='only', help='only  – [str] comma separated benchmarks to run, among %s' % ','.join(BENCHMARKS), action='store')
+    parser.add_argument('--repeat', dest='repeat', help='repeat  – [int] number of runs of every benchmark', type=int, default=3, action='store')
+    parser.add_argument('--latency', dest='latency', help='latency  – [float] ms the mock api waits before every answer', type=float, default=5, action='store')
+    parser.add_argument('--error_rate', dest='error_rate', help='error_rate  – [float] share of the mock api answers that are 503 errors', type=float, default=0, action='store')
+    parser.add_argument('--records', dest='records', help='records  – [int] number of occurrences of the mock search', type=int, default=6000, action='store')
+    parser.add_argument('--rows', dest='rows', help='rows  – [int] number of rows of the mock download', type=int, default=200000, action='store')
+    parser.add_argument('--polls', dest='polls', help='polls  – [int] number of download status checks answering PREPARING', type=int, default=2, action='store')
+    parser.add_argument('--save', dest='save', help='save  – [str] Json file to write the results to', action='store')
+    parser.add_argument('--compare', dest='compare', help='compare  – [str] Json file of saved results to check for regressions', action='store')
+    parser.add_argument('--startup_budget', dest='startup_budget', help='startup_budget  – [float] ms the startup benchmark may take over a bare interpreter', type=float, default=STARTUP_BUDGET, action='store')
+    parser.add_argument('--tolerance', dest='tolerance', help='tolerance  – [float] relative change counted as a regression', type=float, default=0.2, action='store')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    names = args.only.split(',') if args.only else BENCHMARKS
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError("unknown benchmark %s" % name)
+    server, base_url = mockgbif.start(records=args.records, rows=args.rows, polls=args.polls,
+                                      latency=args.latency, error_rate=args.error_rate)
+    workdir = tempfile.mkdtemp(prefix='easy_gbif-bench-')
+    suite = Suite(base_url, workdir, args.records, args.rows)
+    results = {}
+    try:
+        for name in names:
+            sys.stdout.write("== %s\n" % name)
+            sys.stdout.flush()
+            results[name] = run(name, suite, server, args.repeat)
+        if any(name in results for name in STARTUP):
+            bare = percentile([execute([sys.executable, '-c', 'pass'], workdir)[0] for n in range(STARTUP_RUNS)], 50)
+            for name in STARTUP:
+                if name in results:
+                    results[name]['overhead_ms'] = 1000 * (results[name]['p50'] - bare)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    report(results)
+    failed = False
+    for name in STARTUP:
+        if name not in results:
+            continue
+        overhead = results[name]['overhead_ms']
+        sys.stdout.write("%s: %.1f ms over a bare interpreter, budget %.1f ms\n" % (name, overhead, args.startup_budget))
+        if overhead > args.startup_budget:
+            sys.stdout.write("STARTUP BUDGET exceeded\n")
+            failed = True
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            sys.stdout.write("REGRESSION %s\n" % regression)
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
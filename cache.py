@@ -0,0 +1,175 @@
+#-*- coding: utf-8 -*-
+
+'''
+On-disk cache of the responses of the read-only GBIF endpoints, in SQLite.
+
+Entries are keyed on the endpoint name plus the normalized argument set,
+expire after a per-endpoint TTL, and the least recently used entries are
+evicted once the cache grows over its size cap. Endpoints not listed in
+TTL are never cached. The endpoints of CONDITIONS pick the TTL entry of
+an answer from their arguments, or leave it uncached: a search page is
+cached for a day when its query ends in a past year, as records of the
+current one are still coming in, and a limit=0 search (the counts and
+facets of cube.py and partition.py) for an hour whatever its years.
+'''
+
+import os
+import time
+import json
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+HOUR = 3600
+DAY = 86400
+
+## seconds an entry of each endpoint stays valid
+TTL = {
+    'count_schema':              30 * DAY,
+    'count_basisofrecord':        7 * DAY,
+    'count_year':                 7 * DAY,
+    'count_countries':            7 * DAY,
+    'count_publishingcountries':  7 * DAY,
+    'count_datasets':             7 * DAY,
+    'count':                      1 * DAY,
+    'search':                     1 * DAY,
+    'search_counts':              1 * HOUR,
+    'name_backbone':             30 * DAY,
+}
+
+
+def _upper_year(value):
+    """ year of the upper bound of a year or eventDate filter ('1990', '1990,2000', '2000-01-01,2000-06-30'), None when open """
+    if isinstance(value, (list, tuple)):
+        years = [_upper_year(item) for item in value]
+        return None if not years or None in years else max(years)
+    upper = str(value).split(',')[-1].strip()
+    if not upper[:4].isdigit():
+        return None
+    return int(upper[:4])
+
+
+def bounded(kwargs):
+    """ true when a search query ends in a past year, by its year or eventDate upper bound """
+    this_year = time.localtime().tm_year
+    for name in ('year', 'eventDate'):
+        if kwargs.get(name) is not None:
+            year = _upper_year(kwargs[name])
+            if year is not None and year < this_year:
+                return True
+    return False
+
+
+def _search(kwargs):
+    if bounded(kwargs):
+        return 'search'
+    if kwargs.get('limit') == 0:
+        return 'search_counts'
+    return None
+
+
+## endpoints whose TTL entry is chosen from their keyword arguments, None for no caching
+CONDITIONS = {
+    'search': _search,
+}
+
+
+def entry(endpoint, kwargs):
+    """ the TTL entry the answer of endpoint to kwargs is cached under, None when it is not cached """
+    if endpoint in CONDITIONS:
+        return CONDITIONS[endpoint](kwargs)
+    return endpoint if endpoint in TTL else None
+
+
+def cacheable(endpoint, kwargs):
+    """ true when the answer of endpoint to kwargs goes through the cache """
+    return entry(endpoint, kwargs) is not None
+
+
+DEFAULT_PATH = os.environ.get('EASY_GBIF_CACHE',
+                              os.path.join(os.path.expanduser('~'), '.cache', 'easy_gbif', 'cache.sqlite'))
+DEFAULT_MAX_MB = 256
+
+
+class Cache(object):
+    """ SQLite response cache. With refresh=True entries are refetched and rewritten, never read """
+
+    def __init__(self, path=DEFAULT_PATH, max_mb=DEFAULT_MAX_MB, refresh=False, namespace=None):
+        self.path = path
+        self.namespace = namespace
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, endpoint TEXT, '
+                        'created REAL, accessed REAL, size INTEGER, value BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.db.commit()
+
+    def key(self, endpoint, args, kwargs):
+        """ endpoint name plus the arguments, ignoring the unset (None) ones """
+        kwargs = dict((k, v) for k, v in kwargs.items() if v is not None)
+        text = json.dumps([self.namespace, endpoint, list(args), kwargs], sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, endpoint, key):
+        """ cached value of key, or None when missing or expired """
+        with self.lock:
+            row = self.db.execute('SELECT created, value FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None or row[0] + TTL[endpoint] < time.time():
+                return None
+            self.db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+        return json.loads(zlib.decompress(bytes(row[1])))
+
+    def put(self, endpoint, key, value):
+        blob = zlib.compress(json.dumps(value).encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, endpoint, now, now, len(blob), sqlite3.Binary(blob)))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        """ drop expired entries, then the least recently used ones until under the size cap """
+        now = time.time()
+        for endpoint, ttl in TTL.items():
+            self.db.execute('DELETE FROM entries WHERE endpoint = ? AND created < ?', (endpoint, now - ttl))
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes * 0.9:
+                break
+
+    def call(self, endpoint, func, *args, **kwargs):
+        """ func(*args, **kwargs) through the cache when endpoint is cacheable """
+        name = entry(endpoint, kwargs)
+        if name is None:
+            return func(*args, **kwargs)
+        key = self.key(endpoint, args, kwargs)
+        if not self.refresh:
+            value = self.get(name, key)
+            if value is not None:
+                with self.lock:
+                    self.hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        value = func(*args, **kwargs)
+        self.put(name, key, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
@@ -0,0 +1,145 @@
+#-*- coding: utf-8 -*-
+
+'''
+Coalescing of download queries.
+
+Queries whose predicates are the same but for the value of one
+"key = value" predicate (e.g. the taxonKey lines of args.txt) are folded
+into a single download job with an "in" predicate on that key, so GBIF
+builds one export instead of one per query. split() then writes the
+records of every original query to its own file.
+'''
+
+import os
+import zipfile
+
+from pygbif.occurrences.download import GbifDownload, key_lkup, operator_lkup
+
+
+## export column holding the value of a predicate key, in the simple csv download format
+COLUMNS = {'country': 'countrycode',
+           'datasetKey': 'datasetkey',
+           'basisOfRecord': 'basisofrecord',
+           'year': 'year',
+           'month': 'month',
+           'institutionCode': 'institutioncode',
+           'collectionCode': 'collectioncode',
+           'catalogNumber': 'catalognumber',
+           'recordNumber': 'recordnumber',
+           'recordedBy': 'recordedby',
+           'typeStatus': 'typestatus',
+           'establishmentMeans': 'establishmentmeans',
+           'mediatype': 'mediatype'}
+
+## taxon ranks with a column of names in the export
+RANKS = ('kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
+
+
+def parse(predicate):
+    """ 'key op value' -> (key, op, value) """
+    key, op, value = predicate.split(' ', 2)
+    return key, op, value
+
+
+def coalesce(queries):
+    """
+    group the queries (lists of 'key op value' predicates) that differ only in
+    the value of one '=' predicate (not a range). Returns a list of groups, largest first:
+    {'queries': shared predicates, 'field': key or None, 'values': [values], 'members': [query indexes]}.
+    A query that can not be grouped gets a group of its own with field None.
+    """
+    parsed = [[parse(predicate) for predicate in query] for query in queries]
+    candidates = {}
+    for i, predicates in enumerate(parsed):
+        keys = [key for key, op, value in predicates]
+        for j, (key, op, value) in enumerate(predicates):
+            if op != '=' or keys.count(key) != 1 or ',' in value:
+                continue
+            rest = tuple(sorted(predicates[:j] + predicates[j + 1:]))
+            candidates.setdefault((key, rest), []).append(i)
+
+    groups = []
+    grouped = set()
+    for (key, rest), members in sorted(candidates.items(), key=lambda item: -len(item[1])):
+        members = [i for i in members if i not in grouped]
+        if len(members) < 2:
+            continue
+        grouped.update(members)
+        values = [dict((k, v) for k, op, v in parsed[i])[key] for i in members]
+        groups.append({'queries': ['%s %s %s' % predicate for predicate in rest],
+                       'field': key, 'values': values, 'members': members})
+    for i, query in enumerate(queries):
+        if i not in grouped:
+            groups.append({'queries': list(query), 'field': None, 'values': [], 'members': [i]})
+    return groups
+
+
+def download(queries, field, values, user, pwd, email, pred_type='and'):
+    """ request one download of queries AND field in values, returning its key """
+    req = GbifDownload(user, email)
+    req.main_pred_type = pred_type
+    for key, op, value in [parse(query) for query in queries]:
+        req.add_predicate(key_lkup.get(key), value, operator_lkup.get(op))
+    req.predicates.append({'type': 'in', 'key': key_lkup.get(field), 'values': values})
+    return req.post_download(user, pwd)
+
+
+def splittable(field):
+    """ true when an export can be split on the values of field """
+    return field == 'taxonKey' or field in COLUMNS
+
+
+def columns(field, values, name_usage=None):
+    """
+    value -> (export column, expected cell) used to split an export on field.
+    taxonKey values are looked up with name_usage (species.name_usage) to match
+    the name column of their rank, or the taxonkey column below species.
+    """
+    match = {}
+    for value in values:
+        if field == 'taxonKey':
+            usage = name_usage(key=int(value)) if name_usage is not None else {}
+            rank = usage.get('rank', '').lower()
+            if rank in RANKS and usage.get('canonicalName'):
+                match[value] = (rank, usage['canonicalName'])
+            else:
+                match[value] = ('taxonkey', value)
+        elif field in COLUMNS:
+            match[value] = (COLUMNS[field], value)
+        else:
+            raise ValueError("can not split a download on %s" % field)
+    return match
+
+
+def split(zip_path, match, outdir, prefix):
+    """
+    write the records of the export in zip_path to one tab separated file per
+    value of match (see columns()), streaming the zip member. Returns value -> file path.
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    archive = zipfile.ZipFile(zip_path)
+    member = [name for name in archive.namelist() if name.endswith('.csv')][0]
+    stream = archive.open(member)
+    header = stream.readline()
+    names = header.rstrip('\r\n').split('\t')
+
+    paths = {}
+    outputs = {}
+    tests = []
+    for value, (column, expected) in match.items():
+        paths[value] = os.path.join(outdir, '%s_%s.csv' % (prefix, value))
+        outputs[value] = open(paths[value], 'w')
+        outputs[value].write(header)
+        tests.append((value, names.index(column), expected))
+
+    for row in stream:
+        fields = row.rstrip('\r\n').split('\t')
+        for value, column, expected in tests:
+            if column < len(fields) and fields[column] == expected:
+                outputs[value].write(row)
+
+    for output in outputs.values():
+        output.close()
+    archive.close()
+    return paths
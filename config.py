@@ -4,3 +4,32 @@ user  = 'jpalma'
 pwd   = 'lNi95cKZ'
 email = 'jorgempalma@tecnico.ulisboa.pt'
 
+
+## defaults of the command line ##
+## kept here, not in the modules they configure, so that building the parser imports none of them
+
+import os
+import multiprocessing
+
+## export columns converted, rows parsed at a time, and processes parsing them (convert.py)
+CONVERT_COLUMNS = ('gbifid', 'datasetkey', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species',
+                   'taxonrank', 'countrycode', 'decimallatitude', 'decimallongitude',
+                   'coordinateuncertaintyinmeters', 'elevation', 'eventdate', 'day', 'month', 'year',
+                   'taxonkey', 'specieskey', 'basisofrecord', 'institutioncode', 'collectioncode',
+                   'license', 'establishmentmeans', 'lastinterpreted', 'issue')
+CONVERT_BATCH_ROWS = 100000
+CONVERT_PROCESSES = multiprocessing.cpu_count()
+
+## largest change set a sync fetches with the paged search (sync.py)
+SYNC_MAX_SEARCH = 50000
+
+## records a search query can page through, offset + limit (partition.py)
+PARTITION_CEILING = 100000
+
+## values a facet returns, at most (cube.py)
+CUBE_FACET_LIMIT = 1000
+
+## local backbone index, and similarity a fuzzy name match needs (names.py)
+BACKBONE_PATH = os.environ.get('EASY_GBIF_BACKBONE',
+                               os.path.join(os.path.expanduser('~'), '.cache', 'easy_gbif', 'backbone.sqlite'))
+FUZZY_CUTOFF = 0.85
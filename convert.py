@@ -0,0 +1,399 @@
+#-*- coding: utf-8 -*-
+
+'''
+Conversion of GBIF simple csv exports into column files.
+
+The tab separated member of the download zip is read as a stream (it is
+never extracted) in batches of lines, and every wanted column is stored
+with a type of its own:
+
+   float    decimallatitude, decimallongitude, elevation, ...   (missing: nan)
+   int      gbifid, taxonkey, specieskey, year, month, day      (missing: -1)
+   date     eventdate, lastinterpreted, as datetime64[D]        (missing: NaT)
+   category any other column, as int32 codes into a list of categories (missing: -1)
+
+The output is a directory with one .npy file per column plus columns.json
+(column types and categories), read back with load() as memory maps so an
+analysis only touches the columns it needs. With pyarrow installed the
+output can be a parquet file instead.
+Rows with a wrong number of fields or a bad number are written to a
+rejects file rather than stopping the conversion.
+
+With processes > 1 an extracted export is cut into newline-aligned byte
+ranges, parsed by a pool of processes into raw column files of their own
+(category codes local to each range), and merged in order; the batches of
+a zip member, which can not be cut, are parsed in the pool and written in
+order by the parent process.
+'''
+
+import os
+import json
+import shutil
+import zipfile
+import tempfile
+import itertools
+import collections
+import multiprocessing
+
+import config
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+FLOATS = ('decimallatitude', 'decimallongitude', 'coordinateuncertaintyinmeters', 'coordinateprecision',
+          'elevation', 'elevationaccuracy', 'depth', 'depthaccuracy')
+INTS = ('gbifid', 'taxonkey', 'specieskey', 'year', 'month', 'day')
+DATES = ('eventdate', 'lastinterpreted')
+
+## columns converted when none are asked for
+DEFAULT_COLUMNS = config.CONVERT_COLUMNS
+
+## stored dtype of each column type
+DTYPES = {'float': 'float64', 'int': 'int64', 'date': 'datetime64[D]', 'category': 'int32'}
+
+BATCH_ROWS = config.CONVERT_BATCH_ROWS
+PROCESSES = config.CONVERT_PROCESSES
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required to convert exports: pip install numpy")
+
+
+def kind(name):
+    """ storage type of a column """
+    if name in FLOATS:
+        return 'float'
+    if name in INTS:
+        return 'int'
+    if name in DATES:
+        return 'date'
+    return 'category'
+
+
+def open_export(path):
+    """ header fields and line iterator of an export, a download zip or an extracted tab separated file """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        members = [info for info in archive.infolist() if info.filename.endswith('.csv')]
+        stream = archive.open(max(members, key=lambda info: info.file_size))
+    else:
+        stream = open(path, 'rb')
+    header = stream.readline().rstrip('\r\n').split('\t')
+    return header, stream
+
+
+def layout(header, columns=None):
+    """ (name, field index, type) of the wanted columns """
+    columns = columns or [name for name in DEFAULT_COLUMNS if name in header]
+    missing = [name for name in columns if name not in header]
+    if missing:
+        raise ValueError("columns not in the export: %s" % ', '.join(missing))
+    return [(name, header.index(name), kind(name)) for name in columns]
+
+
+def _convert(values, type_):
+    """ string array -> typed array, raising ValueError on a bad value """
+    empty = values == ''
+    if type_ == 'float':
+        values = np.where(empty, 'nan', values)
+        return values.astype(np.float64)
+    if type_ == 'int':
+        values = np.where(empty, '-1', values)
+        return values.astype(np.int64)
+    if type_ == 'date':
+        values = np.where(empty, 'NaT', values.astype(values.dtype.kind + '10'))
+        return values.astype('datetime64[D]')
+    return values
+
+
+def parse_batch(lines, columns, nfields):
+    """
+    parse a batch of export lines. Returns (arrays, rejected lines) where arrays
+    maps each column to a typed array, or to a string array for categories.
+    """
+    rows = []
+    rejected = []
+    for line in lines:
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) == nfields:
+            rows.append(fields)
+        elif line.strip():
+            rejected.append(line)
+
+    while True:
+        arrays = {}
+        try:
+            for name, index, type_ in columns:
+                arrays[name] = _convert(np.array([row[index] for row in rows], dtype=str), type_)
+            return arrays, rejected
+        except ValueError:
+            pass
+        ## reject the rows with a bad value in the column that failed, and parse again
+        good = []
+        for row in rows:
+            try:
+                _convert(np.array([row[index]], dtype=str), type_)
+                good.append(row)
+            except ValueError:
+                rejected.append('\t'.join(row) + '\n')
+        rows = good
+
+
+class Categories(object):
+    """ growing category -> code map of one column """
+
+    def __init__(self):
+        self.codes = {}
+        self.names = []
+
+    def encode(self, values):
+        uniques, inverse = np.unique(values, return_inverse=True)
+        lookup = np.empty(len(uniques), dtype=np.int32)
+        for i, value in enumerate(uniques):
+            if value == '':
+                lookup[i] = -1
+                continue
+            if value not in self.codes:
+                self.codes[value] = len(self.names)
+                self.names.append(value)
+            lookup[i] = self.codes[value]
+        return lookup[inverse] if len(values) else np.empty(0, dtype=np.int32)
+
+
+class ColumnWriter(object):
+    """ appends batches of every column to raw files, turned into .npy files by close() """
+
+    def __init__(self, output, columns):
+        _require_numpy()
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        self.output = output
+        self.columns = columns
+        self.categories = dict((name, Categories()) for name, index, type_ in columns if type_ == 'category')
+        self.files = dict((name, open(os.path.join(output, name + '.bin'), 'wb')) for name, index, type_ in columns)
+        self.rows = 0
+
+    def write(self, arrays):
+        for name, index, type_ in self.columns:
+            values = arrays[name]
+            if type_ == 'category':
+                values = self.categories[name].encode(values)
+            values.tofile(self.files[name])
+        self.rows += len(arrays[self.columns[0][0]])
+
+    def flush(self):
+        """ close the raw files """
+        for name, index, type_ in self.columns:
+            self.files[name].close()
+
+    def close(self, meta=None):
+        """ write the .npy files and columns.json """
+        self.flush()
+        _write(self.output, self.columns, [{'path': self.output}], self.rows,
+               dict((name, categories.names) for name, categories in self.categories.items()), meta)
+
+
+def _write(output, columns, chunks, rows, categories, meta=None, remap=None):
+    """
+    write the .npy file of every column from the raw files of chunks, in order,
+    and columns.json. remap gives the code lookup of the category columns of each chunk.
+    """
+    types = {}
+    for name, index, type_ in columns:
+        dtype = np.dtype(DTYPES[type_])
+        with open(os.path.join(output, name + '.npy'), 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                     'fortran_order': False, 'shape': (rows,)})
+            for n, chunk in enumerate(chunks):
+                raw = os.path.join(chunk['path'], name + '.bin')
+                if remap is not None and type_ == 'category' and os.path.getsize(raw):
+                    remap[n][name][np.memmap(raw, dtype=np.int32, mode='r')].tofile(f)
+                elif remap is None or type_ != 'category':
+                    with open(raw, 'rb') as data:
+                        shutil.copyfileobj(data, f, 16 * 1024 * 1024)
+                os.remove(raw)
+        types[name] = type_
+    info = {'rows': rows, 'types': types, 'categories': categories}
+    info.update(meta or {})
+    with open(os.path.join(output, 'columns.json'), 'w') as f:
+        json.dump(info, f, indent=1)
+
+
+class ParquetWriter(object):
+    """ writes the batches to a parquet file, with pyarrow """
+
+    def __init__(self, output, columns):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.columns = columns
+        self.output = output
+        self.writer = None
+        self.rows = 0
+
+    def write(self, arrays):
+        table = self.pa.Table.from_arrays([self.pa.array(arrays[name]) for name, index, type_ in self.columns],
+                                          names=[name for name, index, type_ in self.columns])
+        if self.writer is None:
+            self.writer = self.pa.parquet.ParquetWriter(self.output, table.schema)
+        self.writer.write_table(table)
+        self.rows += table.num_rows
+
+    def close(self, meta=None):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def _ranges(path, start, parts):
+    """ byte offsets cutting path, from start on, into up to parts ranges that begin at the start of a line """
+    size = os.path.getsize(path)
+    offsets = [start]
+    with open(path, 'rb') as f:
+        for n in range(1, parts):
+            f.seek(max(start + (size - start) * n // parts - 1, offsets[-1]))
+            f.readline()
+            if f.tell() > offsets[-1] and f.tell() < size:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+def _parse_range(job):
+    """ parse the lines of path between two byte offsets into raw column files of a chunk directory (worker process) """
+    path, start, end, columns, nfields, chunk, batch_rows = job
+    writer = ColumnWriter(chunk, columns)
+    rejected = 0
+    with open(path, 'rb') as f:
+        with open(os.path.join(chunk, 'rejects.tsv'), 'w') as rejects:
+            f.seek(start)
+            position = start
+            while position < end:
+                lines = []
+                while position < end and len(lines) < batch_rows:
+                    line = f.readline()
+                    if not line:
+                        break
+                    position += len(line)
+                    lines.append(line)
+                if not lines:
+                    break
+                arrays, bad = parse_batch(lines, columns, nfields)
+                writer.write(arrays)
+                rejects.writelines(bad)
+                rejected += len(bad)
+    writer.flush()
+    return {'path': chunk, 'rows': writer.rows, 'rejected': rejected,
+            'categories': dict((name, categories.names) for name, categories in writer.categories.items())}
+
+
+def _parse_job(job):
+    lines, columns, nfields = job
+    return parse_batch(lines, columns, nfields)
+
+
+def _convert_ranges(path, output, columns, header_size, nfields, batch_rows, rejects, processes):
+    """ parse byte ranges of an extracted export in a process pool, then merge them. Returns (rows, rejected) """
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    tmp = tempfile.mkdtemp(prefix='.chunks-', dir=output)
+    try:
+        jobs = []
+        for n, (start, end) in enumerate(_ranges(path, header_size, processes)):
+            chunk = os.path.join(tmp, '%05d' % n)
+            os.makedirs(chunk)
+            jobs.append((path, start, end, columns, nfields, chunk, batch_rows))
+        pool = multiprocessing.Pool(processes)
+        try:
+            chunks = pool.map(_parse_range, jobs)
+        finally:
+            pool.terminate()
+
+        ## the category codes of every chunk -> codes of the merged categories (-1 stays -1)
+        categories = dict((name, Categories()) for name, index, type_ in columns if type_ == 'category')
+        remap = []
+        for chunk in chunks:
+            lookup = {}
+            for name, names in chunk['categories'].items():
+                codes = categories[name].encode(np.array(names, dtype=str)) if names else np.empty(0, dtype=np.int32)
+                lookup[name] = np.append(codes, -1).astype(np.int32)
+            remap.append(lookup)
+        rows = sum(chunk['rows'] for chunk in chunks)
+        _write(output, columns, chunks, rows, dict((name, c.names) for name, c in categories.items()),
+               {'source': os.path.abspath(path)}, remap)
+
+        with open(rejects, 'ab') as reject_file:
+            for chunk in chunks:
+                with open(os.path.join(chunk['path'], 'rejects.tsv'), 'rb') as f:
+                    shutil.copyfileobj(f, reject_file)
+        return rows, sum(chunk['rejected'] for chunk in chunks)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _batches(stream, batch_rows, columns, nfields, processes):
+    """ parse the batches of lines of stream in a process pool, yielding the results in order """
+    pool = multiprocessing.Pool(processes)
+    pending = collections.deque()
+    try:
+        while True:
+            ## keep a bounded number of batches in flight
+            while len(pending) < 2 * processes:
+                lines = list(itertools.islice(stream, batch_rows))
+                if not lines:
+                    break
+                pending.append(pool.apply_async(_parse_job, ((lines, columns, nfields),)))
+            if not pending:
+                break
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def convert(path, output, columns=None, fmt='npy', batch_rows=BATCH_ROWS, rejects=None, processes=1):
+    """
+    convert the export in path (zip or tab separated file) into column files in
+    the output directory (or a parquet file), using up to processes processes.
+    Returns (rows written, rows rejected).
+    """
+    _require_numpy()
+    header, stream = open_export(path)
+    columns = layout(header, columns)
+    rejects = rejects or (output.rstrip('/') + '.rejects.tsv' if fmt == 'parquet' else os.path.join(output, 'rejects.tsv'))
+    if fmt != 'parquet' and not os.path.isdir(output):
+        os.makedirs(output)
+    with open(rejects, 'w') as reject_file:
+        reject_file.write('\t'.join(header) + '\n')
+
+    if processes > 1 and fmt == 'npy' and isinstance(stream, file):
+        header_size = stream.tell()
+        stream.close()
+        return _convert_ranges(path, output, columns, header_size, len(header), batch_rows, rejects, processes)
+
+    writer = ParquetWriter(output, columns) if fmt == 'parquet' else ColumnWriter(output, columns)
+    if processes > 1:
+        batches = _batches(stream, batch_rows, columns, len(header), processes)
+    else:
+        batches = (parse_batch(lines, columns, len(header)) for lines in
+                   iter(lambda: list(itertools.islice(stream, batch_rows)), []))
+    rejected = 0
+    with open(rejects, 'a') as reject_file:
+        for arrays, bad in batches:
+            writer.write(arrays)
+            reject_file.writelines(bad)
+            rejected += len(bad)
+    writer.close({'source': os.path.abspath(path)})
+    return writer.rows, rejected
+
+
+def load(directory, columns=None):
+    """ column name -> array (memory mapped) of a converted export, and its columns.json info """
+    _require_numpy()
+    with open(os.path.join(directory, 'columns.json')) as f:
+        info = json.load(f)
+    names = columns or sorted(info['types'])
+    arrays = dict((name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')) for name in names)
+    return arrays, info
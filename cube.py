@@ -0,0 +1,178 @@
+#-*- coding: utf-8 -*-
+
+'''
+Count cubes of several dimensions from faceted searches.
+
+The facets of a limit=0 occ.search give the record count of every value of
+a field, for the filters of the query, but only one field at a time. The
+cube of several fields (taxonKey x year x country) is drilled down from
+them: the first search facets every dimension; every value of the first
+dimension with records is then a search filtered on it, faceting the
+other dimensions, whose facets give the non-empty pairs of the first two,
+and so on down to the searches filtered on every dimension but the last,
+whose facet is a row of the cube. The dimensions are drilled from the one
+with the fewest values to the one with the most, and only the non-empty
+prefixes are searched, so a cube takes about as many requests as it has
+non-empty rows, instead of one count per cell.
+
+Written as:
+
+   dense    .npz of counts, an array with one axis per dimension, dims and
+            the labels of every axis (labels_<dimension>)
+   sparse   .npz of index (the axis positions of every non-empty cell),
+            counts, shape, dims and labels
+   tsv      one line per non-empty cell: the label of every dimension and the count
+'''
+
+import numpy as np
+
+import config
+import workers
+
+
+## values a facet returns, at most (facetLimit)
+FACET_LIMIT = config.CUBE_FACET_LIMIT
+
+## cells of a dense cube, at most
+MAX_DENSE = 100000000
+
+## search fields a cube can be faceted on
+DIMENSIONS = ['basisOfRecord', 'country', 'publishingCountry', 'continent', 'datasetKey', 'year', 'month',
+              'taxonKey', 'kingdomKey', 'phylumKey', 'classKey', 'orderKey', 'familyKey', 'genusKey',
+              'subgenusKey', 'establishmentMeans', 'issue', 'mediatype', 'typeStatus', 'institutionCode',
+              'collectionCode', 'recordedBy', 'repatriated']
+
+
+def _field(name):
+    """ facet field of an answer (TAXON_KEY) or search field (taxonKey), compared lowercase without underscores """
+    return name.replace('_', '').lower()
+
+
+def _order(label):
+    """ numeric labels in numeric order, before the others """
+    if label.lstrip('-').isdigit():
+        return 0, int(label), label
+    return 1, 0, label
+
+
+def facets(answer):
+    """ {field: [(label, count)]} of the facets of an occ.search answer """
+    found = {}
+    for facet in answer.get('facets') or []:
+        found[_field(facet['field'])] = [(unicode(count['name']), count['count']) for count in facet['counts']]
+    return found
+
+
+class Cube(object):
+    """ drill-down of a count cube. search(query) gives the limit=0 occ.search answer of a query """
+
+    def __init__(self, search, limit=FACET_LIMIT, mincount=None, multiselect=None, nworkers=4):
+        self.search = search
+        self.limit = limit
+        self.mincount = mincount
+        self.multiselect = multiselect
+        self.nworkers = nworkers
+        self.requests = 0
+        self.truncated = set()
+
+    def _facets(self, queries, dims):
+        """ {dimension: [(label, count)]} of every query, faceted on dims, searched concurrently """
+        options = {'facet': list(dims), 'facetLimit': self.limit}
+        if self.mincount is not None:
+            options['facetMincount'] = self.mincount
+        if self.multiselect:
+            options['facetMultiselect'] = True
+        results = []
+        for query, answer, error in workers.imap(lambda query: self.search(dict(query, **options)), queries,
+                                                 workers=self.nworkers):
+            if error is not None:
+                raise error[0], error[1], error[2]
+            found = facets(answer)
+            result = {}
+            for dim in dims:
+                result[dim] = found.get(_field(dim), [])
+                if len(result[dim]) >= self.limit:
+                    self.truncated.add(dim)
+            results.append(result)
+        self.requests += len(queries)
+        return results
+
+    def build(self, dims, filters=None):
+        """
+        (labels, index, counts) of the cube of dims for the filters: labels[d] are the
+        sorted labels of dimension d, and the non-empty cell n is at the axis positions index[n]
+        """
+        for dim in dims:
+            if dim not in DIMENSIONS:
+                raise ValueError("%s is not a facet dimension, choose among %s" % (dim, ', '.join(DIMENSIONS)))
+        if len(set(dims)) != len(dims):
+            raise ValueError("repeated dimension in %s" % ','.join(dims))
+        filters = dict((name, value) for name, value in (filters or {}).items()
+                       if value is not None and value is not False and name not in ('facet', 'facetMincount', 'facetMultiselect'))
+        self.requests = 0
+        self.truncated = set()
+
+        first = self._facets([filters], dims)[0]
+        order = sorted(dims, key=lambda dim: len(first[dim]))
+        level = [((), filters, first)]
+        for depth, dim in enumerate(order[:-1]):
+            children = [(values + (label,), dict(query, **{dim: label}))
+                        for values, query, found in level for label, count in found[dim] if count]
+            results = self._facets([query for values, query in children], order[depth + 1:])
+            level = [(values, query, found) for (values, query), found in zip(children, results)]
+
+        cells = {}
+        for values, query, found in level:
+            for label, count in found[order[-1]]:
+                if count:
+                    cells[values + (label,)] = count
+        ## back to the order of dims
+        positions = [order.index(dim) for dim in dims]
+        keys = [tuple(values[p] for p in positions) for values in cells]
+        labels = [sorted(set(key[d] for key in keys), key=_order) for d in range(len(dims))]
+        lookup = [dict((label, n) for n, label in enumerate(axis)) for axis in labels]
+        index = np.array([[lookup[d][key[d]] for d in range(len(dims))] for key in keys], dtype=np.int64).reshape(-1, len(dims))
+        counts = np.array(cells.values(), dtype=np.int64)
+        sort = np.lexsort(index.T[::-1]) if len(counts) else np.array([], dtype=np.int64)
+        return labels, index[sort], counts[sort]
+
+
+def _labels(axis):
+    """ labels as an int64 array when they are all numbers """
+    if axis and all(_order(label)[0] == 0 for label in axis):
+        return np.array([int(label) for label in axis], dtype=np.int64)
+    return np.array([label.encode('utf-8') for label in axis])
+
+
+def write(output, dims, labels, index, counts, fmt='dense'):
+    """ write a cube as a dense or sparse .npz, or as tab separated cells """
+    if fmt == 'tsv':
+        with open(output, 'w') as f:
+            f.write('\t'.join(dims) + '\tcount\n')
+            for positions, count in zip(index, counts):
+                f.write('\t'.join(labels[d][p].encode('utf-8') for d, p in enumerate(positions)) + '\t%d\n' % count)
+        return
+    shape = np.array([len(axis) for axis in labels], dtype=np.int64)
+    arrays = dict(('labels_%s' % dim, _labels(axis)) for dim, axis in zip(dims, labels))
+    if fmt == 'sparse':
+        np.savez_compressed(output, index=index, counts=counts, shape=shape, dims=np.array(dims), **arrays)
+        return
+    if shape.prod() > MAX_DENSE:
+        raise ValueError("a dense cube of %s cells is too large, write it sparse" % ' x '.join(str(n) for n in shape))
+    dense = np.zeros(shape, dtype=np.int64)
+    if len(counts):
+        dense[tuple(index.T)] = counts
+    np.savez_compressed(output, counts=dense, dims=np.array(dims), **arrays)
+
+
+def read(path):
+    """ (dims, labels, dense counts) of a .npz written by write() """
+    data = np.load(path)
+    dims = [str(dim) for dim in data['dims']]
+    labels = [data['labels_%s' % dim] for dim in dims]
+    if 'index' in data.files:
+        dense = np.zeros(data['shape'], dtype=np.int64)
+        if len(data['counts']):
+            dense[tuple(data['index'].T)] = data['counts']
+        return dims, labels, dense
+    return dims, labels, data['counts']
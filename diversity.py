@@ -0,0 +1,136 @@
+#-*- coding: utf-8 -*-
+
+'''
+Diversity of every cell, computed for all cells at once.
+
+download/run.pl builds a Bio::Community per cell and asks it for its
+richness (and with -vv, for the relative abundance and rank of every
+member), one cell and one member at a time. Here the grouped (cell,
+taxon, count) arrays of grid.py are reduced per cell with segment sums
+(np.add.reduceat), so every index is a handful of array operations over
+all the cells:
+
+   richness     number of taxa
+   shannon      -sum(p log p), natural log
+   simpson      1 - sum(p^2), the Gini-Simpson index
+   chao1        richness + F1 (F1 - 1) / (2 (F2 + 1)), the bias-corrected
+                form, with F1 singletons and F2 doubletons
+   rarefied_n   expected richness of n individuals drawn without replacement
+                (the accumulation curve of Bio::Community::Tools::Accumulator),
+                sum(1 - C(N - Ni, n) / C(N, n)) from a table of log factorials
+
+   python diversity.py -i cells.npz -o diversity.tsv --depths 1,5,10,20,50,100,min
+'''
+
+import sys
+import argparse
+
+import numpy as np
+
+import grid
+
+
+## individuals of the rarefied richness columns
+DEPTHS = [1, 2, 5, 10, 20, 50, 100]
+
+
+def log_factorials(n):
+    """ log(k!) for k in 0..n """
+    table = np.zeros(n + 1)
+    if n > 0:
+        table[1:] = np.cumsum(np.log(np.arange(1, n + 1, dtype=np.float64)))
+    return table
+
+
+def diversity(cells, taxa, counts, depths=DEPTHS, min_members=3):
+    """
+    per-cell indices of grouped (cells, taxa, counts) arrays, for the cells of
+    at least min_members individuals: a dict of arrays cells, members, richness,
+    shannon, simpson, chao1, and rarefied (cells x depths, nan where a cell has
+    fewer individuals than the depth). depths may hold 'min', the smallest cell.
+    """
+    keep = counts > 0
+    cells = cells[keep]
+    counts = counts[keep].astype(np.int64)
+    first = np.concatenate(([True], cells[1:] != cells[:-1])) if len(cells) else np.array([], dtype=bool)
+    starts = np.flatnonzero(first)
+    members = np.add.reduceat(counts, starts) if len(starts) else np.array([], dtype=np.int64)
+
+    ## rows of the accepted cells only
+    accepted = members >= min_members
+    owner = np.cumsum(first) - 1
+    rows = accepted[owner] if len(owner) else np.array([], dtype=bool)
+    cells, counts, first = cells[rows], counts[rows], first[rows]
+    starts = np.flatnonzero(first)
+    members = members[accepted]
+    owner = np.cumsum(first) - 1
+    depths = [int(members.min()) if depth == 'min' and len(members) else depth for depth in depths]
+    ## once min is resolved a depth may be listed twice: keep its first column
+    depths = [depth for n, depth in enumerate(depths) if depth != 'min' and depth not in depths[:n]]
+    result = {'cells': cells[starts], 'members': members, 'depths': np.array(depths, dtype=np.int64)}
+    if not len(starts):
+        for name in ('richness', 'shannon', 'simpson', 'chao1'):
+            result[name] = np.array([])
+        result['rarefied'] = np.zeros((0, len(depths)))
+        return result
+
+    total = members[owner]
+    p = counts / total.astype(np.float64)
+    result['richness'] = np.diff(np.append(starts, len(counts)))
+    result['shannon'] = -np.add.reduceat(p * np.log(p), starts)
+    result['simpson'] = 1 - np.add.reduceat(p * p, starts)
+    singletons = np.add.reduceat((counts == 1).astype(np.int64), starts)
+    doubletons = np.add.reduceat((counts == 2).astype(np.int64), starts)
+    result['chao1'] = result['richness'] + singletons * (singletons - 1) / (2.0 * (doubletons + 1))
+
+    table = log_factorials(int(members.max()))
+    rest = total - counts
+    rarefied = np.empty((len(starts), len(depths)))
+    for j, depth in enumerate(depths):
+        ## probability that taxon i is absent from depth individuals: C(N - Ni, n) / C(N, n)
+        drawn = rest >= depth
+        absent = np.zeros(len(counts))
+        absent[drawn] = np.exp(table[rest[drawn]] + table[total[drawn] - depth]
+                               - table[rest[drawn] - depth] - table[total[drawn]])
+        rarefied[:, j] = np.where(members >= depth, np.add.reduceat(1 - absent, starts), np.nan)
+    result['rarefied'] = rarefied
+    return result
+
+
+def write(output, result, precision=5):
+    """ write the indices to a .npz file, or to a tab separated file with one line per cell """
+    if output.endswith('.npz'):
+        np.savez_compressed(output, precision=precision, **result)
+        return
+    lat, lon = grid.decode(result['cells'], precision)
+    hashes = grid.to_strings(result['cells'], precision)
+    with open(output, 'w') as f:
+        f.write('geohash\tlatitude\tlongitude\tmembers\trichness\tshannon\tsimpson\tchao1'
+                + ''.join('\trarefied_%d' % depth for depth in result['depths']) + '\n')
+        for n in range(len(hashes)):
+            f.write('%s\t%r\t%r\t%d\t%d\t%.6f\t%.6f\t%.4f' % (hashes[n], lat[n], lon[n], result['members'][n],
+                                                             result['richness'][n], result['shannon'][n],
+                                                             result['simpson'][n], result['chao1'][n]))
+            f.write(''.join('\t' if np.isnan(value) else '\t%.4f' % value for value in result['rarefied'][n]) + '\n')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Richness, Shannon, Simpson, Chao1 and rarefied richness of the communities of the cells made by grid.py')
+    parser.add_argument('-i', '--input', dest='input', help='input  – [str] grid.py output (.tsv or .npz)', required=True, action='store')
+    parser.add_argument('-o', '--output', dest='output', help='output  – [str] tab separated file with one line per cell, or .npz file of the arrays', required=True, action='store')
+    parser.add_argument('--depths', dest='depths', help='depths  – [str] comma separated individuals of the rarefied richness columns; min: the smallest cell', default=','.join(str(depth) for depth in DEPTHS), action='store')
+    parser.add_argument('--min_members', dest='min_members', help='min_members  – [int] smallest number of individuals of a cell', type=int, default=3, action='store')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    depths = [depth if depth == 'min' else int(depth) for depth in args.depths.split(',') if depth]
+    cells, taxa, counts, precision = grid.read(args.input)
+    result = diversity(cells, taxa, counts, depths, args.min_members)
+    write(args.output, result, precision)
+    sys.stdout.write("   %d cells, %d depths of the rarefied richness\n" % (len(result['cells']), len(result['depths'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -32,12 +32,57 @@ import os
 import argparse
 import traceback
 import json
+import re
+import shlex
+import threading
+import importlib
+import Queue
 from config import *
-from pygbif import occurrences as occ
-from pygbif import registry
-from pygbif import species
 
 
+class _Lazy(object):
+    """ stands in for a module, imported on first use: a command only loads the modules it runs """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+import workers
+import cache
+transport = _Lazy('transport')
+server = _Lazy('server')
+jobs = _Lazy('jobs')
+coalesce = _Lazy('coalesce')
+transfer = _Lazy('transfer')
+convert = _Lazy('convert')
+store = _Lazy('store')
+sync = _Lazy('sync')
+partition = _Lazy('partition')
+cube = _Lazy('cube')
+names = _Lazy('names')
+metrics = _Lazy('metrics')
+occ = _Lazy('pygbif.occurrences')
+registry = _Lazy('pygbif.registry')
+species = _Lazy('pygbif.species')
+
+GBIF_HOST = 'api.gbif.org'
+
+args = None
+session = None
+responses = None
+recorder = None
+## arguments of the server in server mode: its --gbif_url is the default of the requests
+served = None
+
 def _check_environ(variable, value):
     """check if a variable is present in the environmental variables"""
     if value is not None and value:
@@ -51,20 +96,16 @@ def _check_environ(variable, value):
         else:
             return value
 
-def get_parser():
-
-    """ Get parser object """
-    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description='A program to manage gbif occurence module')
-
-    if len(sys.argv[1:])==0:
-        parser.print_help()
-        # parser.print_usage() # for just the usage line
-        parser.exit()
-
+def _global_arguments(parser):
+    """ options shared by every command """
     parser.add_argument('-v', '--verbose',
                         help="show only parameters",
                         action="store_true")
 
+    parser.add_argument('-vv', '--mverbose',
+                        help="show http connection statistics at exit",
+                        action="store_true")
+
     parser.add_argument('-json', '--json',
                         help="show output in formated json",
                         action="store_true")
@@ -81,8 +122,115 @@ def get_parser():
                         default=300,
                         action='store')
 
+    group_global_arg.add_argument('--workers',
+                        dest='workers',
+                        help='workers  – [int] Number of concurrent requests used to fetch result pages',
+                        required=False,
+                        type=int,
+                        default=1,
+                        action='store')
+
+    group_global_arg.add_argument('--rate',
+                        dest='rate',
+                        help='rate  – [float] Maximum number of requests per second sent to the GBIF host (0 for no limit)',
+                        required=False,
+                        type=float,
+                        default=10,
+                        action='store')
+
+    group_global_arg.add_argument('--gbif_url',
+                        dest='gbif_url',
+                        help='gbif_url  – [str] Base url of the GBIF api, e.g. a local stub of it (env var GBIF_URL). Default: http://api.gbif.org/v1/',
+                        required=False,
+                        default=os.environ.get('GBIF_URL'),
+                        action='store')
+
+    group_global_arg.add_argument('--serve',
+                        dest='serve',
+                        help='serve  – [bool] Keep running and answer commands sent as json lists of arguments, over localhost http (--port) or a unix socket (--socket)',
+                        required=False,
+                        action='store_true')
+
+    group_global_arg.add_argument('--port',
+                        dest='port',
+                        help='port  – [int] Localhost port used with --serve',
+                        required=False,
+                        type=int,
+                        default=8642,
+                        action='store')
+
+    group_global_arg.add_argument('--socket',
+                        dest='socket',
+                        help='socket  – [str] Unix socket path used with --serve instead of --port',
+                        required=False,
+                        action='store')
+
+    group_global_arg.add_argument('--no_cache',
+                        dest='no_cache',
+                        help='no_cache  – [bool] Do not read nor write the local response cache of the count endpoints, of the searches ending in a past year (year or eventDate upper bound) and, for an hour, of the limit=0 searches (cube, partition probes)',
+                        required=False,
+                        action='store_true')
+
+    group_global_arg.add_argument('--refresh',
+                        dest='refresh',
+                        help='refresh  – [bool] Refetch the cacheable responses and overwrite their cache entries',
+                        required=False,
+                        action='store_true')
+
+    group_global_arg.add_argument('--cache_path',
+                        dest='cache_path',
+                        help='cache_path  – [str] SQLite file of the local response cache (env var EASY_GBIF_CACHE)',
+                        required=False,
+                        default=cache.DEFAULT_PATH,
+                        action='store')
+
+    group_global_arg.add_argument('--cache_size',
+                        dest='cache_size',
+                        help='cache_size  – [float] Size cap of the local response cache in MB, least recently used entries are evicted first',
+                        required=False,
+                        type=float,
+                        default=cache.DEFAULT_MAX_MB,
+                        action='store')
+
+    group_global_arg.add_argument('--local',
+                        dest='local',
+                        help='local  – [str] Directory of a local store (see --store_add). The count and search commands are answered from it, offline',
+                        required=False,
+                        action='store')
+
+    group_global_arg.add_argument('--retries',
+                        dest='retries',
+                        help='retries  – [int] Number of times a failed request is retried, with jittered exponential backoff',
+                        required=False,
+                        type=int,
+                        default=3,
+                        action='store')
+
+    group_global_arg.add_argument('--metrics',
+                        dest='metrics',
+                        help='metrics  – [str] File to write the timing (dns, connect, tls, ttfb, transfer), bytes, status, retries and cache hits of every http call to, and print a summary table to stderr at exit',
+                        required=False,
+                        action='store')
+
+    group_global_arg.add_argument('--metrics_format',
+                        dest='metrics_format',
+                        help='metrics_format  – [str] Format of the --metrics file: one json line per call, or the Prometheus text format',
+                        required=False,
+                        choices=['jsonl', 'prometheus'],
+                        default='jsonl',
+                        action='store')
+
+    group_global_arg.add_argument('--pool_size',
+                        dest='pool_size',
+                        help='pool_size  – [int] Number of keep-alive connections kept open per host (raised to --workers if lower)',
+                        required=False,
+                        type=int,
+                        default=10,
+                        action='store')
 
-    ### SEARCH #############################################
+
+### SEARCH #############################################
+def _search_actions(parser):
     group_search = parser.add_argument_group('group search')
     group_search.add_argument('-s', '--search',
                         dest='search',
@@ -90,6 +238,7 @@ def get_parser():
                         required=False,
                         action='store_true')
 
+def _search_arguments(parser):
     group_search_arg = parser.add_argument_group('group search arguments')
     group_search_arg.add_argument('--offset',
                         dest='offset',
@@ -98,6 +247,39 @@ def get_parser():
                         type=int,
                         action='store')
 
+    group_search_arg.add_argument('--all',
+                        dest='all',
+                        help='all  – [bool] Walk every result page from --offset on and stream the records as newline-delimited json',
+                        required=False,
+                        action='store_true')
+
+    group_search_arg.add_argument('--max_records',
+                        dest='max_records',
+                        help='max_records  – [int] Walk result pages until this many records were streamed (implies --all)',
+                        required=False,
+                        type=int,
+                        action='store')
+
+    group_search_arg.add_argument('--partition',
+                        dest='partition',
+                        help='partition  – [bool] Split the query by year range, coordinate quadrants (plus the records without coordinates) and, where nothing else splits, month into partitions under the paging ceiling, from limit=0 count probes, and stream the records of every partition, fetched concurrently, once per gbifid',
+                        required=False,
+                        action='store_true')
+
+    group_search_arg.add_argument('--partition_ceiling',
+                        dest='partition_ceiling',
+                        help='partition_ceiling  – [int] Deepest offset + limit the search api pages to',
+                        required=False,
+                        type=int,
+                        default=PARTITION_CEILING,
+                        action='store')
+
+    group_search_arg.add_argument('--partition_plan',
+                        dest='partition_plan',
+                        help='partition_plan  – [str] Json file to write the partitions and their counts to',
+                        required=False,
+                        action='store')
+
     group_search_arg.add_argument('--q',
                         dest='q',
                         help='q  – [str] Simple search parameter. The value for this parameter can be a simple word or a phrase.',
@@ -362,28 +544,28 @@ def get_parser():
                         action='store_true')
 
 
-
-    ### GET #########################################
+### GET #########################################
+def _get_actions(parser):
     group_get = parser.add_argument_group('group get')
     group_get.add_argument('-g', '--get',
                             dest='get',
-                            help='Gets details for a single, interpreted occurrence. Must specify --gKey',
+                            help='Gets details for a single, interpreted occurrence. Must specify --gKey or --gKeys',
                             required=False,
                             action='store_true')
 
     group_get.add_argument('-gv', '--get_verbatim',
                             dest='get_verbatim',
-                            help='Gets a verbatim occurrence record without any interpretation. Must specify --gKey',
+                            help='Gets a verbatim occurrence record without any interpretation. Must specify --gKey or --gKeys',
                             required=False,
                             action='store_true')
 
     group_get.add_argument('-gf', '--get_fragment',
                             dest='get_fragment',
-                            help='Get a single occurrence fragment in its raw form (xml or json). Must specify --gKey',
+                            help='Get a single occurrence fragment in its raw form (xml or json). Must specify --gKey or --gKeys',
                             required=False,
                             action='store_true')
 
-
+def _get_arguments(parser):
     group_get_arg = parser.add_argument_group('group get arguments')
     group_get_arg.add_argument('--gKey',
                         dest='gKey',
@@ -392,9 +574,29 @@ def get_parser():
                         type=int,
                         action='store')
 
+    group_get_arg.add_argument('--gKeys',
+                        dest='gKeys',
+                        help='gKeys  – [str] File with one GBIF occurrence key per line (the first column of a tsv), or - for stdin. Keys are deduplicated, fetched with --workers concurrent requests and printed as newline-delimited json',
+                        required=False,
+                        action='store')
+
+    group_get_arg.add_argument('--gOrder',
+                        dest='gOrder',
+                        help='gOrder  – [str] Print the --gKeys records in input order or in completion order',
+                        choices=['input', 'completion'],
+                        required=False,
+                        default='input',
+                        action='store')
+
+    group_get_arg.add_argument('--gFailed',
+                        dest='gFailed',
+                        help='gFailed  – [str] File to list the --gKeys keys that could not be fetched, with the error. Default: stderr',
+                        required=False,
+                        action='store')
 
 
-    ### COUNT ##########################################################
+### COUNT ##########################################################
+def _count_actions(parser):
     group_count = parser.add_argument_group('group count')
     group_count.add_argument('-c', '--count',
                         dest='count',
@@ -438,6 +640,7 @@ def get_parser():
                         required=False,
                         action='store_true')
 
+def _count_arguments(parser):
     group_count_arg = parser.add_argument_group('group count arguments')
 
     group_count_arg.add_argument('--cKey',
@@ -506,12 +709,45 @@ def get_parser():
                         type=int,
                         action='store')
 
+### CUBE ###################################################################
+def _cube_actions(parser):
+    group_cube = parser.add_argument_group('group cube')
+    group_cube.add_argument('-cu', '--cube',
+                        dest='cube',
+                        help='Build a count table of several dimensions (--sFacet taxonKey,year,country) from parallel limit=0 faceted searches, filtered by the search arguments and kept an hour in the response cache. Must specify --sFacet and --cube_output',
+                        required=False,
+                        action='store_true')
+
+def _cube_arguments(parser):
+    group_cube_arg = parser.add_argument_group('group cube arguments')
+    group_cube_arg.add_argument('--cube_output',
+                        dest='cube_output',
+                        help='cube_output  – [str] .npz file of the counts and the labels of every dimension, or tab separated file with --cube_format tsv',
+                        required=False,
+                        action='store')
+
+    group_cube_arg.add_argument('--cube_format',
+                        dest='cube_format',
+                        help='cube_format  – [str] dense array of one axis per dimension, sparse index and counts of the non-empty cells, or tsv lines of the non-empty cells',
+                        choices=['dense', 'sparse', 'tsv'],
+                        required=False,
+                        default='dense',
+                        action='store')
 
-    ### DOWNLOAD ###############################################################
+    group_cube_arg.add_argument('--cube_limit',
+                        dest='cube_limit',
+                        help='cube_limit  – [int] Values of a dimension a facet returns, at most (facetLimit)',
+                        required=False,
+                        type=int,
+                        default=CUBE_FACET_LIMIT,
+                        action='store')
+
+### DOWNLOAD ###############################################################
+def _download_actions(parser):
     group_download = parser.add_argument_group('group download')
     group_download.add_argument('-d', '--download',
                         dest='download',
-                        help='Spin up a download request for GBIF occurrence data. Must specify --queries and --query_type',
+                        help='Spin up a download request for GBIF occurrence data. Must specify --queries and --query_type [--wait --path], or --batch',
                         required=False,
                         action='store_true')
 
@@ -529,10 +765,11 @@ def get_parser():
 
     group_download.add_argument('-dg', '--download_get',
                         dest='download_get',
-                        help='Get a download from GBIF. Must specify --dKey [--path]',
+                        help='Get a download from GBIF. Must specify --dKey [--path] [--wait]',
                         required=False,
                         action='store_true')
 
+def _download_arguments(parser):
     group_download_arg = parser.add_argument_group('group download arguments')
     group_download_arg.add_argument('--dKey',
                         dest='dKey',
@@ -560,8 +797,284 @@ def get_parser():
                         required=False,
                         action='store')
 
+    group_download_arg.add_argument('--wait',
+                        dest='wait',
+                        help='wait  – [bool] With --download or --download_get, poll the download until it succeeds and get its zip into --path. The jobs are saved in --jobs_file, so an interrupted wait resumes without resubmitting the query',
+                        required=False,
+                        action='store_true')
+
+    group_download_arg.add_argument('--batch',
+                        dest='batch',
+                        help='batch  – [str] With --download, file with one query per line (quoted predicates, like args.txt). Every query is submitted within --max_running, polled and fetched into --path, and a manifest is written',
+                        required=False,
+                        action='store')
+
+    group_download_arg.add_argument('--max_running',
+                        dest='max_running',
+                        help='max_running  – [int] Most downloads of a --batch being prepared by GBIF at the same time',
+                        required=False,
+                        type=int,
+                        default=3,
+                        action='store')
+
+    group_download_arg.add_argument('--coalesce',
+                        dest='coalesce',
+                        help='coalesce  – [bool] With --batch, fold the queries that differ only in the value of one "key = value" predicate into a single download with an "in" predicate',
+                        required=False,
+                        action='store_true')
+
+    group_download_arg.add_argument('--split',
+                        dest='split',
+                        help='split  – [bool] With --coalesce, split every coalesced download back into one tab separated file per original query, in --path',
+                        required=False,
+                        action='store_true')
+
+    group_download_arg.add_argument('--manifest',
+                        dest='manifest',
+                        help='manifest  – [str] Json file mapping every --batch query line to its download key, status, size and local path. Default: <path>/manifest.json',
+                        required=False,
+                        action='store')
+
+    group_download_arg.add_argument('--jobs_file',
+                        dest='jobs_file',
+                        help='jobs_file  – [str] Json file keeping the state of the download jobs used with --wait. Default: <path>/.easy_gbif_jobs.json',
+                        required=False,
+                        action='store')
+
+    group_download_arg.add_argument('--poll',
+                        dest='poll',
+                        help='poll  – [float] Seconds before the first status check of a download, the interval then grows exponentially',
+                        required=False,
+                        type=float,
+                        default=10,
+                        action='store')
+
+    group_download_arg.add_argument('--max_poll',
+                        dest='max_poll',
+                        help='max_poll  – [float] Longest interval in seconds between two status checks of a download',
+                        required=False,
+                        type=float,
+                        default=300,
+                        action='store')
+
+
+### CONVERT ###############################################################
+def _convert_actions(parser):
+    group_convert = parser.add_argument_group('group convert')
+    group_convert.add_argument('-cv', '--convert',
+                        dest='convert',
+                        help='Convert a downloaded export (zip or extracted tab separated file) into typed column files, without extracting it. Must specify --input or --dKey [--path]',
+                        required=False,
+                        action='store_true')
+
+def _convert_arguments(parser):
+    group_convert_arg = parser.add_argument_group('group convert arguments')
+    group_convert_arg.add_argument('--input',
+                        dest='input',
+                        help='input  – [str] Export to convert. Default: <path>/<dKey>.zip',
+                        required=False,
+                        action='store')
 
-    return parser.parse_args()
+    group_convert_arg.add_argument('--output',
+                        dest='output',
+                        help='output  – [str] Directory of .npy column files, or parquet file. Default: the input path without .zip, plus _columns or .parquet',
+                        required=False,
+                        action='store')
+
+    group_convert_arg.add_argument('--format',
+                        dest='format',
+                        help='format  – [str] npy column files (numpy), or a parquet file (pyarrow)',
+                        choices=['npy', 'parquet'],
+                        required=False,
+                        default='npy',
+                        action='store')
+
+    group_convert_arg.add_argument('--columns',
+                        dest='columns',
+                        help='columns  – [str] Comma separated export columns to convert. Default: ' + ','.join(CONVERT_COLUMNS),
+                        required=False,
+                        action='store')
+
+    group_convert_arg.add_argument('--batch_rows',
+                        dest='batch_rows',
+                        help='batch_rows  – [int] Number of rows parsed at a time',
+                        required=False,
+                        type=int,
+                        default=CONVERT_BATCH_ROWS,
+                        action='store')
+
+    group_convert_arg.add_argument('--processes',
+                        dest='processes',
+                        help='processes  – [int] Number of processes parsing the export (also for --store_add). An extracted export is cut into byte ranges, a zip is parsed batch by batch',
+                        required=False,
+                        type=int,
+                        default=CONVERT_PROCESSES,
+                        action='store')
+
+
+### STORE #################################################################
+def _store_actions(parser):
+    group_store = parser.add_argument_group('group store')
+    group_store.add_argument('-sa', '--store_add',
+                        dest='store_add',
+                        help='Add a downloaded export to the local store, indexed on taxonkey, year, countrycode, datasetkey, basisofrecord and issue. Must specify --local and --input or --dKey [--path]',
+                        required=False,
+                        action='store_true')
+
+    group_store.add_argument('-sy', '--sync',
+                        dest='sync',
+                        help='Fetch the records of a search query reinterpreted since its last sync (its high-water mark) and upsert them, by gbifid, into the local store. Must specify --local and the search arguments of the query',
+                        required=False,
+                        action='store_true')
+
+    group_store.add_argument('-si', '--store_info',
+                        dest='store_info',
+                        help='Show the exports, rows and date range covered by the local store. Must specify --local',
+                        required=False,
+                        action='store_true')
+
+def _store_arguments(parser):
+    group_store_arg = parser.add_argument_group('group store arguments')
+    group_store_arg.add_argument('--sync_since',
+                        dest='sync_since',
+                        help='sync_since  – [str] lastInterpreted date (yyyy-mm-dd) to sync from, instead of the high-water mark of the query',
+                        required=False,
+                        action='store')
+
+    group_store_arg.add_argument('--sync_max_search',
+                        dest='sync_max_search',
+                        help='sync_max_search  – [int] Largest change set fetched with the paged search; larger ones are fetched with a delta download (uses --path)',
+                        required=False,
+                        type=int,
+                        default=SYNC_MAX_SEARCH,
+                        action='store')
+
+
+### NAMES #################################################################
+def _names_actions(parser):
+    group_names = parser.add_argument_group('group names')
+    group_names.add_argument('-rn', '--resolve_names',
+                        dest='resolve_names',
+                        help='Resolve scientific names to GBIF backbone taxon keys in one pass, from the local backbone index (exact, normalized and fuzzy keys), with species.name_backbone for the names it misses. Must specify --names',
+                        required=False,
+                        action='store_true')
+
+    group_names.add_argument('-nb', '--names_build',
+                        dest='names_build',
+                        help='Build the local backbone index from a backbone dump. Must specify --backbone_dump',
+                        required=False,
+                        action='store_true')
+
+def _names_arguments(parser):
+    group_names_arg = parser.add_argument_group('group names arguments')
+    group_names_arg.add_argument('--names',
+                        dest='names',
+                        help='names  – [str] File with one scientific name per line (the first column of a tsv), or - for stdin. The matches are printed as newline-delimited json, in input order',
+                        required=False,
+                        action='store')
+
+    group_names_arg.add_argument('--backbone',
+                        dest='backbone',
+                        help='backbone  – [str] SQLite file of the local backbone index (env var EASY_GBIF_BACKBONE)',
+                        required=False,
+                        default=BACKBONE_PATH,
+                        action='store')
+
+    group_names_arg.add_argument('--backbone_dump',
+                        dest='backbone_dump',
+                        help='backbone_dump  – [str] GBIF backbone dump to index: backbone.zip, or its extracted Taxon.tsv',
+                        required=False,
+                        action='store')
+
+    group_names_arg.add_argument('--nKingdom',
+                        dest='nKingdom',
+                        help='nKingdom  – [str] Kingdom the names belong to, to choose between homonyms',
+                        required=False,
+                        action='store')
+
+    group_names_arg.add_argument('--fuzzy_cutoff',
+                        dest='fuzzy_cutoff',
+                        help='fuzzy_cutoff  – [float] Similarity (0 to 1) a fuzzy match of the index needs',
+                        required=False,
+                        type=float,
+                        default=FUZZY_CUTOFF,
+                        action='store')
+
+    group_names_arg.add_argument('--no_fallback',
+                        dest='no_fallback',
+                        help='no_fallback  – [bool] Do not ask species.name_backbone for the names the index misses',
+                        required=False,
+                        action='store_true')
+
+
+
+## argument groups, in help order: (name, action flags, arguments)
+GROUPS = [('search', _search_actions, _search_arguments),
+          ('get', _get_actions, _get_arguments),
+          ('count', _count_actions, _count_arguments),
+          ('cube', _cube_actions, _cube_arguments),
+          ('download', _download_actions, _download_arguments),
+          ('convert', _convert_actions, _convert_arguments),
+          ('store', _store_actions, _store_arguments),
+          ('names', _names_actions, _names_arguments)]
+
+## subcommands (easy_gbif.py <command> [arguments]) and the argument groups they read
+COMMANDS = {
+    'search':                  ['search'],
+    'get':                     ['get'],
+    'get_verbatim':            ['get'],
+    'get_fragment':            ['get'],
+    'count':                   ['count'],
+    'count_basisofrecord':     ['count'],
+    'count_year':              ['count'],
+    'count_datasets':          ['count'],
+    'count_country':           ['count'],
+    'count_schema':            ['count'],
+    'count_publishingCountry': ['count'],
+    'cube':                    ['cube', 'search'],
+    'download':                ['download'],
+    'download_meta':           ['download'],
+    'download_list':           ['download'],
+    'download_get':            ['download'],
+    'convert':                 ['convert', 'download'],
+    'store_add':               ['store', 'convert', 'download'],
+    'store_info':              ['store'],
+    'sync':                    ['store', 'search', 'download'],
+    'resolve_names':           ['names'],
+    'names_build':             ['names'],
+}
+
+## commands answered without the GBIF api, and those answered from the store with --local
+OFFLINE = ['convert', 'store_add', 'store_info', 'names_build']
+LOCAL = ['search', 'count', 'count_basisofrecord', 'count_year', 'count_datasets', 'count_country',
+         'count_publishingCountry']
+
+
+def get_parser(command=None):
+    """ parser of a subcommand, with its argument groups only, or of the whole command line """
+    if command is None:
+        parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description='A program to manage gbif occurence module',
+                                         epilog='Subcommands, parsing only the arguments they use: easy_gbif.py {%s} --help' % ','.join(sorted(COMMANDS)))
+        _global_arguments(parser)
+        for name, actions, arguments in GROUPS:
+            actions(parser)
+            arguments(parser)
+        return parser
+
+    parser = argparse.ArgumentParser(prog='easy_gbif.py %s' % command, formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='A program to manage gbif occurence module: %s' % command)
+    _global_arguments(parser)
+    ## the arguments of the groups left out read as None, a misspelt one still raises AttributeError
+    unbuilt = argparse.ArgumentParser(add_help=False)
+    for name, actions, arguments in GROUPS:
+        actions(unbuilt)
+        if name in COMMANDS[command]:
+            arguments(parser)
+        else:
+            arguments(unbuilt)
+    parser.set_defaults(**dict((action.dest, None) for action in unbuilt._actions))
+    parser.set_defaults(**{command: True})
+    return parser
 
 def handle_error():
     formatted_lines = traceback.format_exc().splitlines()
@@ -576,34 +1089,385 @@ def print_out(dic):
     else:
         print json.dumps(dic)
 
-
-if __name__ == '__main__':
-
-    user  = _check_environ('GBIF_USER', user)
-    pwd   = _check_environ('GBIF_PWD', pwd)
-    email = _check_environ('GBIF_EMAIL', email)
-
-    args = get_parser()
-
-    if args.verbose is True:
-        print args
-        print
-        for arg in vars(args):
-            if getattr(args, arg) is not None and getattr(args, arg) is not False:
-                print arg, getattr(args, arg)
-        print
-
-        sys.exit(1)
+def print_records(records):
+    """ print records as newline-delimited json, one record per line """
+    for record in records:
+        print json.dumps(record)
+    sys.stdout.flush()
+
+def _search_filters(args):
+    """ map the search arguments to occ.search keywords. Flags not given are left out, not sent as false """
+    return dict(taxonKey=args.sTaxonKey, repatriated=args.sRepatriated, kingdomKey=args.sKingdomKey,
+                phylumKey=args.sPhylumKey, classKey=args.sClassKey, orderKey=args.sOrderKey,
+                familyKey=args.sFamilyKey, genusKey=args.sGenusKey, subgenusKey=args.sSubgenusKey,
+                scientificName=args.sScientificName, country=args.sCountry,
+                publishingCountry=args.sPublishingCountry, hasCoordinate=args.sHasCoordinate or None,
+                typeStatus=args.sTypeStatus, recordNumber=args.sRecordNumber,
+                lastInterpreted=args.sLastInterpreted, continent=args.sContinent,
+                geometry=args.sGeometry, recordedBy=args.sRecordedBy, basisOfRecord=args.sBasisOfRecord,
+                datasetKey=args.sDatasetKey, eventDate=args.sEventDate, catalogNumber=args.sCatalogNumber,
+                year=args.sYear, month=args.sMonth, decimalLatitude=args.sDecimalLatitude,
+                decimalLongitude=args.sDecimalLongitude, elevation=args.sElevation, depth=args.sDepth,
+                institutionCode=args.sInstitutionCode, collectionCode=args.sCollectionCode,
+                hasGeospatialIssue=args.sHasGeospatialIssue or None, issue=args.sIssue, q=args.q,
+                spellCheck=args.sSpellCheck or None, mediatype=args.sMediatype,
+                establishmentMeans=args.sEstablishmentMeans, facet=args.sFacet,
+                facetMincount=args.sFacetMincount, facetMultiselect=args.sFacetMultiselect or None)
+
+def _offline():
+    """ true when the command needs neither pygbif nor the http session """
+    if any(getattr(args, name) is True for name in OFFLINE):
+        return True
+    if args.resolve_names is True and args.no_fallback is True:
+        return True
+    return args.local is not None and any(getattr(args, name) is True for name in LOCAL)
+
+def _connect():
+    """ import pygbif, set up the keep-alive session and response cache, and attach the metrics of the command """
+    global session, responses
+    pool_size = max(args.pool_size, args.workers)
+    if session is not None and not session.serves(pool_size, args.gbif_url):
+        ## a server request for another api, or for more connections than the session pools
+        session.close()
+        session = None
+    if session is None:
+        ## install() reroutes the pygbif modules already imported
+        for module in (occ, registry, species):
+            module._load()
+        session = transport.install(pool_size=pool_size, base_url=args.gbif_url)
+    if args.no_cache is False and (responses is None or responses.path != args.cache_path
+                                   or responses.namespace != session.base_url):
+        responses = cache.Cache(args.cache_path, max_mb=args.cache_size, namespace=session.base_url)
+    if responses is not None:
+        responses.refresh = args.refresh
+    session.metrics = recorder
+
+def _print_stats(session):
+    """ print http connection and cache statistics to stderr """
+    sys.stderr.write(" http requests: %(requests)d  connections opened: %(connections_opened)d  reused: %(connections_reused)d\n"
+                     % session.stats())
+    if responses is not None:
+        sys.stderr.write(" cache hits: %(hits)d  misses: %(misses)d  entries: %(entries)d  size: %(bytes)d bytes\n"
+                         % responses.stats())
+
+def _client_error(e):
+    """ true for http 4xx errors, which are not worth retrying (429 and 420, too many downloads, excepted) """
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if status is None:
+        ## occ.download raises a bare Exception naming the status code
+        match = re.search(r'with error status code (\d+)', str(e))
+        status = int(match.group(1)) if match else None
+    return status is not None and 400 <= status < 500 and status not in (420, 429)
+
+def _call(func, *fargs, **kwargs):
+    """ call a GBIF api function through the response cache, with retries, rate limited per host """
+    fetched = []
+    def fetch(*fargs, **kwargs):
+        fetched.append(True)
+        on_retry = None if recorder is None else lambda e: recorder.retried(func.__name__, e)
+        return workers.retry(lambda: func(*fargs, **kwargs), retries=args.retries,
+                             limiter=workers.limiter(GBIF_HOST, args.rate), fatal=_client_error, on_retry=on_retry)
+    with metrics.scope(recorder, func.__name__):
+        if responses is None or args.no_cache is True:
+            return fetch(*fargs, **kwargs)
+        result = responses.call(func.__name__, fetch, *fargs, **kwargs)
+    if recorder is not None and cache.cacheable(func.__name__, kwargs):
+        recorder.cached(func.__name__, hit=not fetched)
+    return result
+
+def _lines(path):
+    """ lines of a file, closed once read or once the reader stops. '-' reads stdin """
+    if path == '-':
+        for line in sys.stdin:
+            yield line
+        return
+    with open(path) as f:
+        for line in f:
+            yield line
+
+def _read_keys(path):
+    """ unique occurrence keys from the first column of a file, in input order. '-' reads stdin """
+    seen = set()
+    for line in _lines(path):
+        field = line.split('\t')[0].strip()
+        if not field.isdigit():
+            continue
+        key = int(field)
+        if key not in seen:
+            seen.add(key)
+            yield key
+
+def _read_names(path):
+    """ unique scientific names from the first column of a file, in input order. '-' reads stdin """
+    seen = set()
+    for line in _lines(path):
+        name = line.split('\t')[0].strip()
+        if name and not name.startswith('#') and name not in seen:
+            seen.add(name)
+            yield name
+
+def _resolve_names(names_list):
+    """
+    match names with the local backbone index, then the misses with species.name_backbone
+    (concurrent, through the response cache), printing the matches as newline-delimited json
+    """
+    found = {}
+    if os.path.exists(args.backbone) or args.no_fallback is True:
+        found = names.Index(args.backbone, cutoff=args.fuzzy_cutoff).resolve(names_list, kingdom=args.nKingdom)
+    missed = [name for name in names_list if name not in found]
+    if missed and args.no_fallback is not True:
+        backbone = lambda name: _call(species.name_backbone, name=name, kingdom=args.nKingdom)
+        for name, match, error in workers.imap(backbone, missed, workers=args.workers, ordered=False):
+            if error is None:
+                found[name] = names.from_backbone(name, match)
+            else:
+                sys.stderr.write(" %s: %s\n" % (name, str(error[1]).replace('\n', ' ')))
+    for name in names_list:
+        print json.dumps(found.get(name) or names.from_backbone(name, None))
+    sys.stdout.flush()
+
+def _get_batch(func, keys):
+    """
+    fetch keys concurrently, streaming the records as newline-delimited json and
+    listing the failed keys. Returns the number of failed keys
+    """
+    failed = []
+    fetch = lambda key: _call(func, key=key)
+    for key, result, error in workers.imap(fetch, keys, workers=args.workers, ordered=args.gOrder == 'input'):
+        if error is None:
+            print json.dumps(result)
+        else:
+            failed.append((key, error[1]))
+    sys.stdout.flush()
+
+    if failed:
+        out = open(args.gFailed, 'w') if args.gFailed is not None else sys.stderr
+        for key, e in failed:
+            out.write("%d\t%s\n" % (key, str(e).replace('\n', ' ')))
+        if out is not sys.stderr:
+            out.close()
+    return len(failed)
+
+def _submit_download(query):
+    """ request the download of a job query, returning its key """
+    if query.get('in') is not None:
+        return coalesce.download(query['queries'], query['in']['field'], query['in']['values'],
+                                 user=user, pwd=pwd, email=email, pred_type=query['pred_type'])
+    return occ.download(query['queries'], pred_type=query['pred_type'], user=user, pwd=pwd, email=email)[0]
+
+def _download_batch():
+    """
+    queue, submit, poll and fetch every query of the --batch file, returning the manifest.
+    With --coalesce the queries differing in a single value share one job, which --split
+    breaks back into one file per query once downloaded.
+    """
+    manager = _job_manager()
+    lines = list(_read_batch(args.batch))
+    if args.coalesce is True:
+        groups = coalesce.coalesce([queries for n, line, queries in lines])
+    else:
+        groups = [{'queries': queries, 'field': None, 'values': [], 'members': [i]}
+                  for i, (n, line, queries) in enumerate(lines)]
+    for group in groups:
+        ## checked before anything is submitted: the group is then downloaded, and listed, unsplit
+        group['split'] = args.split is True and group['field'] is not None
+        if group['split'] and not coalesce.splittable(group['field']):
+            sys.stderr.write(" can not split a download on %s, lines %s keep the whole export\n"
+                             % (group['field'], ','.join(str(lines[i][0]) for i in group['members'])))
+            group['split'] = False
+        query = {'queries': group['queries'], 'pred_type': args.q_type}
+        if group['field'] is not None:
+            query['in'] = {'field': group['field'], 'values': group['values']}
+        group['job'] = manager.queue(query)
+    manager.wait([group['job'] for group in groups])
+
+    manifest = []
+    for group in groups:
+        job = group['job']
+        paths = {}
+        if group['split'] and job['state'] == 'done':
+            try:
+                match = coalesce.columns(group['field'], group['values'],
+                                         name_usage=lambda key: _call(species.name_usage, key=key))
+                paths = coalesce.split(job['path'], match, args.path or '.', job['key'])
+            except Exception as e:
+                ## the manifest is written all the same, pointing at the whole export
+                sys.stderr.write(" download %s not split on %s: %s\n" % (job['key'], group['field'], e))
+                group['split'] = False
+        for i, value in zip(group['members'], group['values'] or [None]):
+            n, line, queries = lines[i]
+            manifest.append(dict(line=n, query=queries, key=job['key'], status=job['status'], state=job['state'],
+                                 size=job['size'], path=paths.get(value, job['path']), error=job['error'],
+                                 coalesced=group['field'] is not None, split=bool(paths)))
+    return sorted(manifest, key=lambda entry: entry['line'])
+
+def _download_get(key):
+    """ resumable, verified download of the zip of key into --path """
+    meta = _call(occ.download_meta, key=key)
+    return transfer.download_get(key, meta, path=args.path or '.', session=session, retries=args.retries)
+
+def _job_manager():
+    """ the download job manager, its state kept next to the downloaded zips """
+    path = args.path or '.'
+    return jobs.JobManager(args.jobs_file or os.path.join(path, '.easy_gbif_jobs.json'),
+                           meta=lambda key: _call(occ.download_meta, key=key),
+                           fetch=_download_get,
+                           submit=_submit_download,
+                           max_running=args.max_running, first_poll=args.poll, max_poll=args.max_poll,
+                           fatal=_client_error)
+
+def _sync_download(filters, mark):
+    """ download the records of the search filters interpreted since mark, returning the zip path """
+    queries = ['%s = %s' % (name, value) for name, value in sorted(filters.items())]
+    queries.append('lastInterpreted >= %s' % mark)
+    manager = _job_manager()
+    job = manager.queue({'queries': queries, 'pred_type': 'and'})
+    manager.wait([job])
+    if job['state'] != 'done':
+        raise Exception('delta download %s: %s' % (job['key'], job['error']))
+    return job['path']
+
+_predicate = re.compile(r'^\w+ (=|<|<=|>|>=|!|in|within|like) .+$')
+
+def _read_batch(path):
+    """
+    the download queries of a batch file, one query per line given as quoted
+    'key operator value' predicates, like args.txt. Yields (line number, line, predicates).
+    Lines holding anything else than predicates are skipped.
+    """
+    for n, line in enumerate(open(path), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            queries = shlex.split(line)
+        except ValueError:
+            queries = []
+        if not queries or not all(_predicate.match(query) for query in queries):
+            sys.stderr.write(" %s:%d is not a query, skipped: %s\n" % (path, n, line))
+            continue
+        yield n, line, queries
+
+def _search_pages(filters, limit=300, offset=None, max_records=None, nworkers=1):
+    """
+    walk the search result pages from offset on, yielding one page at a time.
+    With one worker page N+1 is fetched in a background thread while page N
+    is consumed. With more, the first page gives the record count and the
+    remaining pages are fetched concurrently and yielded in order.
+    """
+    start = offset or 0
+
+    def size_at(page_offset):
+        if max_records is None:
+            return limit
+        return min(limit, start + max_records - page_offset)
+
+    def fetch(page_offset):
+        return _call(occ.search, limit=size_at(page_offset), offset=page_offset, **filters)
+
+    if nworkers > 1:
+        page = fetch(start)
+        yield page
+        if page['endOfRecords'] or len(page['results']) == 0:
+            return
+        end = page['count']
+        if max_records is not None:
+            end = min(end, start + max_records)
+        for page_offset, page, error in workers.imap(fetch, xrange(start + limit, end, limit), workers=nworkers):
+            if error is not None:
+                raise error[0], error[1], error[2]
+            yield page
+        return
+
+    pages = Queue.Queue(maxsize=1)
+    done = threading.Event()
+
+    def put(item):
+        while not done.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def walk():
+        page_offset = start
+        try:
+            while size_at(page_offset) > 0:
+                page = fetch(page_offset)
+                if not put(page):
+                    return
+                page_offset += limit
+                if page['endOfRecords'] or len(page['results']) == 0:
+                    break
+        except:
+            put(sys.exc_info())
+            return
+        put(None)
+
+    worker = threading.Thread(target=walk)
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is None:
+                return
+            if isinstance(page, tuple):
+                raise page[0], page[1], page[2]
+            yield page
+    finally:
+        done.set()
+
+def _search_partitions(filters):
+    """ plan the partitions of a search past the paging ceiling, then stream their records """
+    planner = partition.Planner(lambda query: _call(occ.search, limit=0, **query)['count'],
+                                ceiling=args.partition_ceiling, nworkers=args.workers)
+    plan = planner.plan(filters)
+    if args.partition_plan is not None:
+        with open(args.partition_plan, 'w') as f:
+            json.dump(plan, f, indent=2, sort_keys=True)
+    sys.stderr.write(" %d records in %d partitions, %d count probes\n"
+                     % (plan['count'], len(plan['partitions']), plan['probes']))
+    if plan['uncovered']:
+        sys.stderr.write(" %d records have no year or month and are in no partition\n" % plan['uncovered'])
+    for truncated in plan['truncated']:
+        sys.stderr.write(" partition of %d records truncated to %d: %s\n"
+                         % (truncated['count'], args.partition_ceiling, json.dumps(truncated['query'], sort_keys=True)))
+    search = lambda query, offset, limit: _call(occ.search, limit=limit, offset=offset, **query)
+    for records in partition.fetch(plan, search, limit=min(args.limit, 300), ceiling=args.partition_ceiling,
+                                   nworkers=args.workers):
+        print_records(records)
+
+def run():
+    """ run the command selected by the parsed arguments """
 
     ###########################################################################################
     ### download ##############################################################################
     if args.download is True:
         try:
-            if args.queries is not None:
+            if args.batch is not None:
+                manifest = _download_batch()
+                with open(args.manifest or os.path.join(args.path or '.', 'manifest.json'), 'w') as f:
+                    json.dump(manifest, f, indent=2)
+                print_out(manifest)
+            elif args.queries is not None and args.wait is True:
+                manager = _job_manager()
+                query = {'queries': args.queries[0], 'pred_type': args.q_type}
+                job = manager.find(query)
+                if job is None:
+                    result = occ.download(args.queries[0], pred_type=args.q_type, user=user, pwd=pwd, email=email)
+                    print_out(result)
+                    job = manager.add(result[0], query)
+                else:
+                    print " resuming download %s" % job['key']
+                print_out(manager.wait([job]))
+            elif args.queries is not None:
                 result = occ.download(args.queries[0], pred_type=args.q_type)
                 print_out(result)
             else:
-                print " queries arguments are required"
+                print " queries or batch arguments are required"
         except:
             handle_error()
         finally:
@@ -632,8 +1496,12 @@ if __name__ == '__main__':
 
     if args.download_get is True:
         try:
-            if args.dKey is not None:
-                result = occ.download_get(key=args.dKey, path=args.path)
+            if args.dKey is not None and args.wait is True:
+                manager = _job_manager()
+                job = manager.add(args.dKey)
+                print_out(manager.wait([job]))
+            elif args.dKey is not None:
+                result = _download_get(args.dKey)
                 print_out(result)
             else:
                 print " --dKey argument is required [--path]"
@@ -643,6 +1511,94 @@ if __name__ == '__main__':
            sys.exit(0)
 
 
+    ### CONVERT #############################################################################
+    if args.convert is True:
+        try:
+            if args.input is not None or args.dKey is not None:
+                path = args.input or os.path.join(args.path or '.', '%s.zip' % args.dKey)
+                output = args.output or re.sub(r'\.zip$', '', path) + ('.parquet' if args.format == 'parquet' else '_columns')
+                columns = args.columns.split(',') if args.columns is not None else None
+                rows, rejected = convert.convert(path, output, columns=columns, fmt=args.format,
+                                                 batch_rows=args.batch_rows, processes=args.processes)
+                print_out({'input': path, 'output': output, 'rows': rows, 'rejected': rejected})
+            else:
+                print " --input or --dKey argument is required"
+        except:
+            handle_error()
+        finally:
+           sys.exit(0)
+
+
+    ### STORE ###############################################################################
+    if args.store_add is True:
+        try:
+            if args.local is not None and (args.input is not None or args.dKey is not None):
+                path = args.input or os.path.join(args.path or '.', '%s.zip' % args.dKey)
+                print_out(store.Store(args.local).add(path, source=args.dKey, processes=args.processes))
+            else:
+                print " --local and --input or --dKey arguments are required"
+        except:
+            handle_error()
+        finally:
+           sys.exit(0)
+
+    if args.sync is True:
+        try:
+            if args.local is not None:
+                filters = dict((name, value) for name, value in _search_filters(args).items()
+                               if value is not None and value is not False)
+                if responses is not None:
+                    ## the change set must come from the api, not from the cache
+                    responses.refresh = True
+                result = sync.Sync(store.Store(args.local)).sync(
+                    filters, search=lambda delta: _search_pages(delta, limit=300, nworkers=args.workers),
+                    download=_sync_download, since=args.sync_since, max_search=args.sync_max_search)
+                print_out(result)
+            else:
+                print " --local argument is required"
+        except:
+            handle_error()
+        finally:
+           sys.exit(0)
+
+    if args.store_info is True:
+        try:
+            if args.local is not None:
+                print_out(store.Store(args.local).info())
+            else:
+                print " --local argument is required"
+        except:
+            handle_error()
+        finally:
+           sys.exit(0)
+
+
+    ### NAMES #############################################################################
+    if args.names_build is True:
+        try:
+            if args.backbone_dump is not None:
+                log = lambda count: sys.stderr.write(" %d taxa\r" % count)
+                count = names.build(args.backbone_dump, args.backbone, log=log)
+                print_out({'backbone': args.backbone, 'taxa': count})
+            else:
+                print " --backbone_dump argument is required"
+        except:
+            handle_error()
+        finally:
+           sys.exit(0)
+
+    if args.resolve_names is True:
+        try:
+            if args.names is not None:
+                _resolve_names(list(_read_names(args.names)))
+            else:
+                print " --names argument is required"
+        except:
+            handle_error()
+        finally:
+           sys.exit(0)
+
+
     ### SEARCH ##############################################################################
     if args.search is True:
         try:
@@ -650,7 +1606,7 @@ if __name__ == '__main__':
                args.sPhylumKey is not None or args.sClassKey is not None or args.sOrderKey is not None or \
                args.sFamilyKey is not None or args.sGenusKey is not None or args.sSubgenusKey is not None or \
                args.sScientificName is not None or args.sCountry is not None or args.sPublishingCountry is not None or \
-               args.sHhasCoordinate is True or args.sTypeStatus is not None or args.sRecordNumber is not None or \
+               args.sHasCoordinate is True or args.sTypeStatus is not None or args.sRecordNumber is not None or \
                args.sLastInterpreted is not None or args.sContinent is not None or args.sGeometry is not None or \
                args.sRecordedBy is not None or args.sBasisOfRecord is not None or args.sYear is not None or \
                args.sMonth is not None or args.sDecimalLatitude is not None or args.sDecimalLongitude is not None or \
@@ -660,24 +1616,24 @@ if __name__ == '__main__':
                args.sEstablishmentMeans is not None or args.sFacet is not None or \
                args.sFacetMincount is not None or args.sFacetMultiselect is True:
 
-                result = occ.search(taxonKey=args.sTaxonKey, repatriated=args.sRepatriated, kingdomKey=args.sKingdomKey,
-                                    phylumKey=args.sPhylumKey, classKey=args.sClassKey, orderKey=args.sOrderKey,
-                                    familyKey=args.sFamilyKey, genusKey=args.sGenusKey, subgenusKey=args.sSubgenusKey,
-                                    scientificName=args.sScientificName, country=args.sCountry,
-                                    publishingCountry=args.sPublishingCountry, hasCoordinate=args.sHasCoordinate,
-                                    typeStatus=args.sTypeStatus, recordNumber=args.sRecordNumber,
-                                    lastInterpreted=args.sLastInterpreted, continent=args.sContinent,
-                                    geometry=args.sGeometry, recordedBy=args.sRecordedBy, basisOfRecord=args.sBasisOfRecord,
-                                    datasetKey=args.sDatasetKey, eventDate=args.sEventDate, catalogNumber=args.sCatalogNumber,
-                                    year=args.sYear, month=args.sMonth, decimalLatitude=args.sDecimalLatitude,
-                                    decimalLongitude=args.sDecimalLongitude, elevation=args.sElevation, depth=args.sDepth,
-                                    institutionCode=args.sInstitutionCode, collectionCode=args.sCollectionCode,
-                                    hasGeospatialIssue=args.sHasGeospatialIssue, issue=args.sIssue, q=args.q,
-                                    spellCheck=args.sSpellCheck, mediatype=args.sMediatype,
-                                    establishmentMeans=args.sEstablishmentMeans, facet=args.sFacet,
-                                    facetMincount=args.sFacetMincount, facetMultiselect=args.sFacetMultiselect,
-                                    limit=args.limit, offset=args.offset)
-                print_out(result)
+                if args.local is not None:
+                    local = store.Store(args.local)
+                    if args.all is True or args.max_records is not None:
+                        for records in local.walk(offset=args.offset, max_records=args.max_records,
+                                                  **_search_filters(args)):
+                            print_records(records)
+                    else:
+                        print_out(local.search(limit=args.limit, offset=args.offset, **_search_filters(args)))
+                elif args.partition is True:
+                    _search_partitions(_search_filters(args))
+                elif args.all is True or args.max_records is not None:
+                    for page in _search_pages(_search_filters(args), limit=min(args.limit, 300),
+                                              offset=args.offset, max_records=args.max_records,
+                                              nworkers=args.workers):
+                        print_records(page['results'])
+                else:
+                    result = _call(occ.search, limit=args.limit, offset=args.offset, **_search_filters(args))
+                    print_out(result)
             else:
                 print " More arguments are required"
         except:
@@ -687,42 +1643,76 @@ if __name__ == '__main__':
 
 
 
+    ### CUBE ##############################################################################
+    if args.cube is True:
+        try:
+            if args.sFacet is not None and args.cube_output is not None:
+                dims = [dim.strip() for dim in args.sFacet.split(',') if dim.strip()]
+                builder = cube.Cube(lambda query: _call(occ.search, limit=0, **query), limit=args.cube_limit,
+                                    mincount=args.sFacetMincount, multiselect=args.sFacetMultiselect,
+                                    nworkers=args.workers)
+                labels, index, counts = builder.build(dims, _search_filters(args))
+                cube.write(args.cube_output, dims, labels, index, counts, fmt=args.cube_format)
+                for dim in sorted(builder.truncated):
+                    sys.stderr.write(" %s has more values than --cube_limit %d, the others are not in the cube\n"
+                                     % (dim, args.cube_limit))
+                print_out({'output': args.cube_output, 'dims': dims, 'shape': [len(axis) for axis in labels],
+                           'cells': len(counts), 'records': int(counts.sum()), 'requests': builder.requests})
+            else:
+                print " --sFacet and --cube_output arguments are required"
+        except:
+            handle_error()
+        finally:
+           sys.exit(0)
+
+
+
     ### GET ##############################################################################
     if args.get is True:
+        failed = 0
         try:
-            if args.gKey is not None:
-                result = occ.get(key=args.gKey)
+            if args.gKeys is not None:
+                failed = _get_batch(occ.get, _read_keys(args.gKeys))
+            elif args.gKey is not None:
+                result = _call(occ.get, key=args.gKey)
                 print_out(result)
             else:
-                print " --gKey argument is required"
+                print " --gKey or --gKeys argument is required"
         except:
             handle_error()
         finally:
-           sys.exit(0)
+           ## a key that failed makes the exit status 1
+           sys.exit(1 if failed else 0)
 
     if args.get_verbatim is True:
+        failed = 0
         try:
-            if args.gKey is not None:
-                result = occ.get_verbatim(key=args.gKey)
+            if args.gKeys is not None:
+                failed = _get_batch(occ.get_verbatim, _read_keys(args.gKeys))
+            elif args.gKey is not None:
+                result = _call(occ.get_verbatim, key=args.gKey)
                 print_out(result)
             else:
-                print " --gKey argument is required"
+                print " --gKey or --gKeys argument is required"
         except:
             handle_error()
         finally:
-           sys.exit(0)
+           sys.exit(1 if failed else 0)
 
     if args.get_fragment is True:
+        failed = 0
         try:
-            if args.gKey is not None:
-                result = occ.get_fragment(key=args.gKey)
+            if args.gKeys is not None:
+                failed = _get_batch(occ.get_fragment, _read_keys(args.gKeys))
+            elif args.gKey is not None:
+                result = _call(occ.get_fragment, key=args.gKey)
                 print_out(result)
             else:
-                print " --gKey argument is required"
+                print " --gKey or --gKeys argument is required"
         except:
             handle_error()
         finally:
-           sys.exit(0)
+           sys.exit(1 if failed else 0)
 
 
     ### COUNT ##############################################################################
@@ -733,10 +1723,14 @@ if __name__ == '__main__':
                args.cPublishingCountry is not None or args.cTypeStatus is not None or \
                args.cIssue is not None or args.cYear is not None :
 
-                result = occ.get_fragment(taxonKey=args.cTaxonKey, basisOfRecord=args.cBasisOfRecord,
-                                          country=args.cCountry, cIsGeoreferenced=args.cIsGeoreferenced,
-                                          datasetKey=args.cDatasetKey, publishingCountry=args.cPublishingCountry,
-                                          typeStatus=args.cTypeStatus, issue=args.cIssue, year=args.cYear)
+                filters = dict(taxonKey=args.cTaxonKey, basisOfRecord=args.cBasisOfRecord,
+                               country=args.cCountry, isGeoreferenced=args.cIsGeoreferenced,
+                               datasetKey=args.cDatasetKey, publishingCountry=args.cPublishingCountry,
+                               typeStatus=args.cTypeStatus, issue=args.cIssue, year=args.cYear)
+                if args.local is not None:
+                    result = store.Store(args.local).count(**filters)
+                else:
+                    result = _call(occ.count, **filters)
                 print_out(result)
             else:
                 print " More arguments are required"
@@ -747,7 +1741,10 @@ if __name__ == '__main__':
 
     if args.count_basisofrecord is True:
         try:
-            result = occ.count_basisofrecord()
+            if args.local is not None:
+                result = store.Store(args.local).count_by('basisofrecord')
+            else:
+                result = _call(occ.count_basisofrecord)
             print_out(result)
         except:
             handle_error()
@@ -757,7 +1754,10 @@ if __name__ == '__main__':
     if args.count_year is True:
         try:
             if args.cYear is not None:
-                result = occ.count_year(year=args.cYear)
+                if args.local is not None:
+                    result = store.Store(args.local).count_by('year', year=args.cYear)
+                else:
+                    result = _call(occ.count_year, year=args.cYear)
                 print_out(result)
             else:
                 print " --cYear argument is required"
@@ -769,7 +1769,10 @@ if __name__ == '__main__':
     if args.count_datasets is True:
         try:
             if args.cCountry is not None or args.cTaxonKey is not None:
-                result = occ.count_datasets(taxonKey=args.cTaxonKey, country=args.cCountry)
+                if args.local is not None:
+                    result = store.Store(args.local).count_by('datasetkey', taxonKey=args.cTaxonKey, country=args.cCountry)
+                else:
+                    result = _call(occ.count_datasets, taxonKey=args.cTaxonKey, country=args.cCountry)
                 print_out(result)
             else:
                 print " --cTaxonKey and/or --cCountry argument is required"
@@ -781,7 +1784,10 @@ if __name__ == '__main__':
     if args.count_country is True:
         try:
             if args.cPublishingCountry is not None:
-                result = occ.count_countries(publishingCountry=args.cPublishingCountry)
+                if args.local is not None:
+                    result = store.Store(args.local).count_by('countrycode', publishingCountry=args.cPublishingCountry)
+                else:
+                    result = _call(occ.count_countries, publishingCountry=args.cPublishingCountry)
                 print_out(result)
             else:
                 print " --cPublishingCountry argument is required"
@@ -792,7 +1798,7 @@ if __name__ == '__main__':
 
     if args.count_schema is True:
         try:
-            result = occ.count_schema()
+            result = _call(occ.count_schema)
             print_out(result)
         except:
             handle_error()
@@ -802,7 +1808,10 @@ if __name__ == '__main__':
     if args.count_publishingCountry is True:
         try:
             if args.cCountry is not None:
-                result = occ.publishingCountry(country=args.cCountry)
+                if args.local is not None:
+                    result = store.Store(args.local).count_by('publishingcountry', country=args.cCountry)
+                else:
+                    result = _call(occ.count_publishingcountries, country=args.cCountry)
                 print_out(result)
             else:
                 print " --cCountry argument is required"
@@ -810,3 +1819,59 @@ if __name__ == '__main__':
             handle_error()
         finally:
            sys.exit(0)
+
+
+def main(argv=None):
+    """ parse argv and run the command. The session and cache are kept between calls """
+    global args, session, responses, recorder, served
+
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0].replace('-', '_') if argv and argv[0].replace('-', '_') in COMMANDS else None
+    parser = get_parser(command)
+    if served is not None:
+        parser.set_defaults(gbif_url=served.gbif_url)
+    if len(argv)==0:
+        parser.print_help()
+        # parser.print_usage() # for just the usage line
+        parser.exit()
+    args = parser.parse_args(argv[1:] if command is not None else argv)
+
+    if args.verbose is True:
+        print args
+        print
+        for arg in vars(args):
+            if getattr(args, arg) is not None and getattr(args, arg) is not False:
+                print arg, getattr(args, arg)
+        print
+
+        sys.exit(1)
+
+    if args.serve is True and served is not None:
+        parser.error('--serve is not a command of a running server')
+
+    recorder = metrics.Metrics(args.metrics, args.metrics_format) if args.metrics else None
+    if args.serve is True or session is not None or not _offline():
+        _connect()
+
+    if args.serve is True:
+        served = args
+        server.serve(main, port=args.port, socket_path=args.socket)
+        sys.exit(0)
+
+    try:
+        run()
+    finally:
+        if args.mverbose is True and session is not None:
+            _print_stats(session)
+        if recorder is not None:
+            recorder.close()
+            sys.stderr.write(recorder.summary())
+
+
+if __name__ == '__main__':
+
+    user  = _check_environ('GBIF_USER', user)
+    pwd   = _check_environ('GBIF_PWD', pwd)
+    email = _check_environ('GBIF_EMAIL', email)
+
+    main()
@@ -0,0 +1,250 @@
+#-*- coding: utf-8 -*-
+
+'''
+Geohash gridding of occurrences and per-cell species counts.
+
+The bulk replacement of the Geo::Hash loop of download/run.pl: the
+coordinates are encoded to geohash cells a whole column at a time, by
+quantizing latitude and longitude and interleaving their bits, and the
+records are grouped by (cell, taxon) with a sort instead of nested hashes.
+
+Cells are kept as integer codes, which sort in the same order as their
+geohash strings; to_strings() gives the strings back.
+
+   python grid.py -i 0001-1.zip -o cells.tsv -p 5 --bbox 36.8,-9.7,42.1,-6.2 -iy 2000 -ey 2015
+
+The input is a download zip, an extracted export or a directory made by
+easy_gbif.py --convert. The output is a tab separated file of
+geohash, cell centre, taxon and count, or a .npz file of the arrays.
+'''
+
+import os
+import sys
+import argparse
+import itertools
+
+import numpy as np
+
+import convert
+
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+MAX_PRECISION = 12
+
+## (cell, taxon) groups are merged after this many records of a streamed export
+BATCH_ROWS = 1000000
+
+
+def _bits(precision):
+    """ number of (longitude, latitude) bits of a geohash of precision characters """
+    if not 1 <= precision <= MAX_PRECISION:
+        raise ValueError("geohash precision must be between 1 and %d" % MAX_PRECISION)
+    bits = 5 * precision
+    return (bits + 1) // 2, bits // 2
+
+
+def _quantize(values, low, high, bits):
+    """ index of the 2**bits equal intervals of [low, high] holding each value """
+    index = np.floor((np.asarray(values, dtype=np.float64) - low) / (high - low) * (1 << bits))
+    return np.clip(index, 0, (1 << bits) - 1).astype(np.uint64)
+
+
+def interleave(lon_index, lat_index, precision=5):
+    """ geohash cell codes of longitude and latitude interval indexes (see _quantize) """
+    lon_bits, lat_bits = _bits(precision)
+    ## bits alternate from the most significant one: longitude, latitude, longitude, ...
+    codes = np.zeros(np.shape(lon_index), dtype=np.uint64)
+    one = np.uint64(1)
+    for i in range(lon_bits):
+        shift = np.uint64(2 * i + 1 - (lon_bits + lat_bits) % 2)
+        codes |= ((lon_index >> np.uint64(i)) & one) << shift
+    for i in range(lat_bits):
+        shift = np.uint64(2 * i + (lon_bits + lat_bits) % 2)
+        codes |= ((lat_index >> np.uint64(i)) & one) << shift
+    return codes
+
+
+def encode(lat, lon, precision=5):
+    """ geohash cell codes (uint64) of arrays of coordinates """
+    lon_bits, lat_bits = _bits(precision)
+    return interleave(_quantize(lon, -180.0, 180.0, lon_bits), _quantize(lat, -90.0, 90.0, lat_bits), precision)
+
+
+def decode(codes, precision=5):
+    """ (latitude, longitude) of the centre of geohash cell codes """
+    lon_bits, lat_bits = _bits(precision)
+    codes = np.asarray(codes, dtype=np.uint64)
+    lon_index = np.zeros(codes.shape, dtype=np.uint64)
+    lat_index = np.zeros(codes.shape, dtype=np.uint64)
+    one = np.uint64(1)
+    for i in range(lon_bits):
+        shift = np.uint64(2 * i + 1 - (lon_bits + lat_bits) % 2)
+        lon_index |= ((codes >> shift) & one) << np.uint64(i)
+    for i in range(lat_bits):
+        shift = np.uint64(2 * i + (lon_bits + lat_bits) % 2)
+        lat_index |= ((codes >> shift) & one) << np.uint64(i)
+    lat = -90.0 + (lat_index + 0.5) * (180.0 / (1 << lat_bits))
+    lon = -180.0 + (lon_index + 0.5) * (360.0 / (1 << lon_bits))
+    return lat, lon
+
+
+def to_strings(codes, precision=5):
+    """ geohash strings of cell codes """
+    codes = np.asarray(codes, dtype=np.uint64)
+    alphabet = np.array(list(BASE32))
+    chars = [alphabet[((codes >> np.uint64(5 * (precision - 1 - i))) & np.uint64(31)).astype(np.intp)]
+             for i in range(precision)]
+    if not len(codes):
+        return np.array([], dtype='S%d' % precision)
+    return np.array([''.join(cell) for cell in zip(*chars)])
+
+
+def from_strings(hashes):
+    """ cell codes of geohash strings (all of the same precision) """
+    lookup = dict((c, i) for i, c in enumerate(BASE32))
+    codes = np.zeros(len(hashes), dtype=np.uint64)
+    for n, cell in enumerate(hashes):
+        code = 0
+        for c in cell:
+            code = code * 32 + lookup[c]
+        codes[n] = code
+    return codes
+
+
+def select(lat, lon, taxon, year=None, bbox=None, iniyear=None, endyear=None):
+    """ mask of the records with coordinates and a taxon, inside bbox (sw_lat, sw_lon, ne_lat, ne_lon) and the year window """
+    mask = ~(np.isnan(lat) | np.isnan(lon)) & (taxon >= 0)
+    if bbox is not None:
+        sw_lat, sw_lon, ne_lat, ne_lon = bbox
+        mask &= (lat >= sw_lat) & (lat <= ne_lat) & (lon >= sw_lon) & (lon <= ne_lon)
+    if year is not None and iniyear is not None:
+        mask &= year >= iniyear
+    if year is not None and endyear is not None:
+        mask &= (year <= endyear) & (year >= 0)
+    return mask
+
+
+def group(cells, taxa, counts=None):
+    """
+    sum the counts (default 1 per record) of every (cell, taxon) pair.
+    Returns (cells, taxa, counts), sorted by cell then taxon.
+    """
+    if counts is None:
+        counts = np.ones(len(cells), dtype=np.int64)
+    if not len(cells):
+        return cells, taxa, counts.astype(np.int64)
+    order = np.lexsort((taxa, cells))
+    cells = cells[order]
+    taxa = taxa[order]
+    counts = counts[order]
+    starts = np.flatnonzero(np.concatenate(([True], (cells[1:] != cells[:-1]) | (taxa[1:] != taxa[:-1]))))
+    return cells[starts], taxa[starts], np.add.reduceat(counts, starts).astype(np.int64)
+
+
+def aggregate(lat, lon, taxon, year=None, precision=5, bbox=None, iniyear=None, endyear=None):
+    """ (cells, taxa, counts) of coordinate, taxon and year arrays """
+    mask = select(lat, lon, taxon, year, bbox, iniyear, endyear)
+    cells = encode(lat[mask], lon[mask], precision)
+    return group(cells, np.asarray(taxon)[mask])
+
+
+def _read(path, taxon, batch_rows):
+    """ yields (lat, lon, taxon, year) arrays of a converted directory, or of an export in batches """
+    names = ['decimallatitude', 'decimallongitude', taxon, 'year']
+    if os.path.isdir(path):
+        arrays, info = convert.load(path, names)
+        yield tuple(arrays[name] for name in names)
+        return
+    header, stream = convert.open_export(path)
+    columns = convert.layout(header, names)
+    while True:
+        lines = list(itertools.islice(stream, batch_rows))
+        if not lines:
+            break
+        arrays, rejected = convert.parse_batch(lines, columns, len(header))
+        if rejected:
+            sys.stderr.write(" %d rows rejected\n" % len(rejected))
+        yield tuple(arrays[name] for name in names)
+
+
+def grid(path, precision=5, bbox=None, iniyear=None, endyear=None, taxon='taxonkey', batch_rows=BATCH_ROWS):
+    """ (cells, taxa, counts) of the records of an export or converted directory """
+    parts = []
+    for lat, lon, taxa, year in _read(path, taxon, batch_rows):
+        parts.append(aggregate(lat, lon, taxa, year, precision, bbox, iniyear, endyear))
+        if len(parts) > 1:
+            ## keep one merged part, so memory follows the number of groups, not of records
+            parts = [group(*[np.concatenate(arrays) for arrays in zip(*parts)])]
+    if not parts:
+        return np.array([], dtype=np.uint64), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return parts[0]
+
+
+def write(output, cells, taxa, counts, precision=5):
+    """ write the groups to a .npz file, or to a tab separated file """
+    if output.endswith('.npz'):
+        np.savez_compressed(output, cells=cells, taxa=taxa, counts=counts, precision=precision)
+        return
+    lat, lon = decode(cells, precision)
+    hashes = to_strings(cells, precision)
+    with open(output, 'w') as f:
+        f.write('geohash\tlatitude\tlongitude\ttaxonkey\tcount\n')
+        for row in zip(hashes, lat, lon, taxa, counts):
+            f.write('%s\t%r\t%r\t%d\t%d\n' % row)
+
+
+def read(path):
+    """ (cells, taxa, counts, precision) of a file written by write() """
+    if path.endswith('.npz'):
+        data = np.load(path)
+        return data['cells'], data['taxa'], data['counts'], int(data['precision'])
+    hashes, taxa, counts = [], [], []
+    with open(path) as f:
+        f.readline()
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t')
+            hashes.append(fields[0])
+            taxa.append(int(fields[3]))
+            counts.append(int(fields[4]))
+    precision = len(hashes[0]) if hashes else 5
+    return from_strings(hashes), np.array(taxa, dtype=np.int64), np.array(counts, dtype=np.int64), precision
+
+
+def communities(cells, taxa, counts):
+    """ yields (cell, taxa, counts) of every cell of grouped arrays """
+    if not len(cells):
+        return
+    starts = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))
+    ends = np.append(starts[1:], len(cells))
+    for start, end in zip(starts, ends):
+        yield cells[start], taxa[start:end], counts[start:end]
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Geohash gridding of GBIF occurrences, with the count of every taxon per cell')
+    parser.add_argument('-v', '--verbose', dest='verbose', help='verbose mode', action='store_true')
+    parser.add_argument('-i', '--input', dest='input', help='input  – [str] download zip, extracted export or directory made by easy_gbif.py --convert', required=True, action='store')
+    parser.add_argument('-o', '--output', dest='output', help='output  – [str] tab separated file, or .npz file', required=True, action='store')
+    parser.add_argument('-p', '--precision', dest='precision', help='precision  – [int] geohash length (5: cells of about 4.9km)', type=int, default=5, action='store')
+    parser.add_argument('--bbox', dest='bbox', help='bbox  – [str] grid bounds as sw_lat,sw_lon,ne_lat,ne_lon. Default: whole world', required=False, action='store')
+    parser.add_argument('-iy', '--iniyear', dest='iniyear', help='iniyear  – [int] start year', type=int, required=False, action='store')
+    parser.add_argument('-ey', '--endyear', dest='endyear', help='endyear  – [int] end year', type=int, required=False, action='store')
+    parser.add_argument('--taxon', dest='taxon', help='taxon  – [str] taxon column of the export', default='taxonkey', action='store')
+    parser.add_argument('--batch_rows', dest='batch_rows', help='batch_rows  – [int] Number of export rows parsed at a time', type=int, default=BATCH_ROWS, action='store')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    bbox = [float(value) for value in args.bbox.split(',')] if args.bbox else None
+    if bbox is not None and len(bbox) != 4:
+        raise ValueError("--bbox takes sw_lat,sw_lon,ne_lat,ne_lon")
+    sys.stdout.write("== Gridding %s\n" % args.input)
+    cells, taxa, counts = grid(args.input, args.precision, bbox, args.iniyear, args.endyear, args.taxon, args.batch_rows)
+    write(args.output, cells, taxa, counts, args.precision)
+    sys.stdout.write("   %d records, %d cells, %d taxa, %d (cell, taxon) groups\n"
+                     % (counts.sum(), len(np.unique(cells)), len(np.unique(taxa)), len(cells)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#-*- coding: utf-8 -*-
+
+'''
+Sample incidence of per-cell communities, kept sparse.
+
+download/run.pl turns every cell of more than 2 individuals into a
+species x sample 0/1 matrix: the individuals of the cell are drawn one by
+one in random order, and sample j holds the individual of draw j. Each
+sample has a single 1, so the whole matrix is the taxon of every draw.
+Here a cell is a random permutation of its individuals, written as:
+
+   npz          cells, indptr and taxa arrays: sample j of cell i is taxa[indptr[i] + j]
+                (a CSR matrix of cells x samples with implicit ones)
+   triplets     tab separated geohash, sample, taxonkey lines
+   sample_sets  the *MultipleSampleSets* text of run.pl, streamed one matrix row at a time
+
+Draws are seeded per cell as in rarefy.py.
+
+   python incidence.py -i cells.npz -o incidence.npz --seed 1
+   python incidence.py -i cells.npz -o communities.txt --format sample_sets --title "PT"
+'''
+
+import sys
+import argparse
+
+import numpy as np
+
+import grid
+import rarefy
+
+
+def draw(counts, state):
+    """ index (into counts) of the species of every sample, in draw order """
+    return state.permutation(np.repeat(np.arange(len(counts)), counts))
+
+
+def incidence(cells, taxa, counts, seed=0, min_members=3):
+    """ yields (cell, taxa, counts, taxon of every sample) of the cells of at least min_members individuals """
+    for cell, cell_taxa, cell_counts in grid.communities(cells, taxa, counts):
+        if cell_counts.sum() >= min_members:
+            yield cell, cell_taxa, cell_counts, cell_taxa[draw(cell_counts, rarefy.random_state(seed, cell))]
+
+
+def write_npz(path, results, precision=5, seed=0):
+    out_cells, indptr, out_taxa = [], [0], []
+    for cell, cell_taxa, cell_counts, samples in results:
+        out_cells.append(cell)
+        out_taxa.append(samples)
+        indptr.append(indptr[-1] + len(samples))
+    np.savez_compressed(path, cells=np.array(out_cells, dtype=np.uint64), indptr=np.array(indptr, dtype=np.int64),
+                        taxa=np.concatenate(out_taxa) if out_taxa else np.array([], dtype=np.int64),
+                        precision=precision, seed=seed)
+    return len(out_cells)
+
+
+def write_triplets(path, results, precision=5):
+    ncells = 0
+    with open(path, 'w') as f:
+        f.write('geohash\tsample\ttaxonkey\n')
+        for cell, cell_taxa, cell_counts, samples in results:
+            geohash = grid.to_strings([cell], precision)[0]
+            f.writelines('%s\t%d\t%d\n' % (geohash, j + 1, taxon) for j, taxon in enumerate(samples))
+            ncells += 1
+    return ncells
+
+
+def write_sample_sets(path, results, ncells, precision=5, title=''):
+    """
+    write the *MultipleSampleSets* format of download/run.pl. The number of
+    cells goes in the first line, so it is given up front (see count()).
+    """
+    with open(path, 'w') as f:
+        f.write('*MultipleSampleSets*\t%d\t%s\n' % (ncells, title))
+        for cell, cell_taxa, cell_counts, samples in results:
+            members = len(samples)
+            lat, lon = grid.decode([cell], precision)
+            f.write('Cell %s (%.15g, %.15g)\t*SampleSet*\t1\t1\t1\n'
+                    % (grid.to_strings([cell], precision)[0], lat[0], lon[0]))
+            f.write('%d\t%d\n' % (len(cell_taxa), members))
+            f.write(''.join('\t%05d' % j for j in range(1, members + 1)) + '\n')
+            ## one row per taxon, built from the positions of its samples
+            order = np.argsort(samples, kind='mergesort')
+            starts = np.searchsorted(samples[order], cell_taxa)
+            ends = np.append(starts[1:], members)
+            rows = {}
+            for taxon, start, end in zip(cell_taxa, starts, ends):
+                rows[str(taxon)] = order[start:end]
+            for taxon in sorted(rows, key=lambda name: name.lower()):
+                row = bytearray('\t0' * members)
+                for j in rows[taxon]:
+                    row[2 * j + 1] = '1'
+                f.write(taxon)
+                f.write(row)
+                f.write('\n')
+
+
+def count(counts_per_cell, min_members=3):
+    """ number of cells of at least min_members individuals """
+    return sum(1 for total in counts_per_cell if total >= min_members)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Random sample incidence of the communities of the cells made by grid.py')
+    parser.add_argument('-i', '--input', dest='input', help='input  – [str] grid.py output (.tsv or .npz)', required=True, action='store')
+    parser.add_argument('-o', '--output', dest='output', help='output  – [str] output file', required=True, action='store')
+    parser.add_argument('--format', dest='format', help='format  – [str] npz (sparse arrays), triplets (geohash, sample, taxonkey) or sample_sets (*MultipleSampleSets* text)', choices=['npz', 'triplets', 'sample_sets'], default='npz', action='store')
+    parser.add_argument('--seed', dest='seed', help='seed  – [int] random seed', type=int, default=0, action='store')
+    parser.add_argument('--min_members', dest='min_members', help='min_members  – [int] smallest number of individuals of a cell', type=int, default=3, action='store')
+    parser.add_argument('--title', dest='title', help='title  – [str] title of the *MultipleSampleSets* file', default=None, action='store')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    cells, taxa, counts, precision = grid.read(args.input)
+    results = incidence(cells, taxa, counts, args.seed, args.min_members)
+    if args.format == 'npz':
+        ncells = write_npz(args.output, results, precision, args.seed)
+    elif args.format == 'triplets':
+        ncells = write_triplets(args.output, results, precision)
+    else:
+        ncells = count((cell_counts.sum() for cell, cell_taxa, cell_counts in grid.communities(cells, taxa, counts)),
+                       args.min_members)
+        title = args.title or 'Community with more then %d members' % (args.min_members - 1)
+        write_sample_sets(args.output, results, ncells, precision, title)
+    sys.stdout.write("   %d cells\n" % ncells)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#-*- coding: utf-8 -*-
+
+'''
+Download job manager.
+
+Tracks many GBIF download keys at once. Each job is polled on its own
+exponential schedule, and its zip is fetched (in a background thread) as
+soon as its status turns SUCCEEDED, while the other jobs keep being polled.
+The job state is saved in a small json file after every change, so an
+interrupted run resumes from it without resubmitting the queries.
+
+Queries can also be queued: they are submitted only while fewer than
+max_running jobs are being prepared by GBIF, which limits the number of
+concurrent downloads of a user.
+
+job states:  queued -> polling -> fetching -> done
+                              -> failed      (KILLED, CANCELLED, FAILED or fetch error)
+                  -> failed                  (submission refused, or failed max_submits times)
+'''
+
+import os
+import sys
+import json
+import time
+import threading
+
+FINISHED = ('FAILED', 'KILLED', 'CANCELLED')
+
+## submissions of a queued query, at most, before its job fails
+MAX_SUBMITS = 10
+
+
+class JobManager(object):
+    """
+    meta(key) returns the download metadata (occ.download_meta),
+    fetch(key) downloads the zip and returns a dict with at least 'path',
+    and submit(query) requests the download of a queued query, returning its key.
+    A submission error for which fatal(error) is true (a refused query) fails the job
+    at once, other errors are retried up to max_submits times.
+    """
+
+    def __init__(self, state_path, meta, fetch, submit=None, max_running=3,
+                 first_poll=10, max_poll=300, factor=1.6, fetchers=2, fatal=None, max_submits=MAX_SUBMITS):
+        self.state_path = state_path
+        self.meta = meta
+        self.fetch = fetch
+        self.submit = submit
+        self.max_running = max_running
+        self.first_poll = first_poll
+        self.max_poll = max_poll
+        self.factor = factor
+        self.fatal = fatal
+        self.max_submits = max_submits
+        self.fetch_slots = threading.Semaphore(fetchers)
+        self.lock = threading.RLock()
+        self.jobs = []
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.state_path):
+            return
+        with open(self.state_path) as f:
+            self.jobs = json.load(f)
+        for job in self.jobs:
+            if job['state'] == 'fetching':
+                job['state'] = 'polling'
+            job['next_poll'] = 0
+
+    def save(self):
+        """ write the state to a temporary file, then rename it over the old one """
+        with self.lock:
+            directory = os.path.dirname(self.state_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = self.state_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.jobs, f, indent=2)
+            os.rename(tmp, self.state_path)
+
+    def get(self, key):
+        for job in self.jobs:
+            if job['key'] == key:
+                return job
+        return None
+
+    def find(self, query):
+        """ the job already submitted for query, unless it failed """
+        for job in self.jobs:
+            if job['query'] == query and job['state'] != 'failed':
+                return job
+        return None
+
+    def _new(self, key, query, state):
+        job = {'key': key, 'query': query, 'state': state, 'status': None,
+               'interval': self.first_poll, 'next_poll': 0, 'polls': 0,
+               'size': None, 'path': None, 'error': None, 'submits': 0}
+        self.jobs.append(job)
+        return job
+
+    def queue(self, query):
+        """ queue query for submission, returning its job (the existing one when it was already submitted) """
+        with self.lock:
+            job = self.find(query)
+            if job is None:
+                job = self._new(None, query, 'queued')
+                self.save()
+        return job
+
+    def add(self, key, query=None):
+        """ track a download key, returning its job """
+        with self.lock:
+            job = self.get(key)
+            if job is None:
+                job = self._new(key, query, 'polling')
+            elif job['state'] == 'failed':
+                job.update(state='polling', interval=self.first_poll, next_poll=0, error=None)
+            self.save()
+        return job
+
+    def _log(self, job, message):
+        sys.stdout.write(" %s  %s\n" % (job['key'], message))
+        sys.stdout.flush()
+
+    def _submit(self, job):
+        try:
+            job['key'] = self.submit(job['query'])
+            job['state'] = 'polling'
+            job['next_poll'] = time.time() + job['interval']
+            self._log(job, "submitted")
+        except Exception as e:
+            job['submits'] = job.get('submits', 0) + 1
+            if (self.fatal is not None and self.fatal(e)) or job['submits'] >= self.max_submits:
+                job['state'] = 'failed'
+                job['error'] = str(e)
+                sys.stdout.write(" submission failed after %d tries: %s\n" % (job['submits'], e))
+            else:
+                ## most likely too many running downloads, try again later
+                sys.stdout.write(" submission failed, will retry: %s\n" % e)
+                job['next_poll'] = time.time() + min(self.first_poll * self.factor ** (job['submits'] - 1), self.max_poll)
+        self.save()
+
+    def _poll(self, job):
+        job['polls'] += 1
+        try:
+            meta = self.meta(job['key'])
+        except Exception as e:
+            self._log(job, "status check failed: %s" % e)
+            meta = {'status': job['status']}
+        if meta['status'] != job['status']:
+            self._log(job, "status: %s" % meta['status'])
+        job['status'] = meta['status']
+        job['size'] = meta.get('size', job['size'])
+        if job['status'] == 'SUCCEEDED':
+            job['state'] = 'fetching'
+            thread = threading.Thread(target=self._fetch, args=(job,))
+            thread.daemon = True
+            thread.start()
+        elif job['status'] in FINISHED:
+            job['state'] = 'failed'
+            job['error'] = 'download %s' % job['status']
+        else:
+            job['next_poll'] = time.time() + job['interval']
+            job['interval'] = min(job['interval'] * self.factor, self.max_poll)
+        self.save()
+
+    def _fetch(self, job):
+        with self.fetch_slots:
+            try:
+                result = self.fetch(job['key'])
+                with self.lock:
+                    job['state'] = 'done'
+                    job['path'] = result['path']
+                    job['size'] = result.get('size', job['size'])
+                self._log(job, "on disk at %s" % job['path'])
+            except Exception as e:
+                with self.lock:
+                    job['state'] = 'failed'
+                    job['error'] = str(e)
+                self._log(job, "fetch failed: %s" % e)
+            self.save()
+
+    def wait(self, jobs=None, timeout=None):
+        """ submit, poll and fetch jobs (default: all) until each one is done or failed """
+        start = time.time()
+        while True:
+            with self.lock:
+                jobs = self.jobs if jobs is None else jobs
+                active = [job for job in jobs if job['state'] in ('queued', 'polling', 'fetching')]
+                if not active:
+                    return jobs
+                now = time.time()
+                ## jobs of the jobs file not waited on are never polled here: they would hold their slots for ever
+                running = len([job for job in active if job['state'] == 'polling'])
+                for job in active:
+                    if job['state'] == 'queued' and running < self.max_running and job['next_poll'] <= now:
+                        self._submit(job)
+                        running += job['state'] == 'polling'
+                for job in active:
+                    if job['state'] == 'polling' and job['next_poll'] <= now:
+                        self._poll(job)
+                polling = [job['next_poll'] for job in active if job['state'] == 'polling' or
+                           (job['state'] == 'queued' and running < self.max_running)]
+            if timeout is not None and time.time() - start > timeout:
+                return jobs
+            delay = min(polling) - time.time() if polling else 0.5
+            if len(polling) < len(active):
+                ## a fetch may end at any time
+                delay = min(delay, 0.5)
+            time.sleep(max(delay, 0.1))
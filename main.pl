@@ -71,52 +71,30 @@ if($run_d){
 
     #$d_args = "'basisOfRecord = HUMAN_OBSERVATION' 'country = PT' 'year = 1980,2017' 'month = 3,6' 'hasCoordinate = TRUE' 'hasGeospatialIssue = FALSE' 'taxonKey = 729'";
     
-    my $json_txt = `python easy_gbif.py -d -q  $d_args`;
-    
-    my @output_d = split(/\n/, $json_txt);
-    
-    if($output_d[1] =~ /^\[.+\]$/){
-        my @decoded_json = @{decode_json($output_d[1] )};
-        
-        my $d_key = $decoded_json[0];
-        print " download key: $d_key \n";
-                
-        #### get download ####
-        my $nTry = 1;
-        my $sucess;
-        do {
-            $sucess = 0;
-            if($d_key =~ /\d+-\d+/){
-                $json_txt = `python easy_gbif.py -dm --dKey $d_key`;
-                my $decoded_json = decode_json($json_txt);
-                print " The download status is:  ".$decoded_json->{"status"} ."\n";
-                if($decoded_json->{"status"} eq 'SUCCEEDED'){
-                    ## download zip file
-                    `mkdir -p download` ;
-                    $json_txt = `python easy_gbif.py -dg --dKey $d_key --path $dir_download `;
-                    
-                    my @output_dg = split(/\n/, $json_txt);
-                    if($output_dg[0] =~/Download file size/ and $output_dg[1] =~/On disk at/){
-                        $sucess = 1;
-                        print " $output_dg[0] \n";
-                        print " $output_dg[1] \n";
-                        #print " $output_dg[2] \n";
-                    }
-                }
-            }
-            ## wait 10 min
-            if(!$sucess){
-                print " $nTry - I will sleep 2 min and wait for SUCCEEDED status... \n";
-                sleep 120
+    ## submit the query, poll it and get the zip as soon as it SUCCEEDED.
+    ## the jobs are kept in download/.easy_gbif_jobs.json, so running the same query again resumes it
+    `mkdir -p $dir_download` ;
+    open(my $fh, '-|', "python easy_gbif.py -d --wait --path $dir_download -q $d_args") or die " Can't run easy_gbif.py: $!\n";
+    my $last_line = '';
+    while (my $line = <$fh>){
+        chomp $line;
+        print " $line\n" if ($line !~ /^\[\{/);
+        $last_line = $line;
+    }
+    close $fh;
+
+    if($last_line =~ /^\[.+\]$/){
+        foreach my $job (@{decode_json($last_line)}){
+            if($job->{"state"} eq 'done'){
+                print " Download file size: $job->{'size'} bytes \n";
+                print " On disk at $job->{'path'} \n";
+            }else{
+                print " Download NOT SUCCEEDED :( $job->{'error'} \n";
             }
-            $nTry ++;
-        }while($sucess == 0 and $nTry < 10);
-        if($sucess == 0){
-            print " Download NOT SUCCEEDED :( \n";
         }
     }else{
         print "\n Error: Don\'t know parse json output. Output is:  \n";
-        print $output_d[1] ."\n";
+        print $last_line ."\n";
     }
 }
 
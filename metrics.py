@@ -0,0 +1,344 @@
+#-*- coding: utf-8 -*-
+
+'''
+Opt-in timing of every http call to the GBIF api (--metrics).
+
+Each call sent through the shared Transport is timed phase by phase:
+
+   dns        name resolution (getaddrinfo)
+   connect    tcp connection
+   tls        tls handshake
+   ttfb       request sent until the response headers are in
+   transfer   body read, up to its last byte (streamed zips included)
+
+dns, connect and tls are timed by hooks on the urllib3 connections, so
+they are zero for a reused keep-alive connection. Calls record the api
+function that made them (occ.search, ...), the http status and the body
+bytes, next to the retries and the response cache hits of each function.
+The calls are written as json lines as they end, or as a Prometheus text
+exposition at exit, and summary() tells apart the time spent waiting on
+the network from the local time (parsing, writing) of the run.
+'''
+
+import re
+import json
+import time
+import socket
+import urlparse
+import threading
+import contextlib
+
+PHASES = ['dns', 'connect', 'tls', 'ttfb', 'transfer']
+
+_local = threading.local()
+
+
+def _timings():
+    """ phase times of the call running in this thread, empty outside a call """
+    return getattr(_local, 'timings', None) or {}
+
+
+def _add(phase, seconds):
+    """ add seconds to a connection phase of the call running in this thread """
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + seconds
+
+
+class _Socket(object):
+    """ the socket module as seen by urllib3.util.connection, with getaddrinfo timed """
+
+    def getaddrinfo(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return socket.getaddrinfo(*args, **kwargs)
+        finally:
+            _add('dns', time.time() - start)
+
+    def __getattr__(self, name):
+        return getattr(socket, name)
+
+
+_hooked = False
+
+def hook():
+    """ time the dns, connect and tls phases of the new urllib3 connections """
+    global _hooked
+    if _hooked:
+        return
+    import urllib3.connection
+    import urllib3.util.connection
+    urllib3.util.connection.socket = _Socket()
+
+    new_conn = urllib3.connection.HTTPConnection._new_conn
+    def _new_conn(self):
+        start = time.time()
+        dns = _timings().get('dns', 0)
+        try:
+            return new_conn(self)
+        finally:
+            ## the dns lookup happens inside _new_conn, keep it apart
+            _add('connect', time.time() - start - (_timings().get('dns', 0) - dns))
+    urllib3.connection.HTTPConnection._new_conn = _new_conn
+
+    https_connect = urllib3.connection.HTTPSConnection.connect
+    def connect(self):
+        start = time.time()
+        before = dict(_timings())
+        try:
+            return https_connect(self)
+        finally:
+            after = _timings()
+            opened = sum(after.get(phase, 0) - before.get(phase, 0) for phase in ('dns', 'connect'))
+            _add('tls', time.time() - start - opened)
+    urllib3.connection.HTTPSConnection.connect = connect
+    _hooked = True
+
+
+def _path(url):
+    """ url path below the api root, with the keys replaced by N """
+    path = urlparse.urlparse(url).path
+    path = re.sub(r'^/v1/', '', path).strip('/')
+    return re.sub(r'(?<=/)[\d-]+(\.zip)?(?=/|$)', 'N', path)
+
+
+def percentile(values, q):
+    """ q-th percentile of values, linearly interpolated """
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class _Endpoint(object):
+    """ running totals of the calls of one endpoint """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.retries = 0
+        self.hits = 0
+        self.misses = 0
+        self.statuses = {}
+        self.phases = dict((phase, 0.0) for phase in PHASES)
+        self.durations = []
+
+
+class Metrics(object):
+    """
+    per-call timings, retries and cache hits of one run.
+    With path, every call is written there as a json line when it ends (fmt='jsonl'),
+    or the totals are written in Prometheus text format by close() (fmt='prometheus').
+    """
+
+    def __init__(self, path=None, fmt='jsonl'):
+        if fmt not in ('jsonl', 'prometheus'):
+            raise ValueError("metrics format must be jsonl or prometheus")
+        self.path = path
+        self.fmt = fmt
+        self.start = time.time()
+        self.end = None
+        self.endpoints = {}
+        self.intervals = []
+        self.lock = threading.Lock()
+        self.out = open(path, 'w') if path is not None and fmt == 'jsonl' else None
+        hook()
+
+    def _endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = _Endpoint()
+        return self.endpoints[name]
+
+    def _write(self, entry):
+        if self.out is not None:
+            self.out.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    @contextlib.contextmanager
+    def scope(self, endpoint):
+        """ label the http calls made in this thread within the block with endpoint """
+        previous = getattr(_local, 'endpoint', None)
+        _local.endpoint = endpoint
+        try:
+            yield
+        finally:
+            _local.endpoint = previous
+
+    def request(self, send, method, url, **kwargs):
+        """ send(method, url, **kwargs), timing the call """
+        _local.timings = {}
+        start = time.time()
+        try:
+            response = send(method, url, **kwargs)
+        except Exception as e:
+            self._finish(method, url, start, None, 0, e)
+            raise
+        if not kwargs.get('stream'):
+            self._finish(method, url, start, response, len(response.content))
+            return response
+
+        ## a streamed body is timed up to its last chunk
+        iter_content = response.iter_content
+        timings = _local.timings
+        def counted(*args, **kwargs):
+            size = 0
+            error = None
+            try:
+                for chunk in iter_content(*args, **kwargs):
+                    size += len(chunk)
+                    yield chunk
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                _local.timings = timings
+                self._finish(method, url, start, response, size, error)
+        response.iter_content = counted
+        return response
+
+    def _finish(self, method, url, start, response, size, error=None):
+        end = time.time()
+        timings = _timings()
+        _local.timings = None
+        opened = sum(timings.get(phase, 0) for phase in ('dns', 'connect', 'tls'))
+        entry = {'event': 'http', 'time': start, 'endpoint': getattr(_local, 'endpoint', None) or _path(url),
+                 'method': method, 'path': _path(url), 'status': None, 'bytes': size,
+                 'total': end - start, 'reused': 'connect' not in timings, 'error': None}
+        for phase in ('dns', 'connect', 'tls'):
+            entry[phase] = timings.get(phase, 0)
+        if response is not None:
+            entry['status'] = response.status_code
+            headers = response.elapsed.total_seconds()
+            entry['ttfb'] = max(0, headers - opened)
+            entry['transfer'] = max(0, end - start - headers)
+        else:
+            entry['ttfb'] = entry['transfer'] = 0
+        if error is not None:
+            entry['error'] = str(error).replace('\n', ' ')[:200]
+        with self.lock:
+            totals = self._endpoint(entry['endpoint'])
+            totals.calls += 1
+            if error is not None or response is None or response.status_code >= 400:
+                totals.errors += 1
+            totals.bytes += size
+            status = str(entry['status'])
+            totals.statuses[status] = totals.statuses.get(status, 0) + 1
+            for phase in PHASES:
+                totals.phases[phase] += entry[phase]
+            totals.durations.append(entry['total'])
+            self.intervals.append((start, end))
+            self._write(entry)
+
+    def retried(self, endpoint, error):
+        """ count a retry of an endpoint call """
+        with self.lock:
+            self._endpoint(endpoint).retries += 1
+            self._write({'event': 'retry', 'time': time.time(), 'endpoint': endpoint,
+                         'error': str(error).replace('\n', ' ')[:200]})
+
+    def cached(self, endpoint, hit):
+        """ count a response cache hit or miss of an endpoint call """
+        with self.lock:
+            totals = self._endpoint(endpoint)
+            if hit:
+                totals.hits += 1
+            else:
+                totals.misses += 1
+            self._write({'event': 'cache', 'time': time.time(), 'endpoint': endpoint, 'hit': hit})
+
+    def network_seconds(self):
+        """ wall time with at least one http call in flight """
+        busy = 0
+        last = None
+        for start, end in sorted(self.intervals):
+            if last is not None and start < last:
+                if end > last:
+                    busy += end - last
+                    last = end
+                continue
+            busy += end - start
+            last = end
+        return busy
+
+    def close(self):
+        """ end the run: write the totals, and the Prometheus exposition when asked for """
+        with self.lock:
+            self.end = time.time()
+            wall = self.end - self.start
+            network = self.network_seconds()
+            self._write({'event': 'run', 'time': self.start, 'wall': wall, 'network': network, 'local': wall - network})
+            if self.out is not None:
+                self.out.close()
+                self.out = None
+        if self.path is not None and self.fmt == 'prometheus':
+            with open(self.path, 'w') as f:
+                f.write(self.prometheus())
+
+    def prometheus(self):
+        """ the totals in Prometheus text exposition format """
+        lines = []
+        def metric(name, kind, text, samples):
+            lines.append('# HELP easy_gbif_%s %s' % (name, text))
+            lines.append('# TYPE easy_gbif_%s %s' % (name, kind))
+            for labels, value in samples:
+                label = ','.join('%s="%s"' % (key, value) for key, value in labels)
+                lines.append('easy_gbif_%s%s %r' % (name, '{%s}' % label if label else '', value))
+
+        endpoints = sorted(self.endpoints.items())
+        metric('http_requests_total', 'counter', 'HTTP calls to the GBIF api by status',
+               [((('endpoint', name), ('status', status)), count)
+                for name, totals in endpoints for status, count in sorted(totals.statuses.items())])
+        metric('http_request_seconds', 'summary', 'Duration of the HTTP calls',
+               [((('endpoint', name), ('quantile', str(q))), percentile(totals.durations, q * 100))
+                for name, totals in endpoints if totals.durations for q in (0.5, 0.9, 0.99)])
+        lines.extend('easy_gbif_http_request_seconds_sum{endpoint="%s"} %r' % (name, sum(totals.durations))
+                     for name, totals in endpoints if totals.durations)
+        lines.extend('easy_gbif_http_request_seconds_count{endpoint="%s"} %d' % (name, len(totals.durations))
+                     for name, totals in endpoints if totals.durations)
+        metric('http_phase_seconds_total', 'counter', 'Time spent in each phase of the HTTP calls',
+               [((('endpoint', name), ('phase', phase)), totals.phases[phase])
+                for name, totals in endpoints for phase in PHASES if totals.calls])
+        metric('http_response_bytes_total', 'counter', 'Body bytes received',
+               [((('endpoint', name),), totals.bytes) for name, totals in endpoints if totals.calls])
+        metric('retries_total', 'counter', 'Calls retried after an error',
+               [((('endpoint', name),), totals.retries) for name, totals in endpoints])
+        metric('cache_hits_total', 'counter', 'Calls answered by the response cache',
+               [((('endpoint', name),), totals.hits) for name, totals in endpoints if totals.hits or totals.misses])
+        metric('cache_misses_total', 'counter', 'Cacheable calls sent to the api',
+               [((('endpoint', name),), totals.misses) for name, totals in endpoints if totals.hits or totals.misses])
+        end = self.end or time.time()
+        network = self.network_seconds()
+        metric('run_seconds', 'gauge', 'Wall time of the run, with an HTTP call in flight (network) or not (local)',
+               [((('part', 'wall'),), end - self.start), ((('part', 'network'),), network),
+                ((('part', 'local'),), end - self.start - network)])
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """ table of the calls of every endpoint, mean phase times in ms """
+        rows = ['%-32s %6s %6s %7s %6s %10s %8s %8s %6s %7s %6s %7s %8s'
+                % ('endpoint', 'calls', 'errors', 'retries', 'hits', 'bytes', 'p50 ms', 'p99 ms',
+                   'dns', 'connect', 'tls', 'ttfb', 'transfer')]
+        for name, totals in sorted(self.endpoints.items()):
+            calls = totals.calls or 1
+            p50 = percentile(totals.durations, 50)
+            p99 = percentile(totals.durations, 99)
+            rows.append('%-32s %6d %6d %7d %6d %10d %8s %8s %6.1f %7.1f %6.1f %7.1f %8.1f'
+                        % ((name[:32], totals.calls, totals.errors, totals.retries, totals.hits, totals.bytes,
+                            '-' if p50 is None else '%.1f' % (1000 * p50), '-' if p99 is None else '%.1f' % (1000 * p99))
+                           + tuple(1000 * totals.phases[phase] / calls for phase in PHASES)))
+        end = self.end or time.time()
+        network = self.network_seconds()
+        rows.append('wall %.3f s: network %.3f s, local %.3f s' % (end - self.start, network, end - self.start - network))
+        return '\n'.join(rows) + '\n'
+
+
+@contextlib.contextmanager
+def _unlabelled():
+    yield
+
+def scope(metrics, endpoint):
+    """ metrics.scope(endpoint), or a no-op block when metrics is None """
+    return _unlabelled() if metrics is None else metrics.scope(endpoint)
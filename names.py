@@ -0,0 +1,261 @@
+#-*- coding: utf-8 -*-
+
+'''
+Bulk resolution of scientific names to GBIF backbone taxon keys.
+
+build() indexes a dump of the GBIF backbone (the Taxon.tsv of backbone.zip,
+https://hosted-datasets.gbif.org/datasets/backbone/) into SQLite, under
+three keys of every name:
+
+   exact        the scientific name, with or without authorship, as written
+   normalized   lowercase genus and epithets, without authorship, rank
+                markers (subsp., var.), hybrid signs or accents
+   fuzzy        the normalized names of the same genus (or, for a misspelled
+                genus or a higher taxon, of the same first letter), compared
+                with difflib
+
+Index.resolve() looks a whole list of names up in one pass: exact and
+normalized keys in batched queries, fuzzy matching for the rest. The names
+the index cannot match are left to a fallback, species.name_backbone
+through the response cache in easy_gbif.py.
+'''
+
+import os
+import re
+import sqlite3
+import difflib
+import zipfile
+import unicodedata
+
+import config
+
+DEFAULT_PATH = config.BACKBONE_PATH
+
+## similarity (difflib ratio) a fuzzy match needs
+FUZZY_CUTOFF = config.FUZZY_CUTOFF
+
+## names looked up per query
+BATCH = 500
+
+## preferred taxonomic status when a name has several usages
+STATUS_ORDER = {'ACCEPTED': 0, 'DOUBTFUL': 1}
+
+RANK_MARKERS = set(['subsp', 'ssp', 'var', 'subvar', 'f', 'fo', 'forma', 'subf', 'cv', 'nothosubsp', 'nothovar', 'agg'])
+PARTICLES = set(['de', 'del', 'der', 'van', 'von', 'da', 'du', 'la', 'le', 'ex', 'et', 'in', 'non', 'sensu', 'auct', 'emend'])
+
+## Taxon.tsv columns of the backbone dump, and their fields in the index
+COLUMNS = [('taxonID', 'taxonkey'), ('acceptedNameUsageID', 'accepted'), ('scientificName', 'scientificname'),
+           ('canonicalName', 'canonical'), ('taxonRank', 'rank'), ('taxonomicStatus', 'status'),
+           ('kingdom', 'kingdom'), ('family', 'family')]
+
+
+def normalize(name):
+    """ lowercase canonical form of a scientific name: genus and at most two epithets """
+    if isinstance(name, str):
+        name = name.decode('utf-8', 'replace')
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore')
+    ## subgenus, or authorship of a basionym
+    name = re.sub(r'\([^)]*\)', ' ', name)
+    words = []
+    for n, word in enumerate(name.replace('"', ' ').split()):
+        bare = word.rstrip('.').lower()
+        if n == 0:
+            if not re.match(r'^[A-Za-z][A-Za-z-]*$', word):
+                return ''
+            words.append(word.lower())
+            continue
+        if bare == 'x' or bare in RANK_MARKERS:
+            continue
+        if not re.match(r'^[a-z][a-z-]+$', word) or bare in PARTICLES:
+            ## authorship starts
+            break
+        words.append(word)
+        if len(words) == 3:
+            break
+    return ' '.join(words)
+
+
+def _status(value):
+    return value.strip().upper().replace(' ', '_')
+
+
+def _open_dump(path):
+    """ header fields and line iterator of Taxon.tsv, in a backbone zip or extracted """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        members = [info for info in archive.infolist() if os.path.basename(info.filename) == 'Taxon.tsv']
+        if not members:
+            raise ValueError("%s has no Taxon.tsv" % path)
+        stream = archive.open(members[0])
+    else:
+        stream = open(path, 'rb')
+    header = stream.readline().rstrip('\r\n').split('\t')
+    return header, stream
+
+
+def build(dump, path=DEFAULT_PATH, log=None):
+    """ index the Taxon.tsv of a backbone dump into the SQLite file path. Returns the number of taxa """
+    header, stream = _open_dump(dump)
+    missing = [column for column, field in COLUMNS if column not in header]
+    if missing:
+        raise ValueError("columns not in the backbone dump: %s" % ', '.join(missing))
+    fields = [header.index(column) for column, field in COLUMNS]
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('CREATE TABLE taxa (taxonkey INTEGER PRIMARY KEY, accepted INTEGER, scientificname TEXT, '
+               'canonical TEXT, rank TEXT, status TEXT, kingdom TEXT, family TEXT, normalized TEXT, genus TEXT)')
+    db.execute('CREATE TABLE exact (name TEXT, taxonkey INTEGER)')
+
+    count = 0
+    taxa = []
+    exact = []
+    for line in stream:
+        values = line.rstrip('\r\n').split('\t')
+        if len(values) < len(header):
+            continue
+        taxonkey, accepted, scientificname, canonical, rank, status, kingdom, family = [values[i] for i in fields]
+        if not taxonkey.isdigit():
+            continue
+        scientificname = scientificname.decode('utf-8', 'replace')
+        canonical = canonical.decode('utf-8', 'replace')
+        normalized = normalize(canonical or scientificname)
+        taxa.append((int(taxonkey), int(accepted) if accepted.isdigit() else None, scientificname, canonical,
+                     rank.upper(), _status(status), kingdom.decode('utf-8', 'replace'), family.decode('utf-8', 'replace'),
+                     normalized, normalized.split(' ')[0]))
+        exact.append((scientificname, int(taxonkey)))
+        if canonical and canonical != scientificname:
+            exact.append((canonical, int(taxonkey)))
+        count += 1
+        if len(taxa) >= 100000:
+            db.executemany('INSERT OR REPLACE INTO taxa VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', taxa)
+            db.executemany('INSERT INTO exact VALUES (?, ?)', exact)
+            taxa, exact = [], []
+            if log is not None:
+                log(count)
+    db.executemany('INSERT OR REPLACE INTO taxa VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', taxa)
+    db.executemany('INSERT INTO exact VALUES (?, ?)', exact)
+    db.execute('CREATE INDEX exact_name ON exact (name)')
+    db.execute('CREATE INDEX taxa_normalized ON taxa (normalized)')
+    db.execute('CREATE INDEX taxa_genus ON taxa (genus)')
+    db.commit()
+    db.close()
+    os.rename(tmp, path)
+    return count
+
+
+class Index(object):
+    """ name lookups in a backbone index made by build() """
+
+    def __init__(self, path=DEFAULT_PATH, cutoff=FUZZY_CUTOFF):
+        if not os.path.exists(path):
+            raise IOError("no backbone index at %s, build it with --names_build" % path)
+        self.path = path
+        self.cutoff = cutoff
+        self.db = sqlite3.connect(path)
+        self.genera = {}
+        self.species = {}
+
+    def _taxa(self, query, keys):
+        """ {key: [taxon rows]} of a query on a batch of keys """
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), BATCH):
+            batch = keys[start:start + BATCH]
+            sql = query % ','.join('?' * len(batch))
+            for row in self.db.execute(sql, batch):
+                found.setdefault(row[0], []).append(row[1:])
+        return found
+
+    def _best(self, rows, kingdom=None):
+        """ the preferred usage of rows: of kingdom, accepted before doubtful before synonyms """
+        if kingdom is not None:
+            rows = [row for row in rows if (row[6] or '').lower() == kingdom.lower()]
+        if not rows:
+            return None, 0
+        rows = sorted(rows, key=lambda row: (STATUS_ORDER.get(row[5], 2), row[0]))
+        return rows[0], len(rows)
+
+    def _candidates(self, normalized):
+        """ normalized names a fuzzy match of normalized may be: same genus, or same first letter """
+        genus = normalized.split(' ')[0]
+        if ' ' in normalized:
+            if genus not in self.species:
+                self.species[genus] = [row[0] for row in self.db.execute(
+                    'SELECT DISTINCT normalized FROM taxa WHERE genus = ?', (genus,))]
+            if self.species[genus]:
+                return self.species[genus]
+        letter = genus[:1]
+        if letter not in self.genera:
+            self.genera[letter] = [row[0] for row in self.db.execute(
+                'SELECT DISTINCT genus FROM taxa WHERE genus >= ? AND genus < ?', (letter, chr(ord(letter) + 1)))]
+        if ' ' not in normalized:
+            return self.genera[letter]
+        ## misspelled genus: the names of the closest genera
+        names = []
+        for match in difflib.get_close_matches(genus, self.genera[letter], n=3, cutoff=self.cutoff):
+            names.extend(row[0] for row in self.db.execute(
+                'SELECT DISTINCT normalized FROM taxa WHERE genus = ?', (match,)))
+        return names
+
+    def _result(self, name, row, count, match, confidence):
+        taxonkey, accepted, scientificname, canonical, rank, status, kingdom, family = row
+        return {'name': name, 'usageKey': taxonkey, 'acceptedUsageKey': accepted or taxonkey,
+                'scientificName': scientificname, 'canonicalName': canonical, 'rank': rank, 'status': status,
+                'kingdom': kingdom, 'family': family, 'matchType': 'FUZZY' if match == 'fuzzy' else 'EXACT',
+                'confidence': confidence, 'match': match, 'usages': count}
+
+    def resolve(self, names, kingdom=None):
+        """ {name: result} of the names found in the index, exact, normalized or fuzzy """
+        columns = 'taxonkey, accepted, scientificname, canonical, rank, status, kingdom, family'
+        names = set(name.strip() for name in names if name.strip())
+        results = {}
+
+        decoded = dict((name, name.decode('utf-8', 'replace') if isinstance(name, str) else name) for name in names)
+        found = self._taxa('SELECT exact.name, %s FROM exact JOIN taxa USING (taxonkey) WHERE exact.name IN (%%s)' % columns,
+                           decoded.values())
+        for name in names:
+            row, count = self._best(found.get(decoded[name], []), kingdom)
+            if row is not None:
+                results[name] = self._result(name, row, count, 'exact', 100)
+
+        normalized = dict((name, normalize(name)) for name in names if name not in results)
+        found = self._taxa('SELECT normalized, %s FROM taxa WHERE normalized IN (%%s)' % columns,
+                           set(key for key in normalized.values() if key))
+        for name, key in normalized.items():
+            row, count = self._best(found.get(key, []), kingdom)
+            if row is not None:
+                results[name] = self._result(name, row, count, 'normalized', 99)
+
+        for name, key in normalized.items():
+            if name in results or not key:
+                continue
+            matches = difflib.get_close_matches(key, self._candidates(key), n=1, cutoff=self.cutoff)
+            if not matches:
+                continue
+            rows = self._taxa('SELECT normalized, %s FROM taxa WHERE normalized IN (%%s)' % columns, matches)
+            row, count = self._best(rows.get(matches[0], []), kingdom)
+            if row is not None:
+                confidence = int(100 * difflib.SequenceMatcher(None, key, matches[0]).ratio())
+                results[name] = self._result(name, row, count, 'fuzzy', confidence)
+        return results
+
+
+def from_backbone(name, match):
+    """ result of a species.name_backbone answer, in the format of Index.resolve """
+    if not match or match.get('matchType', 'NONE') == 'NONE' or match.get('usageKey') is None:
+        return {'name': name, 'usageKey': None, 'acceptedUsageKey': None, 'matchType': 'NONE',
+                'confidence': (match or {}).get('confidence'), 'match': None, 'usages': 0}
+    return {'name': name, 'usageKey': match['usageKey'], 'acceptedUsageKey': match.get('acceptedUsageKey', match['usageKey']),
+            'scientificName': match.get('scientificName'), 'canonicalName': match.get('canonicalName'),
+            'rank': match.get('rank'), 'status': match.get('status'), 'kingdom': match.get('kingdom'),
+            'family': match.get('family'), 'matchType': match.get('matchType'), 'confidence': match.get('confidence'),
+            'match': 'api', 'usages': 1}
+
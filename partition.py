@@ -0,0 +1,211 @@
+#-*- coding: utf-8 -*-
+
+'''
+Partitioning of a search query past the paging ceiling of the GBIF api.
+
+occ.search pages no deeper than CEILING records (offset + limit), so a
+larger query cannot be walked page by page. Planner.plan() splits it
+into partitions that each fit under the ceiling, from limit=0 count
+probes, probed in parallel one level at a time:
+
+   year         the year range is halved until a range fits, or is a single year
+                (only the first half is probed, the second is the rest)
+   geometry     a single year too large is split into decimalLatitude /
+                decimalLongitude quadrants, down to MIN_DEGREES, plus the
+                records without coordinates (hasCoordinate = false), which
+                covers every record of the year
+   month        a quadrant of MIN_DEGREES, or the records without coordinates,
+                still too large is split into its twelve months
+
+Records without a year (or, in a month split, without a month) are in no
+partition: the plan counts them as uncovered. Old and herbarium records
+often lack a month, so months come last, where nothing else can split. A
+partition still over the ceiling at the last level is truncated, only its
+first CEILING records are fetched. fetch() walks the pages of every partition concurrently and yields
+each gbifid once, as the quadrant bounds are inclusive on both sides.
+'''
+
+import time
+
+import config
+import workers
+
+
+## records a query can page through (offset + limit)
+CEILING = config.PARTITION_CEILING
+
+## year range of a query without a year filter
+MIN_YEAR = 1000
+
+## smallest quadrant side, in degrees
+MIN_DEGREES = 0.01
+
+
+def _range(value, low, high):
+    """ (low, high) bounds of a 'low,high' range filter, '*' open; None for a single value """
+    if value is None:
+        return low, high
+    value = str(value)
+    if ',' not in value:
+        return None
+    first, last = [bound.strip() for bound in value.split(',', 1)]
+    return (low if first in ('', '*') else float(first)), (high if last in ('', '*') else float(last))
+
+
+def _bounds(low, high):
+    if low == high:
+        return str(low)
+    return '%s,%s' % (low, high)
+
+
+def _degrees(value):
+    return ('%.6f' % value).rstrip('0').rstrip('.')
+
+
+class Planner(object):
+    """ partitions of a search query under the paging ceiling, from count(filters) probes """
+
+    def __init__(self, count, ceiling=CEILING, nworkers=4, min_degrees=MIN_DEGREES):
+        self.count = count
+        self.ceiling = ceiling
+        self.nworkers = nworkers
+        self.min_degrees = min_degrees
+        self.probes = 0
+
+    def _probe(self, queries):
+        """ record counts of the queries, probed concurrently """
+        counts = []
+        for query, count, error in workers.imap(self.count, queries, workers=self.nworkers):
+            if error is not None:
+                raise error[0], error[1], error[2]
+            counts.append(count)
+        self.probes += len(queries)
+        return counts
+
+    def _split(self, filters, level):
+        """ (child filters, child level) of a partition over the ceiling, [] when it cannot be split """
+        if level == 'year':
+            low, high = [int(bound) for bound in _range(filters['year'], None, None) or (filters['year'],) * 2]
+            if low < high:
+                middle = (low + high) // 2
+                return [(dict(filters, year=_bounds(low, middle)), 'year'),
+                        (dict(filters, year=_bounds(middle + 1, high)), 'year')]
+            latitude = _range(filters.get('decimalLatitude'), -90.0, 90.0)
+            longitude = _range(filters.get('decimalLongitude'), -180.0, 180.0)
+            if latitude is None or longitude is None:
+                return self._months(filters)
+            if filters.get('hasCoordinate') is True:
+                return self._quadrants(filters, latitude, longitude)
+            return self._quadrants(filters, latitude, longitude) + [(dict(filters, hasCoordinate=False), 'nocoordinate')]
+        if level == 'geometry':
+            latitude = _range(filters['decimalLatitude'], None, None)
+            longitude = _range(filters['decimalLongitude'], None, None)
+            if latitude[1] - latitude[0] < 2 * self.min_degrees and longitude[1] - longitude[0] < 2 * self.min_degrees:
+                return self._months(filters)
+            return self._quadrants(filters, latitude, longitude)
+        if level == 'nocoordinate':
+            return self._months(filters)
+        return []
+
+    def _months(self, filters):
+        """ the month partitions of a query nothing else splits, [] when it has a month """
+        if filters.get('month') is not None:
+            return []
+        return [(dict(filters, month=str(month)), 'month') for month in range(1, 13)]
+
+    def _quadrants(self, filters, latitude, longitude):
+        south, north = latitude
+        west, east = longitude
+        middle_lat = (south + north) / 2.0
+        middle_lon = (west + east) / 2.0
+        return [(dict(filters, decimalLatitude='%s,%s' % (_degrees(lat[0]), _degrees(lat[1])),
+                      decimalLongitude='%s,%s' % (_degrees(lon[0]), _degrees(lon[1])), hasCoordinate=True), 'geometry')
+                for lat in ((south, middle_lat), (middle_lat, north))
+                for lon in ((west, middle_lon), (middle_lon, east))]
+
+    def plan(self, filters):
+        """
+        {'count', 'partitions', 'uncovered', 'truncated', 'probes'} of a query.
+        Partitions are {'query': filters, 'count': records} dicts, every one under
+        the ceiling but the truncated ones (listed again in 'truncated').
+        """
+        filters = dict((name, value) for name, value in filters.items() if value is not None and value is not False)
+        self.probes = 0
+        plan = {'count': 0, 'partitions': [], 'uncovered': 0, 'truncated': []}
+        years = _range(filters.get('year'), MIN_YEAR, time.localtime().tm_year)
+        if years is None:
+            years = (filters['year'], filters['year'])
+        ranged = dict(filters, year=_bounds(int(years[0]), int(years[1])))
+        queries = [filters]
+        if filters.get('year') is None:
+            queries.append(ranged)
+        counts = self._probe(queries)
+        plan['count'] = counts[0]
+        if counts[0] <= self.ceiling:
+            plan['partitions'].append({'query': filters, 'count': counts[0]})
+            plan['probes'] = self.probes
+            return plan
+        if filters.get('year') is None:
+            ## records without a year are in no year range
+            plan['uncovered'] += max(0, counts[0] - counts[1])
+            frontier = [(ranged, 'year', counts[1])]
+        else:
+            frontier = [(ranged, 'year', counts[0])]
+
+        while frontier:
+            children = []
+            splits = []
+            for query, level, count in frontier:
+                if count == 0:
+                    continue
+                if count <= self.ceiling:
+                    plan['partitions'].append({'query': query, 'count': count})
+                    continue
+                split = self._split(query, level)
+                if not split:
+                    partition = {'query': query, 'count': count}
+                    plan['partitions'].append(partition)
+                    plan['truncated'].append(partition)
+                    continue
+                if split[0][1] == 'year':
+                    ## year halves cover the range: the second one is the rest of its parent
+                    children.extend([(split[0][0], 'year', None), (split[1][0], 'year', count)])
+                else:
+                    splits.append((count, len(children), len(split)))
+                    children.extend((query, child_level, None) for query, child_level in split)
+            counts = iter(self._probe([query for query, level, rest in children if rest is None]))
+            frontier = []
+            for query, level, rest in children:
+                frontier.append((query, level, next(counts) if rest is None else max(0, rest - frontier[-1][2])))
+            for count, start, size in splits:
+                if frontier[start][1] == 'month':
+                    plan['uncovered'] += max(0, count - sum(child[2] for child in frontier[start:start + size]))
+        plan['probes'] = self.probes
+        return plan
+
+
+def pages(plan, limit=300, ceiling=CEILING):
+    """ (query, offset, limit) of every result page of the partitions of a plan """
+    for partition in plan['partitions']:
+        end = min(partition['count'], ceiling)
+        for offset in xrange(0, end, limit):
+            yield partition['query'], offset, min(limit, end - offset)
+
+
+def fetch(plan, search, limit=300, ceiling=CEILING, nworkers=4):
+    """
+    walk the pages of every partition concurrently, yielding lists of records
+    not seen before (by gbifid). search(query, offset, limit) gives an occ.search page.
+    """
+    seen = set()
+    for page_args, page, error in workers.imap(lambda page_args: search(*page_args), pages(plan, limit, ceiling),
+                                               workers=nworkers, ordered=False):
+        if error is not None:
+            raise error[0], error[1], error[2]
+        records = []
+        for record in page['results']:
+            key = record.get('key', record.get('gbifID'))
+            if key not in seen:
+                seen.add(key)
+                records.append(record)
+        yield records
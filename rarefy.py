@@ -0,0 +1,193 @@
+#-*- coding: utf-8 -*-
+
+'''
+Rarefaction of per-cell communities.
+
+download/run.pl rarefies a cell by expanding it to a list of every
+individual and splicing random members out of it, one draw at a time.
+Here a subsample of depth individuals is drawn straight from the species
+counts of the cell with a multivariate hypergeometric draw: either a
+sequence of conditional hypergeometric draws (one per species, for all
+replicates at once), or for cells of many species and few individuals,
+the depth individuals of smallest random key, picked with argpartition.
+
+Every cell gets a random state seeded from (seed, cell), so the results
+are the same whatever the number of processes the cells are spread over.
+
+   python rarefy.py -i cells.npz -o rarefied.tsv --depth 20 --replicates 100 --seed 1 --processes 4
+'''
+
+import sys
+import argparse
+import multiprocessing
+
+import numpy as np
+
+import grid
+
+
+## cells sent to a worker process at a time
+CHUNK = 256
+
+## cost of one hypergeometric draw, in random keys sorted
+SEQUENTIAL_COST = 30
+## largest number of random keys drawn at once
+RANK_BUDGET = 1 << 22
+
+
+def random_state(seed, cell):
+    """ random state of a cell, independent of the process it is drawn in """
+    cell = int(cell)
+    return np.random.RandomState([seed & 0xffffffff, cell >> 32, cell & 0xffffffff])
+
+
+def _sequential(counts, total, depth, replicates, state):
+    """ one conditional hypergeometric draw per species, for all replicates at once """
+    drawn = np.zeros((replicates, len(counts)), dtype=np.int64)
+    left = np.repeat(np.int64(depth), replicates)
+    rest = total
+    for i, count in enumerate(counts):
+        rest -= count
+        if not left.any():
+            break
+        if rest == 0:
+            drawn[:, i] = left
+            break
+        ## draws of species i given the individuals still to draw from it and the species after it
+        sample = state.hypergeometric(count, rest, np.maximum(left, 1))
+        drawn[:, i] = np.where(left > 0, sample, 0)
+        left -= drawn[:, i]
+    return drawn
+
+
+def _ranked(counts, total, depth, replicates, state):
+    """ the depth individuals of smallest random key, a block of replicates at a time """
+    species = np.repeat(np.arange(len(counts)), counts)
+    drawn = np.zeros((replicates, len(counts)), dtype=np.int64)
+    block = max(1, RANK_BUDGET // total)
+    for start in range(0, replicates, block):
+        n = min(block, replicates - start)
+        keys = state.random_sample((n, total))
+        chosen = species[np.argpartition(keys, depth - 1, axis=1)[:, :depth]]
+        chosen += np.arange(n)[:, None] * len(counts)
+        drawn[start:start + n] = np.bincount(chosen.ravel(), minlength=n * len(counts)).reshape(n, len(counts))
+    return drawn
+
+
+def multivariate_hypergeometric(counts, depth, replicates=1, state=None):
+    """
+    draw depth individuals without replacement from a community of species
+    counts, replicates times. Returns an array (replicates, species) of drawn counts.
+    """
+    state = state or np.random.RandomState()
+    counts = np.asarray(counts, dtype=np.int64)
+    total = counts.sum()
+    if depth > total:
+        raise ValueError("depth %d larger than the community (%d individuals)" % (depth, total))
+    if depth == total:
+        return np.tile(counts, (replicates, 1))
+    if depth == 0:
+        return np.zeros((replicates, len(counts)), dtype=np.int64)
+    ## both draws have the same distribution, take the cheaper one
+    if len(counts) * (replicates + 5) * SEQUENTIAL_COST > replicates * total:
+        return _ranked(counts, total, depth, replicates, state)
+    return _sequential(counts, total, depth, replicates, state)
+
+
+def _rarefy_chunk(job):
+    """ rarefy a list of (cell, counts, depth) in a worker process """
+    cells, seed, replicates = job
+    results = []
+    for cell, counts, depth in cells:
+        results.append((cell, depth, multivariate_hypergeometric(counts, depth, replicates, random_state(seed, cell))))
+    return results
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def rarefy(cells, taxa, counts, depth=None, replicates=1, seed=0, processes=1, min_members=3):
+    """
+    rarefy every cell of grouped (cells, taxa, counts) arrays with at least
+    min_members individuals. depth is a number of individuals, 'min' (the
+    smallest accepted cell) or None (every individual of the cell).
+    Yields (cell, taxa, counts, depth, drawn counts (replicates, species)) in cell order;
+    cells smaller than depth are skipped.
+    """
+    accepted = [(cell, cell_taxa, cell_counts) for cell, cell_taxa, cell_counts in grid.communities(cells, taxa, counts)
+                if cell_counts.sum() >= min_members]
+    if depth == 'min':
+        depth = min(cell_counts.sum() for cell, cell_taxa, cell_counts in accepted) if accepted else 0
+    community = dict((cell, (cell_taxa, cell_counts)) for cell, cell_taxa, cell_counts in accepted)
+    jobs = [(cell, cell_counts, depth if depth is not None else cell_counts.sum())
+            for cell, cell_taxa, cell_counts in accepted
+            if depth is None or cell_counts.sum() >= depth]
+    jobs = ((chunk, seed, replicates) for chunk in _chunks(jobs, CHUNK))
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_rarefy_chunk, jobs)
+    else:
+        pool = None
+        results = (_rarefy_chunk(job) for job in jobs)
+    try:
+        for chunk in results:
+            for cell, cell_depth, drawn in chunk:
+                yield (cell,) + community[cell] + (cell_depth, drawn)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Rarefaction of the communities of the cells made by grid.py')
+    parser.add_argument('-i', '--input', dest='input', help='input  – [str] grid.py output (.tsv or .npz)', required=True, action='store')
+    parser.add_argument('-o', '--output', dest='output', help='output  – [str] tab separated file of the rarefied richness of every cell, or .npz file of the drawn counts', required=True, action='store')
+    parser.add_argument('--depth', dest='depth', help='depth  – [int|min] individuals drawn per cell; min: the smallest cell. Default: every individual', required=False, action='store')
+    parser.add_argument('--replicates', dest='replicates', help='replicates  – [int] number of draws per cell', type=int, default=1, action='store')
+    parser.add_argument('--seed', dest='seed', help='seed  – [int] random seed', type=int, default=0, action='store')
+    parser.add_argument('--processes', dest='processes', help='processes  – [int] number of worker processes', type=int, default=1, action='store')
+    parser.add_argument('--min_members', dest='min_members', help='min_members  – [int] smallest number of individuals of a cell', type=int, default=3, action='store')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    depth = args.depth if args.depth in (None, 'min') else int(args.depth)
+    cells, taxa, counts, precision = grid.read(args.input)
+    results = rarefy(cells, taxa, counts, depth, args.replicates, args.seed, args.processes, args.min_members)
+
+    ncells = 0
+    if args.output.endswith('.npz'):
+        out_cells, out_taxa, out_depths, out_counts = [], [], [], []
+        for cell, cell_taxa, cell_counts, cell_depth, drawn in results:
+            out_cells.append(np.repeat(cell, len(cell_taxa)))
+            out_taxa.append(cell_taxa)
+            out_depths.append(cell_depth)
+            out_counts.append(drawn)
+            ncells += 1
+        np.savez_compressed(args.output, cells=np.concatenate(out_cells) if out_cells else np.array([], dtype=np.uint64),
+                            taxa=np.concatenate(out_taxa) if out_taxa else np.array([], dtype=np.int64),
+                            counts=np.hstack(out_counts) if out_counts else np.zeros((args.replicates, 0), dtype=np.int64),
+                            depths=np.array(out_depths, dtype=np.int64), precision=precision, seed=args.seed)
+    else:
+        with open(args.output, 'w') as f:
+            f.write('geohash\tmembers\tdepth\trichness_mean\trichness_sd\n')
+            for cell, cell_taxa, cell_counts, cell_depth, drawn in results:
+                richness = (drawn > 0).sum(axis=1)
+                f.write('%s\t%d\t%d\t%.4f\t%.4f\n' % (grid.to_strings([cell], precision)[0], cell_counts.sum(), cell_depth,
+                                                       richness.mean(), richness.std()))
+                ncells += 1
+    sys.stdout.write("   %d cells rarefied, %d replicates, seed %d\n" % (ncells, args.replicates, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#-*- coding: utf-8 -*-
+
+'''
+Long running easy_gbif server.
+
+Imports, the argument parser, the keep-alive session and the response
+cache are set up once, and every request then runs one easy_gbif command.
+A request is a POST of a json list with the same arguments given on the
+command line, e.g.
+
+   curl -s -d '["-dm", "--dKey", "0000066-140928181241064"]' http://localhost:8642/
+
+and the answer is a json object {"status": <exit code>, "output": <stdout>, "errors": <stderr>}.
+GET /ping answers "pong". A request for another --gbif_url, or a larger
+pool, gets a new session (see easy_gbif._connect); --serve is refused.
+'''
+
+import os
+import sys
+import json
+import threading
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _answer(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/ping':
+            self._answer(200, json.dumps('pong'))
+        else:
+            self._answer(404, json.dumps({'error': 'POST a json list of arguments'}))
+
+    def do_POST(self):
+        try:
+            argv = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if isinstance(argv, dict):
+                argv = argv['argv']
+            argv = [str(arg) for arg in argv]
+        except Exception as e:
+            self._answer(400, json.dumps({'error': 'bad request: %s' % e}))
+            return
+        self._answer(200, json.dumps(self.server.run(argv)))
+
+    def log_message(self, format, *args):
+        sys.stderr.write(" %s\n" % (format % args))
+
+
+class _Server(object):
+    """ runs one command at a time, capturing its output and exit code """
+
+    lock = threading.Lock()
+
+    def run(self, argv):
+        with self.lock:
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = StringIO(), StringIO()
+            status = 0
+            try:
+                self.command(argv)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception as e:
+                sys.stderr.write(" %s\n" % e)
+                status = 1
+            finally:
+                output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+                sys.stdout, sys.stderr = stdout, stderr
+        return {'status': status, 'output': output, 'errors': errors}
+
+
+class HTTPServer(_Server, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+    def __init__(self, address, command):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.command = command
+
+
+class UnixServer(_Server, SocketServer.UnixStreamServer):
+
+    def __init__(self, path, command):
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, _UnixHandler)
+        self.command = command
+
+
+class _UnixHandler(_Handler):
+
+    def address_string(self):
+        return 'unix'
+
+    def setup(self):
+        self.client_address = ('unix', 0)
+        _Handler.setup(self)
+
+
+def serve(command, port=8642, socket_path=None):
+    """ answer requests until interrupted, running command(argv) for each one """
+    if socket_path is not None:
+        server = UnixServer(socket_path, command)
+        where = socket_path
+    else:
+        server = HTTPServer(('127.0.0.1', port), command)
+        where = 'http://127.0.0.1:%d/' % port
+    sys.stderr.write(" easy_gbif serving at %s\n" % where)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
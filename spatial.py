@@ -0,0 +1,158 @@
+#-*- coding: utf-8 -*-
+
+'''
+Spatial index of the local store: bounding box and WKT polygon queries.
+
+Every segment keeps the geohash (12 characters, as a uint64 code) of its
+georeferenced rows in sorted order, with the row order that sorts them.
+All the points of a geohash cell, at any precision, are then one range
+of the sorted codes. A query covers its bounding box with at most
+MAX_CELLS cells of the finest precision that allows, reads the rows of
+those ranges, and refines them with exact, vectorized comparisons: the
+bounding box, then even-odd ray casting for polygons.
+
+   POLYGON((lon lat, lon lat, ...), (hole ...))
+   MULTIPOLYGON(((lon lat, ...)), ((lon lat, ...)))
+'''
+
+import os
+import re
+
+try:
+    import numpy as np
+    import grid
+except ImportError:
+    np = None
+
+
+PRECISION = 12
+MAX_CELLS = 64
+
+
+def index(path, lat, lon):
+    """ write the geohash index of the rows of a segment """
+    rows = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    codes = grid.encode(lat[rows], lon[rows], PRECISION)
+    order = np.argsort(codes, kind='mergesort')
+    np.save(os.path.join(path, 'geohash.sorted.npy'), codes[order])
+    np.save(os.path.join(path, 'geohash.order.npy'), rows[order].astype(np.uint32 if len(lat) < 2 ** 32 else np.int64))
+
+
+def _nest(body):
+    """ nested lists of the parenthesised groups of body, with the innermost groups as strings """
+    stack = [[]]
+    text = ''
+    for char in body:
+        if char == '(':
+            stack.append([])
+            text = ''
+        elif char == ')':
+            group = stack.pop()
+            stack[-1].append(group if group else text)
+            text = ''
+        else:
+            text += char
+    if len(stack) != 1 or len(stack[0]) != 1:
+        raise ValueError("unbalanced parentheses in geometry")
+    return stack[0][0]
+
+
+def _ring(text):
+    points = np.array([[float(value) for value in point.split()] for point in text.split(',')])
+    if points.ndim != 2 or points.shape[1] != 2 or len(points) < 3:
+        raise ValueError("bad polygon ring: %s" % text[:60])
+    return points
+
+
+def parse_wkt(text):
+    """ list of polygons, each a list of rings (arrays of lon, lat) of a WKT POLYGON or MULTIPOLYGON """
+    match = re.match(r'^\s*(MULTIPOLYGON|POLYGON)\s*(\(.*\))\s*$', text, re.I | re.S)
+    if match is None:
+        raise ValueError("geometry must be a WKT POLYGON or MULTIPOLYGON: %s" % text[:60])
+    groups = _nest(match.group(2))
+    if match.group(1).upper() == 'POLYGON':
+        groups = [groups]
+    return [[_ring(ring) for ring in polygon] for polygon in groups]
+
+
+def bounds(polygons):
+    """ (sw_lat, sw_lon, ne_lat, ne_lon) of polygons """
+    points = np.vstack([ring for rings in polygons for ring in rings])
+    return points[:, 1].min(), points[:, 0].min(), points[:, 1].max(), points[:, 0].max()
+
+
+def contains(polygons, lat, lon):
+    """ mask of the points inside any of the polygons (holes excluded) """
+    inside = np.zeros(len(lat), dtype=bool)
+    for rings in polygons:
+        odd = np.zeros(len(lat), dtype=bool)
+        for ring in rings:
+            x1, y1 = ring[:, 0], ring[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            for ax, ay, bx, by in zip(x1, y1, x2, y2):
+                if ay == by:
+                    continue
+                crosses = (ay > lat) != (by > lat)
+                odd ^= crosses & (lon < (bx - ax) * (lat - ay) / (by - ay) + ax)
+        inside |= odd
+    return inside
+
+
+def cover(bbox, max_cells=MAX_CELLS):
+    """ [(start, end)] ranges of PRECISION geohash codes of the cells covering bbox """
+    sw_lat, sw_lon, ne_lat, ne_lon = bbox
+    if sw_lat > ne_lat or sw_lon > ne_lon:
+        return []
+    best = None
+    for precision in range(1, PRECISION + 1):
+        lon_bits, lat_bits = grid._bits(precision)
+        lon_range = grid._quantize([sw_lon, ne_lon], -180.0, 180.0, lon_bits)
+        lat_range = grid._quantize([sw_lat, ne_lat], -90.0, 90.0, lat_bits)
+        if (lon_range[1] - lon_range[0] + 1) * (lat_range[1] - lat_range[0] + 1) > max_cells:
+            break
+        best = precision, lon_range, lat_range
+    if best is None:
+        return [(np.uint64(0), None)]
+    precision, lon_range, lat_range = best
+    lon_index, lat_index = np.meshgrid(np.arange(lon_range[0], lon_range[1] + 1, dtype=np.uint64),
+                                       np.arange(lat_range[0], lat_range[1] + 1, dtype=np.uint64))
+    codes = np.sort(grid.interleave(lon_index.ravel(), lat_index.ravel(), precision))
+    shift = np.uint64(5 * (PRECISION - precision))
+    ranges = []
+    for code in codes:
+        start, end = code << shift, (code + np.uint64(1)) << shift
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def select(segment, bbox=None, polygons=None):
+    """ sorted row numbers of a segment (see store.Segment) inside bbox and the polygons """
+    if polygons is not None:
+        box = bounds(polygons)
+        bbox = box if bbox is None else (max(bbox[0], box[0]), max(bbox[1], box[1]),
+                                         min(bbox[2], box[2]), min(bbox[3], box[3]))
+    lat = segment.array('decimallatitude')
+    lon = segment.array('decimallongitude')
+    if os.path.exists(os.path.join(segment.path, 'geohash.sorted.npy')):
+        codes = segment.array('geohash.sorted')
+        order = segment.array('geohash.order')
+        parts = []
+        for start, end in cover(bbox):
+            first = np.searchsorted(codes, start, side='left')
+            last = len(codes) if end is None else np.searchsorted(codes, end, side='left')
+            parts.append(order[first:last])
+        rows = np.sort(np.concatenate(parts)) if parts else np.array([], dtype=np.int64)
+    else:
+        ## segment added before the spatial index
+        rows = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    row_lat = lat[rows]
+    row_lon = lon[rows]
+    sw_lat, sw_lon, ne_lat, ne_lon = bbox
+    keep = (row_lat >= sw_lat) & (row_lat <= ne_lat) & (row_lon >= sw_lon) & (row_lon <= ne_lon)
+    rows, row_lat, row_lon = rows[keep], row_lat[keep], row_lon[keep]
+    if polygons is not None:
+        rows = rows[contains(polygons, row_lat, row_lon)]
+    return rows
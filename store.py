@@ -0,0 +1,450 @@
+#-*- coding: utf-8 -*-
+
+'''
+Local occurrence store built from downloaded exports.
+
+Each export added to the store becomes a segment: a directory of column
+files made by convert.py, plus, for every indexed column, the column
+values in sorted order and the row order that sorts them. A count on one
+value is then two binary searches; further filters are applied to the
+rows the most selective index gives. The issues of every row are kept as
+a bitmap (one bit per issue of the segment).
+
+   <store>/store.json              segments, their source and their rows
+   <store>/<segment>/<column>.npy  column files (see convert.py)
+   <store>/<segment>/<column>.sorted.npy, <column>.order.npy
+   <store>/<segment>/issues.npy    issue bitmap, with the issue names in index.json
+   <store>/<segment>/geohash.sorted.npy, geohash.order.npy   spatial index (see spatial.py)
+   <store>/<segment>/deleted.npy   tombstones: rows replaced by a later segment (same gbifid) or deleted
+
+The store answers the count and search commands of easy_gbif.py with
+--local, including geometry (WKT) and decimalLatitude/decimalLongitude
+range filters. It only
+knows the records of the exports it holds: taxonKey matches the taxonkey
+and specieskey columns of the simple export for a species or lower rank;
+a genus or higher rank matches its name columns (kingdom .. genus), from a
+stored row identified to that key, and a key on no stored row, whose rank
+is unknown offline, is an error. publishingCountry needs a
+publishingcountry column, absent from simple exports.
+'''
+
+import os
+import json
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import convert
+import spatial
+
+
+INDEXED = ('gbifid', 'taxonkey', 'specieskey', 'year', 'countrycode', 'datasetkey', 'basisofrecord')
+
+## count filter -> store column
+FILTERS = {'taxonKey': ('taxonkey', 'specieskey'),
+           'basisOfRecord': ('basisofrecord',),
+           'country': ('countrycode',),
+           'datasetKey': ('datasetkey',),
+           'year': ('year',),
+           'publishingCountry': ('publishingcountry',),
+           'typeStatus': ('typestatus',)}
+
+## name column of each rank a taxonKey is matched on by name, from the highest
+RANKS = [('KINGDOM', 'kingdom'), ('PHYLUM', 'phylum'), ('CLASS', 'class'), ('ORDER', 'order'),
+         ('FAMILY', 'family'), ('GENUS', 'genus')]
+
+## ranks matched on the taxonkey and specieskey columns
+SPECIFIC = ('SPECIES', 'SUBSPECIES', 'VARIETY', 'SUBVARIETY', 'FORM', 'SUBFORM',
+            'INFRASPECIFIC_NAME', 'INFRASUBSPECIFIC_NAME', 'CULTIVAR', 'STRAIN')
+
+
+class Segment(object):
+    """ the column files and indexes of one export """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'columns.json')) as f:
+            self.info = json.load(f)
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        self.rows = self.info['rows']
+        self._arrays = {}
+        deleted = os.path.join(path, 'deleted.npy')
+        self.deleted = np.load(deleted) if os.path.exists(deleted) else np.array([], dtype=np.int64)
+
+    def array(self, name):
+        """ memory map of a column or index file """
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    def has(self, column):
+        return column in self.info['types']
+
+    def code(self, column, value):
+        """ stored value of value in column: its category code, or the number """
+        if self.info['types'][column] == 'category':
+            try:
+                return self.info['categories'][column].index(value)
+            except ValueError:
+                return None
+        return int(value)
+
+    def _range(self, column, low, high):
+        """ rows with low <= column <= high, from the sorted index """
+        values = self.array(column + '.sorted')
+        start = np.searchsorted(values, low, side='left')
+        end = np.searchsorted(values, high, side='right')
+        return start, end
+
+    def _match(self, column, value):
+        """ (start, end) into the index of column of the rows matching value, None when no row can match """
+        if column == 'year' and ',' in str(value):
+            low, high = [int(bound) for bound in str(value).split(',')]
+            return self._range(column, low, high)
+        code = self.code(column, value)
+        if code is None:
+            return None
+        return self._range(column, code, code)
+
+    def _test(self, column, value, rows):
+        """ mask of rows (row numbers) that match value on a column with no index """
+        values = self.array(column)[rows]
+        if column == 'year' and ',' in str(value):
+            low, high = [int(bound) for bound in str(value).split(',')]
+            return (values >= low) & (values <= high)
+        code = self.code(column, value)
+        return values == code if code is not None else np.zeros(len(rows), dtype=bool)
+
+    def select(self, filters, bbox=None, polygons=None):
+        """ row numbers matching every filter, and inside bbox and polygons, or None for all rows """
+        ranges = []
+        tests = []
+        if bbox is not None or polygons is not None:
+            ranges.append(spatial.select(self, bbox, polygons))
+        for name, value in filters.items():
+            if name in ('isGeoreferenced', 'hasCoordinate'):
+                tests.append(('georeferenced', value))
+            elif name == 'issue':
+                tests.append(('issue', value))
+            elif name == 'classification':
+                ## a taxon of genus rank or higher: its name and those of its parents (Store._taxon)
+                for column, label in sorted(value.items()):
+                    if not self.has(column):
+                        raise ValueError("the local store has no %s column" % column)
+                    tests.append(('name', (column, label)))
+            elif name in FILTERS:
+                columns = [column for column in FILTERS[name] if self.has(column)]
+                if not columns:
+                    raise ValueError("the local store has no %s column" % FILTERS[name][0])
+                if len(columns) > 1:
+                    ## a value of any of the columns (taxonkey or specieskey)
+                    parts = [self._match(column, value) for column in columns]
+                    rows = [self.array(column + '.order')[part[0]:part[1]] for column, part in zip(columns, parts) if part]
+                    ranges.append(np.unique(np.concatenate(rows)) if rows else np.array([], dtype=np.int64))
+                    continue
+                part = self._match(columns[0], value)
+                if part is None:
+                    return np.array([], dtype=np.int64)
+                ranges.append((columns[0], value, part))
+            else:
+                raise ValueError("the local store can not filter on %s" % name)
+
+        ## start from the smallest set of rows, test the other filters on them
+        rows = None
+        if ranges:
+            sizes = [len(item) if isinstance(item, np.ndarray) else item[2][1] - item[2][0] for item in ranges]
+            first = ranges.pop(sizes.index(min(sizes)))
+            if isinstance(first, np.ndarray):
+                rows = first
+            else:
+                column, value, (start, end) = first
+                rows = np.sort(self.array(column + '.order')[start:end])
+            for item in ranges:
+                if isinstance(item, np.ndarray):
+                    rows = np.intersect1d(rows, item, assume_unique=True)
+                else:
+                    column, value, part = item
+                    rows = rows[self._test(column, value, rows)]
+        for kind, value in tests:
+            if rows is None:
+                rows = np.arange(self.rows)
+            if kind == 'georeferenced':
+                lat = self.array('decimallatitude')[rows]
+                lon = self.array('decimallongitude')[rows]
+                rows = rows[~(np.isnan(lat) | np.isnan(lon))]
+            elif kind == 'name':
+                rows = rows[self._test(value[0], value[1], rows)]
+            else:
+                issues = self.index['issues']
+                if value not in issues:
+                    return np.array([], dtype=np.int64)
+                bit = np.uint64(1) << np.uint64(issues.index(value))
+                rows = rows[(self.array('issues')[rows] & bit) != 0]
+        if len(self.deleted):
+            rows = np.arange(self.rows) if rows is None else rows
+            rows = rows[~np.in1d(rows, self.deleted, assume_unique=True)]
+        return rows
+
+    def find(self, gbifids):
+        """ row numbers of the live rows holding any of gbifids """
+        gbifids = np.asarray(gbifids, dtype=np.int64)
+        if os.path.exists(os.path.join(self.path, 'gbifid.sorted.npy')):
+            values = self.array('gbifid.sorted')
+            start = np.searchsorted(values, gbifids, side='left')
+            end = np.searchsorted(values, gbifids, side='right')
+            order = self.array('gbifid.order')
+            parts = [order[first:last] for first, last in zip(start, end) if last > first]
+            rows = np.concatenate(parts) if parts else np.array([], dtype=np.int64)
+        else:
+            ## segment added before the gbifid index
+            rows = np.flatnonzero(np.in1d(self.array('gbifid'), gbifids))
+        return np.setdiff1d(rows.astype(np.int64), self.deleted)
+
+    def delete(self, rows):
+        """ add tombstones for rows, so they are no longer counted nor searched """
+        self.deleted = np.union1d(self.deleted, np.asarray(rows, dtype=np.int64))
+        tmp = os.path.join(self.path, 'deleted.tmp.npy')
+        np.save(tmp, self.deleted)
+        os.rename(tmp, os.path.join(self.path, 'deleted.npy'))
+
+    def count(self, filters, bbox=None, polygons=None):
+        if not filters and bbox is None and polygons is None:
+            return self.rows - len(self.deleted)
+        rows = self.select(filters, bbox, polygons)
+        return self.rows if rows is None else len(rows)
+
+    def count_by(self, column, filters, bbox=None, polygons=None):
+        """ value -> count of the rows matching filters """
+        if not self.has(column):
+            raise ValueError("the local store has no %s column" % column)
+        rows = self.select(filters, bbox, polygons)
+        values = self.array(column) if rows is None else self.array(column)[rows]
+        uniques, counts = np.unique(values, return_counts=True)
+        if self.info['types'][column] == 'category':
+            names = self.info['categories'][column]
+            return dict((names[code], int(n)) for code, n in zip(uniques, counts) if code >= 0)
+        return dict((str(value), int(n)) for value, n in zip(uniques, counts) if value >= 0)
+
+    def records(self, rows):
+        """ the rows as dicts of their column values (None when missing) """
+        columns = {}
+        for name, type_ in self.info['types'].items():
+            values = self.array(name)[rows]
+            if type_ == 'category':
+                names = self.info['categories'][name]
+                columns[name] = [names[code] if code >= 0 else None for code in values]
+            elif type_ == 'date':
+                columns[name] = [str(value) if not np.isnat(value) else None for value in values]
+            elif type_ == 'float':
+                columns[name] = [float(value) if not np.isnan(value) else None for value in values]
+            else:
+                columns[name] = [int(value) if value >= 0 else None for value in values]
+        return [dict((name, columns[name][i]) for name in columns) for i in range(len(rows))]
+
+
+def _index(path, info):
+    """ write the sorted indexes and the issue bitmap of a converted export """
+    indexes = []
+    for column in INDEXED:
+        if column not in info['types']:
+            continue
+        values = np.load(os.path.join(path, column + '.npy'), mmap_mode='r')
+        order = np.argsort(values, kind='mergesort')
+        order = order.astype(np.uint32 if len(values) < 2 ** 32 else np.int64)
+        np.save(os.path.join(path, column + '.order.npy'), order)
+        np.save(os.path.join(path, column + '.sorted.npy'), values[order])
+        indexes.append(column)
+
+    issues = []
+    if 'issue' in info['types']:
+        names = info['categories']['issue']
+        issues = sorted(set(flag for name in names for flag in name.split(';') if flag))
+        if len(issues) > 64:
+            raise ValueError("more than 64 issues in one export")
+        masks = np.array([sum(1 << issues.index(flag) for flag in set(name.split(';')) if flag) for name in names] + [0],
+                         dtype=np.uint64)
+        ## code -1 (no issue) takes the last, empty mask
+        np.save(os.path.join(path, 'issues.npy'), masks[np.load(os.path.join(path, 'issue.npy'))])
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump({'indexes': indexes, 'issues': issues}, f, indent=1)
+
+
+class Store(object):
+    """ a directory of indexed segments """
+
+    def __init__(self, path):
+        convert._require_numpy()
+        self.path = path
+        self.state_path = os.path.join(path, 'store.json')
+        self.state = {'segments': []}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        self._segments = {}
+
+    def save(self):
+        """ write the state to a temporary file, then rename it over the old one """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.rename(tmp, self.state_path)
+
+    def segments(self):
+        for entry in self.state['segments']:
+            if entry['name'] not in self._segments:
+                self._segments[entry['name']] = Segment(os.path.join(self.path, entry['name']))
+            yield self._segments[entry['name']]
+
+    def add(self, export, source=None, processes=1):
+        """
+        convert and index an export (zip or tab separated file) into a new segment,
+        returning its entry. Records already in the store (same gbifid) are replaced:
+        their old rows get tombstones.
+        """
+        name = 'segment-%05d' % (len(self.state['segments']) + 1)
+        path = os.path.join(self.path, name)
+        rows, rejected = convert.convert(export, path, processes=processes)
+        with open(os.path.join(path, 'columns.json')) as f:
+            info = json.load(f)
+        _index(path, info)
+        spatial.index(path, np.load(os.path.join(path, 'decimallatitude.npy'), mmap_mode='r'),
+                      np.load(os.path.join(path, 'decimallongitude.npy'), mmap_mode='r'))
+        entry = {'name': name, 'source': source or os.path.abspath(export), 'rows': rows,
+                 'rejected': rejected, 'added': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        entry['replaced'] = self.delete(np.load(os.path.join(path, 'gbifid.npy'), mmap_mode='r'))
+        self.state['segments'].append(entry)
+        self.save()
+        return entry
+
+    def delete(self, gbifids):
+        """ tombstone every stored row of gbifids, returning the number of rows deleted """
+        deleted = 0
+        for segment in self.segments():
+            rows = segment.find(gbifids)
+            if len(rows):
+                segment.delete(rows)
+                deleted += len(rows)
+        return deleted
+
+    def _filters(self, filters):
+        """ (filters, bbox, polygons) of the count or search filters that are set """
+        filters = dict((name, value) for name, value in filters.items() if value is not None and value is not False)
+        bbox = None
+        polygons = None
+        if 'geometry' in filters:
+            polygons = spatial.parse_wkt(filters.pop('geometry'))
+        if 'decimalLatitude' in filters or 'decimalLongitude' in filters:
+            lat = [float(bound) for bound in str(filters.pop('decimalLatitude', '-90,90')).split(',')]
+            lon = [float(bound) for bound in str(filters.pop('decimalLongitude', '-180,180')).split(',')]
+            bbox = (lat[0], lon[0], lat[-1], lon[-1])
+        if polygons is not None and bbox is None:
+            bbox = spatial.bounds(polygons)
+        if 'taxonKey' in filters:
+            names = self._taxon(filters['taxonKey'])
+            if names is not None:
+                del filters['taxonKey']
+                filters['classification'] = names
+        return filters, bbox, polygons
+
+    def _taxon(self, key):
+        """
+        {name column: name} of a taxon key of genus rank or higher, from a stored row
+        identified to it, with the names of its parents; None for a species or lower rank
+        """
+        for segment in self.segments():
+            if segment.has('specieskey'):
+                part = segment._match('specieskey', key)
+                if part is not None and part[1] > part[0]:
+                    return None
+            if not segment.has('taxonkey'):
+                continue
+            part = segment._match('taxonkey', key)
+            if part is None or part[1] == part[0]:
+                continue
+            record = segment.records([segment.array('taxonkey.order')[part[0]]])[0]
+            rank = (record.get('taxonrank') or '').upper()
+            if rank in SPECIFIC:
+                return None
+            ranks = [name for name, column in RANKS]
+            if rank not in ranks:
+                raise ValueError("taxonKey %s is of rank %s, the local store matches species and lower ranks, or %s"
+                                 % (key, rank or 'unknown', ', '.join(ranks)))
+            return dict((column, record[column]) for name, column in RANKS[:ranks.index(rank) + 1] if record.get(column))
+        raise ValueError("taxonKey %s is on no row of the local store: its rank, and so the rows of its "
+                         "lower taxa, are unknown offline" % key)
+
+    def count(self, **filters):
+        filters, bbox, polygons = self._filters(filters)
+        return sum(segment.count(filters, bbox, polygons) for segment in self.segments())
+
+    def count_by(self, column, **filters):
+        filters, bbox, polygons = self._filters(filters)
+        result = {}
+        for segment in self.segments():
+            for value, n in segment.count_by(column, filters, bbox, polygons).items():
+                result[value] = result.get(value, 0) + n
+        return result
+
+    def select(self, **filters):
+        """ yields (segment, row numbers) of the rows matching filters """
+        filters, bbox, polygons = self._filters(filters)
+        for segment in self.segments():
+            rows = segment.select(filters, bbox, polygons)
+            yield segment, np.arange(segment.rows) if rows is None else rows
+
+    def search(self, limit=300, offset=0, **filters):
+        """ a page of records matching filters, shaped like occ.search results """
+        offset = offset or 0
+        count = 0
+        results = []
+        for segment, rows in self.select(**filters):
+            first = max(offset - count, 0)
+            wanted = rows[first:first + limit - len(results)]
+            results.extend(segment.records(wanted))
+            count += len(rows)
+        return {'offset': offset, 'limit': limit, 'endOfRecords': offset + len(results) >= count,
+                'count': count, 'results': results}
+
+    def walk(self, offset=0, max_records=None, batch=1000, **filters):
+        """ yields the records matching filters from offset on, in lists of at most batch records """
+        skip = offset or 0
+        left = max_records
+        for segment, rows in self.select(**filters):
+            if skip >= len(rows):
+                skip -= len(rows)
+                continue
+            rows = rows[skip:]
+            skip = 0
+            for start in range(0, len(rows), batch):
+                part = rows[start:start + batch]
+                if left is not None:
+                    part = part[:left]
+                    left -= len(part)
+                yield segment.records(part)
+                if left == 0:
+                    return
+
+    def info(self):
+        """ what the store covers: segments, rows, and the range of years, event dates and interpretation dates """
+        covers = {'path': os.path.abspath(self.path), 'rows': 0, 'deleted': 0, 'segments': self.state['segments']}
+        bounds = {}
+        for segment in self.segments():
+            covers['rows'] += segment.rows - len(segment.deleted)
+            covers['deleted'] += len(segment.deleted)
+            for column in ('year', 'eventdate', 'lastinterpreted'):
+                if not segment.has(column) or not segment.rows:
+                    continue
+                values = segment.array(column)
+                values = values[~np.isnat(values)] if values.dtype.kind == 'M' else values[values >= 0]
+                if len(values):
+                    low, high = bounds.get(column, (values.min(), values.max()))
+                    bounds[column] = (min(low, values.min()), max(high, values.max()))
+        for column, (low, high) in bounds.items():
+            covers[column] = [str(low), str(high)]
+        return covers
@@ -0,0 +1,132 @@
+#-*- coding: utf-8 -*-
+
+'''
+Incremental sync of a local store.
+
+Every synced query keeps a high-water mark, the latest lastInterpreted
+date seen for it, in <store>/sync.json. A sync fetches only the records
+reinterpreted since the mark. Small change sets come through the paged
+search, and larger ones through a delta download (lastInterpreted >= mark).
+Either way they become a new segment of the store, and the old rows of
+the same gbifids get tombstones (store.Store.add). The first sync of a
+query starts from the latest lastInterpreted date already in the store.
+'''
+
+import os
+import json
+import time
+import tempfile
+
+import config
+import convert
+
+
+## largest change set fetched with the paged search, larger ones are downloaded
+MAX_SEARCH = config.SYNC_MAX_SEARCH
+
+
+def _column(name):
+    """ export column of a search record field """
+    if name == 'key':
+        return 'gbifid'
+    if name == 'issues':
+        return 'issue'
+    return name.lower()
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = ';'.join(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\t', ' ').replace('\n', ' ').replace('\r', ' ')
+
+
+def write_records(path, records):
+    """ write search records as a tab separated export, the latest record of every gbifid only """
+    latest = {}
+    for record in records:
+        latest[record.get('key', record.get('gbifID'))] = record
+    with open(path, 'w') as f:
+        f.write('\t'.join(convert.DEFAULT_COLUMNS) + '\n')
+        for record in latest.values():
+            row = dict((_column(name), value) for name, value in record.items())
+            f.write('\t'.join(_cell(row.get(column)) for column in convert.DEFAULT_COLUMNS) + '\n')
+    return len(latest)
+
+
+class Sync(object):
+    """ high-water marks of the synced queries of a store """
+
+    def __init__(self, store):
+        self.store = store
+        self.state_path = os.path.join(store.path, 'sync.json')
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+    def save(self):
+        """ write the state to a temporary file, then rename it over the old one """
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.state_path)
+
+    def mark(self, filters, since=None):
+        """ the high-water mark of a query: since, its last sync, or the latest lastInterpreted of the store """
+        entry = self.state.get(json.dumps(filters, sort_keys=True))
+        if since is not None:
+            return since
+        if entry is not None:
+            return entry['mark']
+        return self.store.info().get('lastinterpreted', [None, None])[1]
+
+    def sync(self, filters, search, download=None, since=None, max_search=MAX_SEARCH):
+        """
+        fetch the records of filters reinterpreted since the mark and upsert them.
+        search(filters) yields pages of occ.search results; download(filters, mark)
+        returns the path of a zip, used when more than max_search records changed.
+        """
+        mark = self.mark(filters, since)
+        if mark is None:
+            raise ValueError("no high-water mark: the store has no lastinterpreted dates, give --sync_since")
+        delta = dict(filters, lastInterpreted='%s,*' % mark)
+        entry = {'query': filters, 'previous': mark, 'mark': mark, 'records': 0, 'replaced': 0,
+                 'segment': None, 'synced': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+        pages = search(delta)
+        first = next(pages, None)
+        changed = first['count'] if first is not None else 0
+        if changed > max_search and download is not None:
+            entry['via'] = 'download'
+            path = download(filters, mark)
+        else:
+            entry['via'] = 'search'
+            records = []
+            for page in ([first] if first is not None else []):
+                records.extend(page['results'])
+            for page in pages:
+                records.extend(page['results'])
+            handle, path = tempfile.mkstemp(suffix='.tsv', prefix='delta-', dir=self.store.path)
+            os.close(handle)
+            write_records(path, records)
+            marks = [record['lastInterpreted'][:10] for record in records if record.get('lastInterpreted')]
+            if marks:
+                entry['mark'] = max(marks)
+
+        try:
+            if changed:
+                segment = self.store.add(path, source='sync %s since %s' % (json.dumps(filters, sort_keys=True), mark))
+                entry.update(records=segment['rows'], replaced=segment['replaced'], segment=segment['name'])
+                if entry['via'] == 'download':
+                    info = self.store.info()
+                    entry['mark'] = info.get('lastinterpreted', [mark, mark])[1]
+        finally:
+            if entry['via'] == 'search':
+                os.remove(path)
+        self.state[json.dumps(filters, sort_keys=True)] = entry
+        self.save()
+        return entry
@@ -0,0 +1,57 @@
+#-*- coding: utf-8 -*-
+
+'''
+Startup budget of easy_gbif.py: a subcommand that only parses its
+arguments, and the legacy flags building the whole parser, may add at most
+STARTUP_BUDGET ms (bench/run.py) to the start of a bare interpreter. A heavy
+import creeping back into the parser (pygbif, requests, numpy) fails here.
+
+   python -m unittest discover tests
+'''
+
+import os
+import sys
+import time
+import subprocess
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from run import STARTUP_BUDGET
+
+## runs of each command, the median is compared
+RUNS = 10
+
+
+def _median_ms(command):
+    env = dict(os.environ, GBIF_USER='user', GBIF_PWD='pwd', GBIF_EMAIL='email')
+    seconds = []
+    with open(os.devnull, 'w') as devnull:
+        for n in range(RUNS):
+            start = time.time()
+            subprocess.check_call(command, stdout=devnull, stderr=devnull, cwd=ROOT, env=env)
+            seconds.append(time.time() - start)
+    return 1000 * sorted(seconds)[len(seconds) // 2]
+
+
+class StartupTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bare = _median_ms([sys.executable, '-c', 'pass'])
+
+    def check(self, *argv):
+        overhead = _median_ms([sys.executable, os.path.join(ROOT, 'easy_gbif.py')] + list(argv)) - self.bare
+        self.assertLessEqual(overhead, STARTUP_BUDGET, "%s takes %.1f ms over a bare interpreter, budget %d ms"
+                             % (' '.join(argv), overhead, STARTUP_BUDGET))
+
+    def test_subcommand_help(self):
+        self.check('get', '--help')
+
+    def test_legacy_help(self):
+        self.check('-g', '--help')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#-*- coding: utf-8 -*-
+
+'''
+Resumable, verified download of GBIF export zips.
+
+The zip is streamed in bounded chunks to <path>/<key>.zip.part. When the
+transfer breaks, the next attempt asks only for the missing bytes with an
+HTTP Range request. Once the part file has the size given by download_meta
+and the CRC of every zip member checks out, it is renamed to <path>/<key>.zip,
+so a .zip on disk is always complete.
+'''
+
+import os
+import sys
+import time
+import zipfile
+import requests
+
+DOWNLOAD_URL = 'http://api.gbif.org/v1/occurrence/download/request/'
+CHUNK = 1024 * 1024
+
+
+def _transfer(session, url, part, offset, chunk_size):
+    """ append the bytes of url from offset on to part """
+    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+    response = session.request('GET', url, headers=headers, stream=True, timeout=60)
+    response.raise_for_status()
+    mode = 'ab'
+    if offset and response.status_code != 206:
+        ## the server ignored the range, start over
+        mode = 'wb'
+    with open(part, mode) as f:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def download_get(key, meta, path='.', session=None, retries=5, backoff=1, chunk_size=CHUNK, verify=True):
+    """
+    get the zip of download key, given its download_meta, into path.
+    Returns {'path': ..., 'size': ..., 'key': ...} like occ.download_get.
+    """
+    if meta['status'] != 'SUCCEEDED':
+        raise Exception('download "%s" not of status SUCCEEDED' % key)
+    session = session or requests.Session()
+    size = int(meta['size'])
+    url = meta.get('downloadLink') or DOWNLOAD_URL + key
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    target = os.path.join(path, '%s.zip' % key)
+    part = target + '.part'
+
+    sys.stdout.write('Download file size: %s bytes\n' % size)
+    if not (os.path.exists(target) and os.path.getsize(target) == size):
+        attempt = 0
+        while True:
+            have = os.path.getsize(part) if os.path.exists(part) else 0
+            if have > size:
+                os.remove(part)
+                have = 0
+            if have == size:
+                break
+            try:
+                _transfer(session, url, part, have, chunk_size)
+                if os.path.getsize(part) == size:
+                    break
+                error = IOError('transfer ended at %d of %d bytes' % (os.path.getsize(part), size))
+            except (requests.RequestException, IOError) as e:
+                error = e
+            attempt += 1
+            if attempt > retries:
+                raise error
+            sys.stderr.write(' %s: %s, resuming\n' % (key, error))
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        if verify:
+            with zipfile.ZipFile(part) as archive:
+                bad = archive.testzip()
+            if bad is not None:
+                os.remove(part)
+                raise IOError('%s: bad CRC for %s, removed the partial download' % (key, bad))
+        os.rename(part, target)
+    sys.stdout.write('On disk at %s\n' % target)
+    sys.stdout.flush()
+    return {'path': target, 'size': size, 'key': key}
@@ -0,0 +1,109 @@
+#-*- coding: utf-8 -*-
+
+'''
+One keep-alive HTTP session shared by every pygbif call.
+
+pygbif calls requests.get/requests.post at module level, so every call
+opens (and for https, handshakes) a new connection. install() replaces
+the requests module seen by the pygbif modules with a proxy that sends
+everything through a single pooled requests.Session. Installing again
+replaces that session, for the modules already rerouted too.
+'''
+
+import sys
+import requests
+from requests.adapters import HTTPAdapter
+
+
+GBIF_BASEURL = 'http://api.gbif.org/v1/'
+
+
+def _base(url):
+    return url.rstrip('/') + '/' if url else None
+
+
+class Transport(object):
+    """
+    pooled keep-alive session, with pool_size connections kept per host.
+    With base_url, calls to the GBIF api are sent there instead (e.g. a local stub of the api).
+    With metrics (a metrics.Metrics), every call is timed.
+    """
+
+    def __init__(self, pool_size=10, base_url=None):
+        self.base_url = _base(base_url)
+        self.pool_size = pool_size
+        self.metrics = None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if self.base_url is not None:
+            for prefix in (GBIF_BASEURL, GBIF_BASEURL.replace('http:', 'https:')):
+                if url.startswith(prefix):
+                    url = self.base_url + url[len(prefix):]
+        if self.metrics is not None:
+            return self.metrics.request(self.session.request, method, url, **kwargs)
+        return self.session.request(method, url, **kwargs)
+
+    def serves(self, pool_size, base_url):
+        """ true when the session sends to base_url with at least pool_size connections per host """
+        return self.base_url == _base(base_url) and self.pool_size >= pool_size
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        """ count of requests sent, connections opened and connections reused """
+        sent = 0
+        opened = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                sent += pool.num_requests
+                opened += pool.num_connections
+        return {'requests': sent, 'connections_opened': opened, 'connections_reused': sent - opened}
+
+
+class _RequestsProxy(object):
+    """ stands in for the requests module inside pygbif """
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def request(self, method, url, **kwargs):
+        return self._transport.request(method, url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self._transport.request('GET', url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self._transport.request('POST', url, data=data, json=json, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self._transport.request('DELETE', url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+_transport = None
+
+def install(pool_size=10, base_url=None):
+    """ route every pygbif http call through one shared Transport and return it """
+    global _transport
+    _transport = Transport(pool_size=pool_size, base_url=base_url)
+    proxy = _RequestsProxy(_transport)
+    for name, module in sys.modules.items():
+        if name.split('.')[0] == 'pygbif' and (getattr(module, 'requests', None) is requests
+                                               or isinstance(getattr(module, 'requests', None), _RequestsProxy)):
+            module.requests = proxy
+    return _transport
+
+def get_transport():
+    """ the installed Transport, installing a default one if needed """
+    if _transport is None:
+        install()
+    return _transport
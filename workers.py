@@ -0,0 +1,151 @@
+#-*- coding: utf-8 -*-
+
+'''
+Thread pool helpers to fan GBIF requests out:
+
+   RateLimiter   token bucket shared by every call to the same host
+   retry         call again with jittered exponential backoff
+   imap          bounded thread pool, results in input or completion order
+'''
+
+import sys
+import time
+import random
+import threading
+import Queue
+
+
+class RateLimiter(object):
+    """ token bucket allowing `rate` calls per second, with bursts of `burst` calls """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, int(rate)))
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """ allow `rate` calls per second from now on, the burst following it """
+        with self.lock:
+            self.rate = float(rate)
+            self.burst = float(max(1, int(rate)))
+            self.tokens = min(self.tokens, self.burst)
+
+    def wait(self):
+        """ block until a call is allowed """
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter(host, rate):
+    """ get the rate limiter shared by every call to host, at the rate of the last caller (a --serve request may change it) """
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = RateLimiter(rate)
+        elif _limiters[host].rate != float(rate):
+            _limiters[host].set_rate(rate)
+        return _limiters[host]
+
+
+def retry(func, retries=3, backoff=0.5, limiter=None, fatal=None, on_retry=None):
+    """
+    call func(), retrying with full-jitter exponential backoff when it raises.
+    Exceptions for which fatal(exception) is true are raised at once.
+    on_retry(exception) is called before every retry.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.wait()
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= retries or (fatal is not None and fatal(e)):
+                raise
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+            attempt += 1
+
+
+def imap(func, items, workers=4, ordered=True, window=None):
+    """
+    map func over items in a pool of threads, yielding (item, result, error) tuples.
+    error is the sys.exc_info() of a failed call, and result is then None.
+    At most `window` items are in flight or waiting to be yielded, so items
+    may be a long lazy iterator. With ordered=False results come in completion order.
+    Closing the generator early waits for the calls in flight.
+    """
+    window = window or workers * 2
+    todo = Queue.Queue()
+    done = Queue.Queue()
+
+    def work():
+        while True:
+            job = todo.get()
+            if job is None:
+                return
+            index, item = job
+            try:
+                done.put((index, item, func(item), None))
+            except:
+                done.put((index, item, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    items = iter(items)
+    exhausted = False
+    submitted = 0
+    yielded = 0
+    buffered = {}
+    try:
+        while True:
+            while not exhausted and submitted - yielded < window:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                todo.put((submitted, item))
+                submitted += 1
+            if submitted == yielded:
+                return
+            index, item, result, error = done.get()
+            if not ordered:
+                yielded += 1
+                yield item, result, error
+                continue
+            buffered[index] = (item, result, error)
+            while yielded in buffered:
+                entry = buffered.pop(yielded)
+                yielded += 1
+                yield entry
+    finally:
+        ## on an early exit, drop the items not started and wait for those in flight:
+        ## no thread is left running into interpreter shutdown
+        try:
+            while True:
+                todo.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in threads:
+            todo.put(None)
+        for thread in threads:
+            thread.join()